@@ -186,6 +186,7 @@ class PJSIP_build_ext(build_ext):
     def update_extension(self, extension):
         build_mak_vars = self.get_makefile_variables(os.path.join(self.build_dir, "build.mak"))
         extension.include_dirs = self.get_opts_from_string(build_mak_vars["PJ_CFLAGS"], "-I")
+        extension.include_dirs.append(os.path.join(self.build_dir, "third_party", "opus", "include"))
         extension.library_dirs = self.get_opts_from_string(build_mak_vars["PJ_LDFLAGS"], "-L")
         extension.libraries = self.get_opts_from_string(build_mak_vars["PJ_LDLIBS"], "-l")
         extension.define_macros = [tuple(define.split("=", 1)) for define in self.get_opts_from_string(build_mak_vars["PJ_CFLAGS"], "-D")]
@@ -31,6 +31,7 @@ from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import AudioMixer, Engine
 from sipsimple.lookup import DNSManager
 from sipsimple.session import SessionManager
+from sipsimple.streams.rtp import RTPTransportPool
 from sipsimple.storage import ISIPSimpleStorage, ISIPSimpleApplicationDataStorage
 from sipsimple.threading import ThreadManager, run_in_thread, run_in_twisted_thread
 from sipsimple.threading.green import run_in_green_thread
@@ -266,6 +267,7 @@ class SIPApplication(object):
         account_manager.start()
         addressbook_manager.start()
         session_manager.start()
+        RTPTransportPool().start()
 
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange')
         notification_center.add_observer(self, name='DNSNameserversDidChange')
@@ -289,6 +291,7 @@ class SIPApplication(object):
         self._timer = None
 
         # shutdown middleware components
+        RTPTransportPool().stop()
         dns_manager = DNSManager()
         account_manager = AccountManager()
         addressbook_manager = AddressbookManager()
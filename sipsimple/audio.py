@@ -3,21 +3,24 @@
 
 from __future__ import absolute_import
 
-__all__ = ['IAudioPort', 'AudioDevice', 'AudioBridge', 'RootAudioBridge', 'AudioConference', 'WavePlayer', 'WavePlayerError', 'WaveRecorder']
+__all__ = ['IAudioPort', 'AudioDevice', 'AudioBridge', 'AudioPortGroups', 'RootAudioBridge', 'AudioConference', 'WaveBufferCache', 'WavePlayer', 'WavePlayerError', 'WaveRecorder', 'AudioRecorder']
 
 import os
 import weakref
+from collections import OrderedDict
 from functools import partial
 from itertools import combinations
 from threading import RLock
 
 from application.notification import IObserver, NotificationCenter, NotificationData, ObserverWeakrefProxy
+from application.python.types import Singleton
 from application.system import makedirs
 from eventlib import coros
 from twisted.internet import reactor
 from zope.interface import Attribute, Interface, implements
 
-from sipsimple.core import MixerPort, RecordingWaveFile, SIPCoreError, WaveFile
+from sipsimple.configuration.settings import SIPSimpleSettings
+from sipsimple.core import AsyncRecordingFile, MixerPort, RecordingWaveFile, SIPCoreError, WaveBuffer, WaveFile
 from sipsimple.threading import run_in_twisted_thread
 from sipsimple.threading.green import Command, run_in_waitable_green_thread
 
@@ -106,6 +109,100 @@ class AudioDevice(object):
     del _get_output_muted, _set_output_muted
 
 
+class _AudioPortGroup(object):
+    def __init__(self, bus):
+        self.bus = bus
+        self.ports = []
+
+
+class AudioPortGroups(object):
+    """
+    Connects the ports of a bridge in groups of at most group_size ports
+    instead of in a full-mesh. The ports of a group are connected to each
+    other and each group has a MixerPort which sums the audio of its
+    producers and feeds it to the consumers of all the other groups. For N
+    ports this needs about N*(group_size + N/group_size) connections instead
+    of N^2, at the cost of 20ms of extra delay for the audio going from one
+    group to another.
+    """
+
+    def __init__(self, mixer, group_size):
+        if group_size < 1:
+            raise ValueError("group_size must be at least 1")
+        self.mixer = mixer
+        self.group_size = group_size
+        self.groups = []
+        self._port_groups = {}
+
+    def add(self, port, portwr):
+        group = next((group for group in self.groups if len(group.ports) < self.group_size), None)
+        if group is None:
+            group = self._create_group()
+        self._connect_port(group, port, port.producer_slot, port.consumer_slot, self.mixer.connect_slots)
+        group.ports.append(portwr)
+        self._port_groups[portwr] = group
+
+    def remove(self, port):
+        portwr = weakref.ref(port)
+        group = self._port_groups.pop(portwr)
+        group.ports.remove(portwr)
+        self._connect_port(group, port, port.producer_slot, port.consumer_slot, self.mixer.disconnect_slots)
+        if not group.ports:
+            self._remove_group(group)
+
+    def discard(self, portwr):
+        # the port is gone and the mixer dropped its connections along with its slots
+        group = self._port_groups.pop(portwr, None)
+        if group is not None:
+            group.ports.remove(portwr)
+            if not group.ports:
+                self._remove_group(group)
+
+    def update_slots(self, port, old_producer_slot, new_producer_slot, old_consumer_slot, new_consumer_slot):
+        group = self._port_groups[weakref.ref(port)]
+        self._connect_port(group, port, old_producer_slot, old_consumer_slot, self.mixer.disconnect_slots)
+        self._connect_port(group, port, new_producer_slot, new_consumer_slot, self.mixer.connect_slots)
+
+    def clear(self):
+        for group in self.groups:
+            for port in (wr() for wr in group.ports):
+                if port is not None:
+                    self._connect_port(group, port, port.producer_slot, port.consumer_slot, self.mixer.disconnect_slots)
+            group.bus.stop()
+        del self.groups[:]
+        self._port_groups.clear()
+
+    def _connect_port(self, group, port, producer_slot, consumer_slot, action):
+        if producer_slot is not None and group.bus.slot is not None:
+            action(producer_slot, group.bus.slot)
+        for other in (wr() for wr in group.ports):
+            if other is None or other is port:
+                continue
+            if other.producer_slot is not None and consumer_slot is not None:
+                action(other.producer_slot, consumer_slot)
+            if producer_slot is not None and other.consumer_slot is not None:
+                action(producer_slot, other.consumer_slot)
+        if consumer_slot is not None:
+            for other_group in self.groups:
+                if other_group is not group and other_group.bus.slot is not None:
+                    action(other_group.bus.slot, consumer_slot)
+
+    def _create_group(self):
+        group = _AudioPortGroup(MixerPort(self.mixer))
+        group.bus.start()
+        for other_group in self.groups:
+            for other in (wr() for wr in other_group.ports):
+                if other is not None and other.consumer_slot is not None:
+                    self.mixer.connect_slots(group.bus.slot, other.consumer_slot)
+        self.groups.append(group)
+        return group
+
+    def _remove_group(self, group):
+        # stopping the bus removes its slot and with it all of its connections
+        self.groups.remove(group)
+        group.bus.stop()
+
+
 class AudioBridge(object):
     """
     An AudioBridge is a container for objects providing the IAudioPort interface.
@@ -116,14 +213,19 @@ class AudioBridge(object):
     contain another bridge. This must be done such that the resulting structure
     is a tree (i.e. no loops are allowed). All leafs of the tree will be
     connected as if they were the children of a single bridge.
+
+    If group_size is given, the objects are connected in groups using
+    AudioPortGroups instead of in a full-mesh, which scales better for
+    bridges with many participants.
     """
 
     implements(IAudioPort, IObserver)
 
-    def __init__(self, mixer):
+    def __init__(self, mixer, group_size=None):
         self._lock = RLock()
         self.ports = set()
         self.mixer = mixer
+        self._groups = AudioPortGroups(mixer, group_size) if group_size is not None else None
         self.multiplexer = MixerPort(mixer)
         self.demultiplexer = MixerPort(mixer)
         self.multiplexer.start()
@@ -134,7 +236,9 @@ class AudioBridge(object):
     def __del__(self):
         self.multiplexer.stop()
         self.demultiplexer.stop()
-        if len(self.ports) >= 2:
+        if self._groups is not None:
+            self._groups.clear()
+        elif len(self.ports) >= 2:
             for port1, port2 in ((wr1(), wr2()) for wr1, wr2 in combinations(self.ports, 2)):
                 if port1 is None or port2 is None:
                     continue
@@ -167,19 +271,23 @@ class AudioBridge(object):
                 self.mixer.connect_slots(self.demultiplexer.slot, port.consumer_slot)
             if port.producer_slot is not None and self.multiplexer.slot is not None:
                 self.mixer.connect_slots(port.producer_slot, self.multiplexer.slot)
-            for other in (wr() for wr in self.ports):
-                if other is None:
-                    continue
-                if other.producer_slot is not None and port.consumer_slot is not None:
-                    self.mixer.connect_slots(other.producer_slot, port.consumer_slot)
-                if port.producer_slot is not None and other.consumer_slot is not None:
-                    self.mixer.connect_slots(port.producer_slot, other.consumer_slot)
             # This hack is required because a weakly referenced object keeps a
             # strong reference to weak references of itself and thus to any
             # callbacks registered in those weak references. To be more
             # precise, we don't want the port to have a strong reference to
             # ourselves. -Luci
-            self.ports.add(weakref.ref(port, partial(self._remove_port, weakref.ref(self))))
+            portwr = weakref.ref(port, partial(self._remove_port, weakref.ref(self)))
+            if self._groups is not None:
+                self._groups.add(port, portwr)
+            else:
+                for other in (wr() for wr in self.ports):
+                    if other is None:
+                        continue
+                    if other.producer_slot is not None and port.consumer_slot is not None:
+                        self.mixer.connect_slots(other.producer_slot, port.consumer_slot)
+                    if port.producer_slot is not None and other.consumer_slot is not None:
+                        self.mixer.connect_slots(port.producer_slot, other.consumer_slot)
+            self.ports.add(portwr)
 
     def remove(self, port):
         with self._lock:
@@ -189,27 +297,33 @@ class AudioBridge(object):
                 self.mixer.disconnect_slots(self.demultiplexer.slot, port.consumer_slot)
             if port.producer_slot is not None and self.multiplexer.slot is not None:
                 self.mixer.disconnect_slots(port.producer_slot, self.multiplexer.slot)
-            for other in (wr() for wr in self.ports):
-                if other is None:
-                    continue
-                if other.producer_slot is not None and port.consumer_slot is not None:
-                    self.mixer.disconnect_slots(other.producer_slot, port.consumer_slot)
-                if port.producer_slot is not None and other.consumer_slot is not None:
-                    self.mixer.disconnect_slots(port.producer_slot, other.consumer_slot)
+            if self._groups is not None:
+                self._groups.remove(port)
+            else:
+                for other in (wr() for wr in self.ports):
+                    if other is None:
+                        continue
+                    if other.producer_slot is not None and port.consumer_slot is not None:
+                        self.mixer.disconnect_slots(other.producer_slot, port.consumer_slot)
+                    if port.producer_slot is not None and other.consumer_slot is not None:
+                        self.mixer.disconnect_slots(port.producer_slot, other.consumer_slot)
             self.ports.remove(weakref.ref(port))
 
     def stop(self):
         with self._lock:
-            for port1 in (wr() for wr in self.ports):
-                if port1 is None:
-                    continue
-                for port2 in (wr() for wr in self.ports):
-                    if port2 is None or port2 is port1:
+            if self._groups is not None:
+                self._groups.clear()
+            else:
+                for port1 in (wr() for wr in self.ports):
+                    if port1 is None:
                         continue
-                    if port1.producer_slot is not None and port2.consumer_slot is not None:
-                        self.mixer.disconnect_slots(port1.producer_slot, port2.consumer_slot)
-                    if port2.producer_slot is not None and port1.consumer_slot is not None:
-                        self.mixer.disconnect_slots(port2.producer_slot, port1.consumer_slot)
+                    for port2 in (wr() for wr in self.ports):
+                        if port2 is None or port2 is port1:
+                            continue
+                        if port1.producer_slot is not None and port2.consumer_slot is not None:
+                            self.mixer.disconnect_slots(port1.producer_slot, port2.consumer_slot)
+                        if port2.producer_slot is not None and port1.consumer_slot is not None:
+                            self.mixer.disconnect_slots(port2.producer_slot, port1.consumer_slot)
             self.ports.clear()
             self.multiplexer.stop()
             self.demultiplexer.stop()
@@ -223,25 +337,31 @@ class AudioBridge(object):
                     self.mixer.disconnect_slots(self.demultiplexer.slot, notification.data.old_consumer_slot)
                 if notification.data.new_consumer_slot is not None and self.demultiplexer.slot is not None:
                     self.mixer.connect_slots(self.demultiplexer.slot, notification.data.new_consumer_slot)
-                for other in (wr() for wr in self.ports):
-                    if other is None or other is notification.sender or other.producer_slot is None:
-                        continue
-                    if notification.data.old_consumer_slot is not None:
-                        self.mixer.disconnect_slots(other.producer_slot, notification.data.old_consumer_slot)
-                    if notification.data.new_consumer_slot is not None:
-                        self.mixer.connect_slots(other.producer_slot, notification.data.new_consumer_slot)
+                if self._groups is not None:
+                    self._groups.update_slots(notification.sender, None, None, notification.data.old_consumer_slot, notification.data.new_consumer_slot)
+                else:
+                    for other in (wr() for wr in self.ports):
+                        if other is None or other is notification.sender or other.producer_slot is None:
+                            continue
+                        if notification.data.old_consumer_slot is not None:
+                            self.mixer.disconnect_slots(other.producer_slot, notification.data.old_consumer_slot)
+                        if notification.data.new_consumer_slot is not None:
+                            self.mixer.connect_slots(other.producer_slot, notification.data.new_consumer_slot)
             if notification.data.producer_slot_changed:
                 if notification.data.old_producer_slot is not None and self.multiplexer.slot is not None:
                     self.mixer.disconnect_slots(notification.data.old_producer_slot, self.multiplexer.slot)
                 if notification.data.new_producer_slot is not None and self.multiplexer.slot is not None:
                     self.mixer.connect_slots(notification.data.new_producer_slot, self.multiplexer.slot)
-                for other in (wr() for wr in self.ports):
-                    if other is None or other is notification.sender or other.consumer_slot is None:
-                        continue
-                    if notification.data.old_producer_slot is not None:
-                        self.mixer.disconnect_slots(notification.data.old_producer_slot, other.consumer_slot)
-                    if notification.data.new_producer_slot is not None:
-                        self.mixer.connect_slots(notification.data.new_producer_slot, other.consumer_slot)
+                if self._groups is not None:
+                    self._groups.update_slots(notification.sender, notification.data.old_producer_slot, notification.data.new_producer_slot, None, None)
+                else:
+                    for other in (wr() for wr in self.ports):
+                        if other is None or other is notification.sender or other.consumer_slot is None:
+                            continue
+                        if notification.data.old_producer_slot is not None:
+                            self.mixer.disconnect_slots(notification.data.old_producer_slot, other.consumer_slot)
+                        if notification.data.new_producer_slot is not None:
+                            self.mixer.connect_slots(notification.data.new_producer_slot, other.consumer_slot)
 
     @staticmethod
     def _remove_port(selfwr, portwr):
@@ -249,6 +369,8 @@ class AudioBridge(object):
         if self is not None:
             with self._lock:
                 self.ports.discard(portwr)
+                if self._groups is not None:
+                    self._groups.discard(portwr)
 
 
 class RootAudioBridge(object):
@@ -260,19 +382,25 @@ class RootAudioBridge(object):
     The difference between a RootAudioBridge and an AudioBridge is that the
     RootAudioBridge does not implement the IAudioPort interface. This makes it
     more efficient.
+
+    As with AudioBridge, group_size selects a grouped layout instead of a
+    full-mesh.
     """
 
     implements(IObserver)
 
-    def __init__(self, mixer):
+    def __init__(self, mixer, group_size=None):
         self.mixer = mixer
         self.ports = set()
         self._lock = RLock()
+        self._groups = AudioPortGroups(mixer, group_size) if group_size is not None else None
         notification_center = NotificationCenter()
         notification_center.add_observer(ObserverWeakrefProxy(self), name='AudioPortDidChangeSlots')
 
     def __del__(self):
-        if len(self.ports) >= 2:
+        if self._groups is not None:
+            self._groups.clear()
+        elif len(self.ports) >= 2:
             for port1, port2 in ((wr1(), wr2()) for wr1, wr2 in combinations(self.ports, 2)):
                 if port1 is None or port2 is None:
                     continue
@@ -293,37 +421,50 @@ class RootAudioBridge(object):
                 raise ValueError("expected port with Mixer %r, got %r" % (self.mixer, port.mixer))
             if weakref.ref(port) in self.ports:
                 return
-            for other in (wr() for wr in self.ports):
-                if other is None:
-                    continue
-                if other.producer_slot is not None and port.consumer_slot is not None:
-                    self.mixer.connect_slots(other.producer_slot, port.consumer_slot)
-                if port.producer_slot is not None and other.consumer_slot is not None:
-                    self.mixer.connect_slots(port.producer_slot, other.consumer_slot)
             # This hack is required because a weakly referenced object keeps a
             # strong reference to weak references of itself and thus to any
             # callbacks registered in those weak references. To be more
             # precise, we don't want the port to have a strong reference to
             # ourselves. -Luci
-            self.ports.add(weakref.ref(port, partial(self._remove_port, weakref.ref(self))))
+            portwr = weakref.ref(port, partial(self._remove_port, weakref.ref(self)))
+            if self._groups is not None:
+                self._groups.add(port, portwr)
+            else:
+                for other in (wr() for wr in self.ports):
+                    if other is None:
+                        continue
+                    if other.producer_slot is not None and port.consumer_slot is not None:
+                        self.mixer.connect_slots(other.producer_slot, port.consumer_slot)
+                    if port.producer_slot is not None and other.consumer_slot is not None:
+                        self.mixer.connect_slots(port.producer_slot, other.consumer_slot)
+            self.ports.add(portwr)
 
     def remove(self, port):
         with self._lock:
             if weakref.ref(port) not in self.ports:
                 raise ValueError("port %r is not part of this bridge" % port)
-            for other in (wr() for wr in self.ports):
-                if other is None:
-                    continue
-                if other.producer_slot is not None and port.consumer_slot is not None:
-                    self.mixer.disconnect_slots(other.producer_slot, port.consumer_slot)
-                if port.producer_slot is not None and other.consumer_slot is not None:
-                    self.mixer.disconnect_slots(port.producer_slot, other.consumer_slot)
+            if self._groups is not None:
+                self._groups.remove(port)
+            else:
+                for other in (wr() for wr in self.ports):
+                    if other is None:
+                        continue
+                    if other.producer_slot is not None and port.consumer_slot is not None:
+                        self.mixer.disconnect_slots(other.producer_slot, port.consumer_slot)
+                    if port.producer_slot is not None and other.consumer_slot is not None:
+                        self.mixer.disconnect_slots(port.producer_slot, other.consumer_slot)
             self.ports.remove(weakref.ref(port))
 
     def handle_notification(self, notification):
         with self._lock:
             if weakref.ref(notification.sender) not in self.ports:
                 return
+            if self._groups is not None:
+                if notification.data.consumer_slot_changed:
+                    self._groups.update_slots(notification.sender, None, None, notification.data.old_consumer_slot, notification.data.new_consumer_slot)
+                if notification.data.producer_slot_changed:
+                    self._groups.update_slots(notification.sender, notification.data.old_producer_slot, notification.data.new_producer_slot, None, None)
+                return
             if notification.data.consumer_slot_changed:
                 for other in (wr() for wr in self.ports):
                     if other is None or other is notification.sender or other.producer_slot is None:
@@ -347,13 +488,15 @@ class RootAudioBridge(object):
         if self is not None:
             with self._lock:
                 self.ports.discard(portwr)
+                if self._groups is not None:
+                    self._groups.discard(portwr)
 
 
 class AudioConference(object):
-    def __init__(self):
+    def __init__(self, group_size=None):
         from sipsimple.application import SIPApplication
         mixer = SIPApplication.voice_audio_mixer
-        self.bridge = RootAudioBridge(mixer)
+        self.bridge = RootAudioBridge(mixer, group_size)
         self.device = AudioDevice(mixer)
         self.on_hold = False
         self.streams = []
@@ -389,6 +532,72 @@ class AudioConference(object):
             self.on_hold = False
 
 
+class WaveBufferCache(object):
+    """
+    Keeps the decoded audio of recently played WAV files in memory, so that
+    WavePlayers which loop or play the same prompt don't have to open and
+    decode the file every time. Files are identified by their path and
+    modification time and the least recently used ones are evicted when the
+    cache holds more than audio.wave_cache_size bytes. Files which are larger
+    than that are not cached and are played directly from disk.
+    """
+
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self._lock = RLock()
+        self._buffers = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+        return SIPSimpleSettings().audio.wave_cache_size
+
+    @property
+    def statistics(self):
+        with self._lock:
+            return dict(files=len(self._buffers), size=self.size, hits=self.hits, misses=self.misses)
+
+    def get(self, filename):
+        """Return the WaveBuffer with the contents of the file or None if it should be played from disk"""
+        max_size = self.max_size
+        path = os.path.realpath(filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if stat.st_size > max_size:
+            return None
+        with self._lock:
+            mtime, buffer = self._buffers.pop(path, (None, None))
+            if buffer is not None and mtime == stat.st_mtime:
+                self._buffers[path] = mtime, buffer
+                self.hits += 1
+                return buffer
+            if buffer is not None:
+                self.size -= buffer.size
+            self.misses += 1
+        buffer = WaveBuffer(path)
+        if buffer.size > max_size:
+            return buffer
+        with self._lock:
+            if path in self._buffers:
+                self.size -= self._buffers[path][1].size
+            self._buffers[path] = stat.st_mtime, buffer
+            self.size += buffer.size
+            while self.size > max_size:
+                evicted_path, (evicted_mtime, evicted_buffer) = self._buffers.popitem(last=False)
+                self.size -= evicted_buffer.size
+        return buffer
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+            self.size = 0
+
+
 class WavePlayer(object):
     """
     An object capable of playing a WAV file. It can be used as part of an
@@ -450,7 +659,11 @@ class WavePlayer(object):
             while True:
                 command = self._channel.wait()
                 if command.name == 'play':
-                    self._wave_file = WaveFile(self.mixer, self.filename)
+                    try:
+                        buffer = WaveBufferCache().get(self.filename)
+                    except SIPCoreError:
+                        buffer = None  # opening the file from disk will report the error
+                    self._wave_file = WaveFile(self.mixer, self.filename, buffer)
                     notification_center.add_observer(self, sender=self._wave_file, name='WaveFileDidFinishPlaying')
                     self._wave_file.volume = self.volume
                     try:
@@ -538,3 +751,74 @@ class WaveRecorder(object):
                                                                                                             old_consumer_slot=old_slot, new_consumer_slot=None))
 
 
+class AudioRecorder(object):
+    """
+    An object capable of recording to a WAV or an Opus (in Ogg) file. The
+    audio is handed over to a separate writer thread, so that a slow disk
+    does not block the mixer. If the writer cannot keep up, audio is dropped
+    and an AudioRecorderDidDropFrames notification is posted. Unless given,
+    the format is chosen based on the file extension. It can be used as part
+    of an AudioBridge as it implements the IAudioPort interface.
+    """
+
+    implements(IAudioPort)
+
+    formats = {'.ogg': 'opus', '.oga': 'opus', '.opus': 'opus'}
+
+    def __init__(self, mixer, filename, format=None, bitrate=24000):
+        self.mixer = mixer
+        self.filename = filename
+        self.format = format or self.formats.get(os.path.splitext(filename)[1].lower(), 'wav')
+        self.bitrate = bitrate
+        self.dropped_frames = 0
+        self._recording_file = None
+        self._failed = False
+
+    @property
+    def is_active(self):
+        return bool(self._recording_file and self._recording_file.is_active)
+
+    @property
+    def consumer_slot(self):
+        return self._recording_file.slot if self._recording_file else None
+
+    @property
+    def producer_slot(self):
+        return None
+
+    def start(self):
+        makedirs(os.path.dirname(self.filename))
+        self._recording_file = AsyncRecordingFile(self.mixer, self.filename, self.format, self.bitrate)
+        self._recording_file.start()
+        notification_center = NotificationCenter()
+        notification_center.post_notification('AudioPortDidChangeSlots', sender=self, data=NotificationData(consumer_slot_changed=True, producer_slot_changed=False,
+                                                                                                            old_consumer_slot=None, new_consumer_slot=self._recording_file.slot))
+        self._check_recording_file()
+
+    def stop(self):
+        old_slot = self.consumer_slot
+        recording_file = self._recording_file
+        recording_file.stop()
+        self._recording_file = None
+        notification_center = NotificationCenter()
+        notification_center.post_notification('AudioPortDidChangeSlots', sender=self, data=NotificationData(consumer_slot_changed=True, producer_slot_changed=False,
+                                                                                                            old_consumer_slot=old_slot, new_consumer_slot=None))
+        self._report_status(recording_file)
+
+    @run_in_twisted_thread
+    def _check_recording_file(self):
+        recording_file = self._recording_file
+        if recording_file is not None:
+            self._report_status(recording_file)
+            reactor.callLater(1, self._check_recording_file)
+
+    def _report_status(self, recording_file):
+        notification_center = NotificationCenter()
+        dropped_frames = recording_file.dropped_frames
+        if dropped_frames > self.dropped_frames:
+            notification_center.post_notification('AudioRecorderDidDropFrames', sender=self, data=NotificationData(dropped_frames=dropped_frames-self.dropped_frames, total_dropped_frames=dropped_frames))
+            self.dropped_frames = dropped_frames
+        error = recording_file.error
+        if error is not None and not self._failed:
+            self._failed = True
+            notification_center.post_notification('AudioRecorderDidFail', sender=self, data=NotificationData(error=error))
@@ -29,6 +29,7 @@ class AudioSettings(SettingsGroup):
     sample_rate = Setting(type=SampleRate, default=44100)
     muted = RuntimeSetting(type=bool, default=False)
     silent = Setting(type=bool, default=False)
+    wave_cache_size = Setting(type=NonNegativeInteger, default=16777216)
     echo_canceller = EchoCancellerSettings
 
 
@@ -68,6 +69,8 @@ class LogsSettings(SettingsGroup):
 class RTPSettings(SettingsGroup):
     port_range = Setting(type=PortRange, default=PortRange(50000, 50500))
     timeout = Setting(type=NonNegativeInteger, default=30)
+    transport_pool_size = Setting(type=NonNegativeInteger, default=0)
+    stun_server_ranking_ttl = Setting(type=NonNegativeInteger, default=300)
     audio_codec_list = Setting(type=AudioCodecList, default=AudioCodecList(('opus', 'G722', 'PCMU', 'PCMA')))
     video_codec_list = Setting(type=VideoCodecList, default=VideoCodecList(('H264', 'VP8')))
 
@@ -9,20 +9,42 @@ cdef struct _core_event:
     void *data
     int len
 
+cdef struct _log_record:
+    unsigned int size
+    int level
+    unsigned int len
+
 cdef struct _handler:
     _handler *next
     _handler *prev
+    _handler *obj_next
     int func(object obj) except -1
     void *obj
 
 cdef struct _handler_queue:
     _handler *head
     _handler *tail
+    void *index
+    int count
+
+cdef struct _poll_wakeup_data:
+    pj_sock_t sock
+    pj_sockaddr_in addr
+    pj_ioqueue_key_t *key
+    pj_ioqueue_op_key_t op_key
+    pj_ioqueue_callback callback
+    char buf[16]
+    int pending
 
 # callback functions
 
 cdef void _cb_log(int level, char_ptr_const data, int len):
+    # Lines up to the event level are posted as SIPEngineLog events, the more verbose ones are kept in the log buffer
+    # if there is one and dropped otherwise, without ever reaching Python
     cdef _core_event *event
+    if level > _log_event_level:
+        _log_buffer_add(level, data, len)
+        return
     event = <_core_event *> malloc(sizeof(_core_event))
     if event != NULL:
         event.data = malloc(len)
@@ -37,8 +59,35 @@ cdef void _cb_log(int level, char_ptr_const data, int len):
             free(event.data)
             free(event)
 
+cdef void _cb_poll_wakeup_read(pj_ioqueue_key_t *key, pj_ioqueue_op_key_t *op_key, pj_ssize_t bytes_read) nogil:
+    cdef pj_ssize_t length
+    cdef int status
+    if _poll_wakeup.key == NULL:
+        return
+    _poll_wakeup.pending = 0
+    # drain the socket and leave a read operation pending for the next wakeup
+    while True:
+        length = sizeof(_poll_wakeup.buf)
+        status = pj_ioqueue_recv(_poll_wakeup.key, &_poll_wakeup.op_key, _poll_wakeup.buf, &length, 0)
+        if status != 0:
+            break
+
 # functions
 
+cdef void _log_buffer_add(int level, char_ptr_const data, int len) nogil:
+    cdef _log_record *record
+    cdef size_t size
+    if _log_buffer_lock == NULL or _log_buffer.buf == NULL or len < 0:
+        return
+    size = (sizeof(_log_record) + len + 7) & ~(<size_t> 7)
+    pj_mutex_lock(_log_buffer_lock)
+    record = <_log_record *> _ring_buffer_reserve(&_log_buffer, size)
+    if record != NULL:
+        record.level = level
+        record.len = len
+        memcpy(<char *> record + sizeof(_log_record), data, len)
+    pj_mutex_unlock(_log_buffer_lock)
+
 cdef int _add_event(object event_name, dict params) except -1:
     cdef tuple data
     cdef _core_event *event
@@ -108,12 +157,33 @@ cdef list _get_clear_event_queue():
     return events
 
 cdef int _add_handler(int func(object obj) except -1, object obj, _handler_queue *queue) except -1:
+    # The queue keeps a dict which maps the id of each queued object to the first of its handlers, the handlers of the
+    # same object being chained through obj_next, so that they can be removed without walking the whole queue.
     cdef _handler *handler
+    cdef _handler *first = NULL
+    cdef dict index
+    if queue.index == NULL:
+        index = dict()
+        Py_INCREF(index)
+        queue.index = <void *> index
+    else:
+        index = <dict> queue.index
+    entry = index.get(id(obj))
+    if entry is not None:
+        first = <_handler *> <Py_ssize_t> entry
+        handler = first
+        while handler != NULL:
+            if handler.func == func:
+                # already queued
+                return 0
+            handler = handler.obj_next
     handler = <_handler *> malloc(sizeof(_handler))
     if handler == NULL:
         raise MemoryError()
     handler.func = func
     handler.obj = <void *> obj
+    handler.obj_next = first
+    index[id(obj)] = <Py_ssize_t> handler
     handler.next = NULL
     if queue.head == NULL:
         handler.prev = NULL
@@ -123,27 +193,35 @@ cdef int _add_handler(int func(object obj) except -1, object obj, _handler_queue
         queue.tail.next = handler
         handler.prev = queue.tail
         queue.tail = handler
+    queue.count += 1
+    if queue == &_post_poll_handler_queue:
+        _poll_wakeup_signal()
     return 0
 
 cdef int _remove_handler(object obj, _handler_queue *queue) except -1:
     cdef _handler *handler
     cdef _handler *handler_free
-    handler = queue.head
+    cdef dict index
+    if queue.index == NULL:
+        return 0
+    index = <dict> queue.index
+    entry = index.pop(id(obj), None)
+    if entry is None:
+        return 0
+    handler = <_handler *> <Py_ssize_t> entry
     while handler != NULL:
-        if handler.obj == <void *> obj:
-            if handler.prev != NULL:
-                handler.prev.next = handler.next
-            if handler.next != NULL:
-                handler.next.prev = handler.prev
-            if queue.head == handler:
-                queue.head = handler.next
-            if queue.tail == handler:
-                queue.tail = handler.prev
-            handler_free = handler
-            handler = handler.next
-            free(handler_free)
-        else:
-            handler = handler.next
+        if handler.prev != NULL:
+            handler.prev.next = handler.next
+        if handler.next != NULL:
+            handler.next.prev = handler.prev
+        if queue.head == handler:
+            queue.head = handler.next
+        if queue.tail == handler:
+            queue.tail = handler.prev
+        queue.count -= 1
+        handler_free = handler
+        handler = handler.obj_next
+        free(handler_free)
     return 0
 
 cdef int _process_handler_queue(PJSIPUA ua, _handler_queue *queue) except -1:
@@ -151,6 +229,9 @@ cdef int _process_handler_queue(PJSIPUA ua, _handler_queue *queue) except -1:
     cdef _handler *handler_free
     handler = queue.head
     queue.head = queue.tail = NULL
+    queue.count = 0
+    if queue.index != NULL:
+        (<dict> queue.index).clear()
     while handler != NULL:
         try:
             handler.func(<object> handler.obj)
@@ -161,14 +242,76 @@ cdef int _process_handler_queue(PJSIPUA ua, _handler_queue *queue) except -1:
         free(handler_free)
     return 0
 
+cdef int _poll_wakeup_init(pj_pool_t *pool, pj_ioqueue_t *ioqueue) except -1:
+    # A UDP socket on the loopback interface which is registered with the PJSIP ioqueue, so that other threads can
+    # interrupt the poll loop by sending a datagram to it, instead of waiting for the poll timeout to expire.
+    global _poll_wakeup
+    cdef pj_str_t loopback
+    cdef int addr_len = sizeof(pj_sockaddr_in)
+    cdef int status
+    _str_to_pj_str("127.0.0.1", &loopback)
+    status = pj_sock_socket(pj_AF_INET(), pj_SOCK_DGRAM(), 0, &_poll_wakeup.sock)
+    if status != 0:
+        raise PJSIPError("Could not create poll wakeup socket", status)
+    status = pj_sockaddr_in_init(&_poll_wakeup.addr, &loopback, 0)
+    if status == 0:
+        status = pj_sock_bind(_poll_wakeup.sock, &_poll_wakeup.addr, addr_len)
+    if status == 0:
+        status = pj_sock_getsockname(_poll_wakeup.sock, &_poll_wakeup.addr, &addr_len)
+    if status != 0:
+        pj_sock_close(_poll_wakeup.sock)
+        raise PJSIPError("Could not bind poll wakeup socket", status)
+    _poll_wakeup.callback.on_read_complete = _cb_poll_wakeup_read
+    status = pj_ioqueue_register_sock(pool, ioqueue, _poll_wakeup.sock, NULL, &_poll_wakeup.callback, &_poll_wakeup.key)
+    if status != 0:
+        pj_sock_close(_poll_wakeup.sock)
+        _poll_wakeup.key = NULL
+        raise PJSIPError("Could not register poll wakeup socket", status)
+    pj_ioqueue_op_key_init(&_poll_wakeup.op_key, sizeof(pj_ioqueue_op_key_t))
+    _poll_wakeup.pending = 0
+    _cb_poll_wakeup_read(_poll_wakeup.key, &_poll_wakeup.op_key, 0)
+    return 0
+
+cdef void _poll_wakeup_destroy():
+    global _poll_wakeup, _poll_thread_ident
+    cdef pj_ioqueue_key_t *key = _poll_wakeup.key
+    _poll_wakeup.key = NULL
+    _poll_thread_ident = 0
+    if key != NULL:
+        # this also closes the socket
+        pj_ioqueue_unregister(key)
+
+cdef void _poll_wakeup_signal():
+    # Only needed when called from a thread other than the one running PJSIPUA.poll, which will process the
+    # post-poll handlers and timers anyway once it returns from handling events.
+    cdef pj_ssize_t length = 1
+    if _poll_wakeup.key == NULL or _poll_wakeup.pending or _poll_thread_ident == PyThread_get_thread_ident():
+        return
+    _poll_wakeup.pending = 1
+    with nogil:
+        pj_sock_sendto(_poll_wakeup.sock, "w", &length, 0, &_poll_wakeup.addr, sizeof(pj_sockaddr_in))
+
+
 # globals
 
 cdef pj_mutex_t *_event_queue_lock = NULL
 cdef _core_event *_event_queue_head = NULL
 cdef _core_event *_event_queue_tail = NULL
+cdef pj_mutex_t *_log_buffer_lock = NULL
+cdef _ring_buffer _log_buffer
+memset(&_log_buffer, 0, sizeof(_ring_buffer))
+cdef int _log_event_level = PJ_LOG_MAX_LEVEL
 cdef _handler_queue _post_poll_handler_queue
 _post_poll_handler_queue.head = NULL
 _post_poll_handler_queue.tail = NULL
+_post_poll_handler_queue.index = NULL
+_post_poll_handler_queue.count = 0
 cdef _handler_queue _dealloc_handler_queue
 _dealloc_handler_queue.head = NULL
 _dealloc_handler_queue.tail = NULL
+_dealloc_handler_queue.index = NULL
+_dealloc_handler_queue.count = 0
+cdef _poll_wakeup_data _poll_wakeup
+_poll_wakeup.key = NULL
+_poll_wakeup.pending = 0
+cdef long _poll_thread_ident = 0
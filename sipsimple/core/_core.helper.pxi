@@ -143,7 +143,7 @@ cdef class BaseSIPURI:
             raise TypeError("unorderable types: {0.__class__.__name__}() {2} {1.__class__.__name__}()".format(self, other, operator_map[op]))
 
     def matches(self, address):
-        match = re.match(r'^((?P<scheme>sip|sips):)?(?P<username>.+?)(@(?P<domain>.+?)(:(?P<port>\d+?))?)?(;(?P<parameters>.+?))?(\?(?P<headers>.+?))?$', address)
+        match = _re_sip_uri_address.match(address)
         if match is None:
             return False
         components = match.groupdict()
@@ -188,21 +188,7 @@ cdef class SIPURI(BaseSIPURI):
 
     @classmethod
     def parse(cls, object uri_str):
-        if not isinstance(uri_str, basestring):
-            raise TypeError('a string or unicode is required')
-        cdef bytes uri_bytes = str(uri_str)
-        cdef pjsip_uri *uri = NULL
-        cdef pj_pool_t *pool = NULL
-        cdef pj_str_t tmp
-        cdef char buffer[4096]
-        pool = pj_pool_create_on_buf("SIPURI_parse", buffer, sizeof(buffer))
-        if pool == NULL:
-            raise SIPCoreError("Could not allocate memory pool")
-        pj_strdup2_with_null(pool, &tmp, uri_bytes)
-        uri = pjsip_parse_uri(pool, tmp.ptr, tmp.slen, 0)
-        if uri == NULL:
-            raise SIPCoreError("Not a valid SIP URI: %s" % uri_str)
-        return SIPURI_create(<pjsip_sip_uri *>pjsip_uri_get_uri(uri))
+        return SIPURI.new(_parse_sip_uri(uri_str))
 
 
 cdef class FrozenSIPURI(BaseSIPURI):
@@ -227,6 +213,11 @@ cdef class FrozenSIPURI(BaseSIPURI):
         def __get__(self):
             return self.parameters.get('transport', 'udp')
 
+    def __str__(self):
+        if self._str is None:
+            self._str = BaseSIPURI.__str__(self)
+        return self._str
+
     def __hash__(self):
         return hash((self.user, self.password, self.host, self.port, self.secure, self.parameters, self.headers))
 
@@ -249,21 +240,7 @@ cdef class FrozenSIPURI(BaseSIPURI):
 
     @classmethod
     def parse(cls, object uri_str):
-        if not isinstance(uri_str, basestring):
-            raise TypeError('a string or unicode is required')
-        cdef bytes uri_bytes = str(uri_str)
-        cdef pjsip_uri *uri = NULL
-        cdef pj_pool_t *pool = NULL
-        cdef pj_str_t tmp
-        cdef char buffer[4096]
-        pool = pj_pool_create_on_buf("FrozenSIPURI_parse", buffer, sizeof(buffer))
-        if pool == NULL:
-            raise SIPCoreError("Could not allocate memory pool")
-        pj_strdup2_with_null(pool, &tmp, uri_bytes)
-        uri = pjsip_parse_uri(pool, tmp.ptr, tmp.slen, 0)
-        if uri == NULL:
-            raise SIPCoreError("Not a valid SIP URI: %s" % uri_str)
-        return FrozenSIPURI_create(<pjsip_sip_uri *>pjsip_uri_get_uri(uri))
+        return _parse_sip_uri(uri_str)
 
 
 # Factory functions
@@ -329,9 +306,41 @@ cdef FrozenSIPURI FrozenSIPURI_create(pjsip_sip_uri *uri):
     return FrozenSIPURI(**kwargs)
 
 
+# Helper functions
+#
+
+cdef FrozenSIPURI _parse_sip_uri(object uri_str):
+    # The same URIs (our own account, registrar, proxies) get parsed over and over again, so the most recently parsed
+    # ones are kept in a LRU cache. It holds FrozenSIPURI objects, which can be shared as they are read-only.
+    cdef bytes uri_bytes
+    cdef FrozenSIPURI sip_uri
+    cdef pjsip_uri *uri = NULL
+    cdef pj_pool_t *pool = NULL
+    cdef pj_str_t tmp
+    cdef char buffer[4096]
+    if not isinstance(uri_str, basestring):
+        raise TypeError('a string or unicode is required')
+    uri_bytes = str(uri_str)
+    sip_uri = _sip_uri_cache.get(uri_bytes)
+    if sip_uri is not None:
+        return sip_uri
+    pool = pj_pool_create_on_buf("SIPURI_parse", buffer, sizeof(buffer))
+    if pool == NULL:
+        raise SIPCoreError("Could not allocate memory pool")
+    pj_strdup2_with_null(pool, &tmp, uri_bytes)
+    uri = pjsip_parse_uri(pool, tmp.ptr, tmp.slen, 0)
+    if uri == NULL:
+        raise SIPCoreError("Not a valid SIP URI: %s" % uri_str)
+    sip_uri = FrozenSIPURI_create(<pjsip_sip_uri *>pjsip_uri_get_uri(uri))
+    _sip_uri_cache.set(uri_bytes, sip_uri)
+    return sip_uri
+
+
 # Globals
 #
 
 cdef PJSTR _Credentials_scheme_digest = PJSTR("digest")
+cdef object _re_sip_uri_address = re.compile(r'^((?P<scheme>sip|sips):)?(?P<username>.+?)(@(?P<domain>.+?)(:(?P<port>\d+?))?)?(;(?P<parameters>.+?))?(\?(?P<headers>.+?))?$')
+cdef _LRUCache _sip_uri_cache = _LRUCache(1024)
 
 
@@ -1,7 +1,18 @@
 
+import os
 import sys
 
 
+# C types
+
+cdef struct _udp_transport_info:
+    pjsip_transport *transport
+    unsigned long rx_packets
+    unsigned long rx_bytes
+    unsigned long tx_packets
+    unsigned long tx_bytes
+
+
 # classes
 
 cdef class PJLIB:
@@ -25,8 +36,11 @@ cdef class PJLIB:
 
 
 cdef class PJCachingPool:
-    def __cinit__(self):
-        pj_caching_pool_init(&self._obj, &pj_pool_factory_default_policy, 0)
+    def __cinit__(self, int max_capacity=0):
+        # released pools are kept for reuse, grouped by size, as long as their total capacity is below max_capacity
+        if max_capacity < 0:
+            raise ValueError("max_capacity must be a non-negative number")
+        pj_caching_pool_init(&self._obj, &pj_pool_factory_default_policy, max_capacity)
         self._init_done = 1
 
     def __dealloc__(self):
@@ -36,7 +50,8 @@ cdef class PJCachingPool:
 
 cdef class PJSIPEndpoint:
     def __cinit__(self, PJCachingPool caching_pool, ip_address, udp_port, tcp_port, tls_port,
-                  tls_verify_server, tls_ca_file, tls_cert_file, tls_privkey_file, int tls_timeout):
+                  tls_verify_server, tls_ca_file, tls_cert_file, tls_privkey_file, int tls_timeout,
+                  int async_socket_operations, int udp_sockets):
         cdef pj_dns_resolver *resolver
         cdef pjsip_tpmgr *tpmgr
         cdef int status
@@ -44,6 +59,15 @@ cdef class PJSIPEndpoint:
         if ip_address is not None and not _is_valid_ip(pj_AF_INET(), ip_address):
             raise ValueError("Not a valid IPv4 address: %s" % ip_address)
         self._local_ip_used = ip_address
+        if async_socket_operations < 1:
+            raise ValueError("The number of asynchronous socket operations must be at least 1")
+        self._async_socket_operations = async_socket_operations
+        if udp_sockets < 1:
+            raise ValueError("The number of UDP sockets must be at least 1")
+        IF UNAME_SYSNAME != "Linux":
+            if udp_sockets > 1:
+                raise SIPCoreError("Using more than one UDP socket is not supported on this platform")
+        self._udp_sockets = udp_sockets
 
         status = pjsip_endpt_create(&caching_pool._obj.factory, "core",  &self._obj)
         if status != 0:
@@ -51,6 +75,9 @@ cdef class PJSIPEndpoint:
         self._pool = pjsip_endpt_create_pool(self._obj, "PJSIPEndpoint", 4096, 4096)
         if self._pool == NULL:
             raise SIPCoreError("Could not allocate memory pool")
+        status = pj_mutex_create_simple(self._pool, "udp_transport_lock", &_udp_transport_lock)
+        if status != 0:
+            raise PJSIPError("Could not initialize UDP transport mutex", status)
 
         status = pjsip_tsx_layer_init_module(self._obj)
         if status != 0:
@@ -83,6 +110,18 @@ cdef class PJSIPEndpoint:
         status = pjsip_tpmgr_set_state_cb(tpmgr, _transport_state_cb)
         if status != 0:
             raise PJSIPError("Could not set transport state callback", status)
+        # priority 0 so that outgoing messages have already been printed when it sees them
+        self._transport_stats_module_name = PJSTR("mod-core-transport-stats")
+        self._transport_stats_module.name = self._transport_stats_module_name.pj_str
+        self._transport_stats_module.id = -1
+        self._transport_stats_module.priority = 0
+        self._transport_stats_module.on_rx_request = _cb_transport_stats_rx
+        self._transport_stats_module.on_rx_response = _cb_transport_stats_rx
+        self._transport_stats_module.on_tx_request = _cb_transport_stats_tx
+        self._transport_stats_module.on_tx_response = _cb_transport_stats_tx
+        status = pjsip_endpt_register_module(self._obj, &self._transport_stats_module)
+        if status != 0:
+            raise PJSIPError("Could not load transport statistics module", status)
         if udp_port is not None:
             self._start_udp_transport(udp_port)
         if tcp_port is not None:
@@ -115,22 +154,86 @@ cdef class PJSIPEndpoint:
         return 0
 
     cdef int _start_udp_transport(self, int port) except -1:
+        global _udp_transports
         cdef pj_sockaddr_in local_addr
+        cdef pjsip_transport *transport = NULL
+        cdef pj_sock_t sock
+        cdef int addr_len = sizeof(pj_sockaddr_in)
+        cdef int enable = 1
+        cdef int status
+        cdef int i
         self._make_local_addr(&local_addr, self._local_ip_used, port)
-        status = pjsip_udp_transport_start(self._obj, &local_addr, NULL, 1, &self._udp_transport)
-        if status != 0:
-            raise PJSIPError("Could not create UDP transport", status)
+        _udp_transports = <_udp_transport_info *> malloc(sizeof(_udp_transport_info) * self._udp_sockets)
+        if _udp_transports == NULL:
+            raise MemoryError()
+        try:
+            if self._udp_sockets == 1:
+                status = pjsip_udp_transport_start(self._obj, &local_addr, NULL, self._async_socket_operations, &transport)
+                if status != 0:
+                    raise PJSIPError("Could not create UDP transport", status)
+                self._add_udp_transport(transport)
+            else:
+                # Several sockets are bound to the same port and each one is registered as a separate transport, so
+                # that the kernel spreads the incoming packets among them. PJSIP sends using the last one registered.
+                for i in range(self._udp_sockets):
+                    status = pj_sock_socket(pj_AF_INET(), pj_SOCK_DGRAM(), 0, &sock)
+                    if status != 0:
+                        raise PJSIPError("Could not create UDP socket", status)
+                    IF UNAME_SYSNAME == "Linux":
+                        status = pj_sock_setsockopt(sock, pj_SOL_SOCKET(), SO_REUSEPORT, &enable, sizeof(int))
+                    if status == 0:
+                        status = pj_sock_bind(sock, &local_addr, sizeof(pj_sockaddr_in))
+                    if status == 0 and i == 0:
+                        # the other sockets need to use the port picked for the first one
+                        status = pj_sock_getsockname(sock, &local_addr, &addr_len)
+                    if status != 0:
+                        pj_sock_close(sock)
+                        raise PJSIPError("Could not bind UDP socket", status)
+                    # the socket is closed by PJSIP if this fails
+                    status = pjsip_udp_transport_attach(self._obj, sock, NULL, self._async_socket_operations, &transport)
+                    if status != 0:
+                        raise PJSIPError("Could not create UDP transport", status)
+                    self._add_udp_transport(transport)
+        except:
+            self._stop_udp_transport()
+            raise
+        self._udp_transport = transport
+        return 0
+
+    cdef int _add_udp_transport(self, pjsip_transport *transport) except -1:
+        global _udp_transport_count
+        with nogil:
+            pj_mutex_lock(_udp_transport_lock)
+        memset(&_udp_transports[_udp_transport_count], 0, sizeof(_udp_transport_info))
+        _udp_transports[_udp_transport_count].transport = transport
+        _udp_transport_count += 1
+        with nogil:
+            pj_mutex_unlock(_udp_transport_lock)
         return 0
 
     cdef int _stop_udp_transport(self) except -1:
-        pjsip_transport_shutdown(self._udp_transport)
+        global _udp_transports, _udp_transport_count
+        cdef _udp_transport_info *transports
+        cdef int count
+        cdef int i
+        with nogil:
+            pj_mutex_lock(_udp_transport_lock)
+        transports = _udp_transports
+        count = _udp_transport_count
+        _udp_transports = NULL
+        _udp_transport_count = 0
+        with nogil:
+            pj_mutex_unlock(_udp_transport_lock)
+        for i in range(count):
+            pjsip_transport_shutdown(transports[i].transport)
+        free(transports)
         self._udp_transport = NULL
         return 0
 
     cdef int _start_tcp_transport(self, int port) except -1:
         cdef pj_sockaddr_in local_addr
         self._make_local_addr(&local_addr, self._local_ip_used, port)
-        status = pjsip_tcp_transport_start2(self._obj, &local_addr, NULL, 1, &self._tcp_transport)
+        status = pjsip_tcp_transport_start2(self._obj, &local_addr, NULL, self._async_socket_operations, &self._tcp_transport)
         if status != 0:
             raise PJSIPError("Could not create TCP transport", status)
         return 0
@@ -156,7 +259,7 @@ cdef class PJSIPEndpoint:
             tls_setting.privkey_file = self._tls_privkey_file.pj_str
         tls_setting.method = PJSIP_SSLV23_METHOD
         tls_setting.verify_server = self._tls_verify_server
-        status = pjsip_tls_transport_start(self._obj, &tls_setting, &local_addr, NULL, 1, &self._tls_transport)
+        status = pjsip_tls_transport_start(self._obj, &tls_setting, &local_addr, NULL, self._async_socket_operations, &self._tls_transport)
         if status in (PJSIP_TLS_EUNKNOWN, PJSIP_TLS_EINVMETHOD, PJSIP_TLS_ECACERT, PJSIP_TLS_ECERTFILE, PJSIP_TLS_EKEYFILE, PJSIP_TLS_ECIPHER, PJSIP_TLS_ECTX):
             raise PJSIPTLSError("Could not create TLS transport", status)
         elif status != 0:
@@ -195,16 +298,20 @@ cdef class PJSIPEndpoint:
         return 0
 
     def __dealloc__(self):
+        global _udp_transport_lock
         cdef pjsip_tpmgr *tpmgr
         tpmgr = pjsip_endpt_get_tpmgr(self._obj)
         if tpmgr != NULL:
             pjsip_tpmgr_set_state_cb(tpmgr, NULL)
-        if self._udp_transport != NULL:
+        if _udp_transport_lock != NULL:
             self._stop_udp_transport()
         if self._tcp_transport != NULL:
             self._stop_tcp_transport()
         if self._tls_transport != NULL:
             self._stop_tls_transport()
+        if _udp_transport_lock != NULL:
+            pj_mutex_destroy(_udp_transport_lock)
+            _udp_transport_lock = NULL
         if self._pool != NULL:
             pjsip_endpt_release_pool(self._obj, self._pool)
         if self._obj != NULL:
@@ -213,14 +320,18 @@ cdef class PJSIPEndpoint:
 
 
 cdef class PJMEDIAEndpoint:
-    def __cinit__(self, PJCachingPool caching_pool):
+    def __cinit__(self, PJCachingPool caching_pool, int worker_threads, object thread_affinity):
         cdef int status
-        status = pjmedia_endpt_create(&caching_pool._obj.factory, NULL, 1, &self._obj)
+        if worker_threads < 1:
+            raise ValueError("The number of media threads must be at least 1")
+        status = pjmedia_endpt_create(&caching_pool._obj.factory, NULL, worker_threads, &self._obj)
         if status != 0:
             raise PJSIPError("Could not create PJMEDIA endpoint", status)
         self._pool = pjmedia_endpt_create_pool(self._obj, "PJMEDIAEndpoint", 4096, 4096)
         if self._pool == NULL:
             raise SIPCoreError("Could not allocate memory pool")
+        if thread_affinity is not None:
+            self._set_thread_affinity(list(thread_affinity))
 
         self._audio_subsystem_init(caching_pool)
         self._video_subsystem_init(caching_pool)
@@ -234,6 +345,38 @@ cdef class PJMEDIAEndpoint:
             with nogil:
                 pjmedia_endpt_destroy(self._obj)
 
+    cdef int _set_thread_affinity(self, list thread_affinity) except -1:
+        # The n-th item is the CPU (or a list of CPUs) the n-th media thread is pinned to, None leaves it unpinned
+        IF UNAME_SYSNAME == "Linux":
+            cdef pj_thread_t *thread
+            cdef cpu_set_t cpu_set
+            cdef unsigned int count
+            cdef unsigned int index
+            cdef int status
+            count = pjmedia_endpt_get_thread_count(self._obj)
+            if len(thread_affinity) > count:
+                raise ValueError("Got CPU affinity for %d media threads, but there are only %d" % (len(thread_affinity), count))
+            for index, cpus in enumerate(thread_affinity):
+                if cpus is None:
+                    continue
+                if isinstance(cpus, (int, long)):
+                    cpus = [cpus]
+                CPU_ZERO(&cpu_set)
+                for cpu in cpus:
+                    if cpu < 0:
+                        raise ValueError("Invalid CPU number: %d" % cpu)
+                    CPU_SET(cpu, &cpu_set)
+                thread = pjmedia_endpt_get_thread(self._obj, index)
+                if thread == NULL:
+                    raise SIPCoreError("Could not get media thread %d" % index)
+                status = pthread_setaffinity_np((<pthread_t *> pj_thread_get_os_handle(thread))[0], sizeof(cpu_set_t), &cpu_set)
+                if status != 0:
+                    raise SIPCoreError("Could not set the CPU affinity of media thread %d: %s" % (index, os.strerror(status)))
+        ELSE:
+            if any(cpus is not None for cpus in thread_affinity):
+                raise SIPCoreError("Setting the CPU affinity of media threads is not supported on this platform")
+        return 0
+
     cdef void _audio_subsystem_init(self, PJCachingPool caching_pool):
         cdef int status
         cdef pjmedia_audio_codec_config audio_codec_cfg
@@ -540,8 +683,35 @@ cdef void _transport_state_cb(pjsip_transport *tp, pjsip_transport_state state,
         event_dict['reason'] = _pj_status_to_str(info.status)
         _add_event("SIPEngineTransportDidDisconnect", event_dict)
 
+cdef int _cb_transport_stats_rx(pjsip_rx_data *rdata) nogil:
+    _udp_transport_count_packet(rdata.tp_info.transport, rdata.pkt_info.len, 1)
+    return 0
+
+cdef int _cb_transport_stats_tx(pjsip_tx_data *tdata) nogil:
+    _udp_transport_count_packet(tdata.tp_info.transport, tdata.buf.cur - tdata.buf.start, 0)
+    return 0
+
+cdef void _udp_transport_count_packet(pjsip_transport *transport, long length, int received) nogil:
+    cdef int i
+    if _udp_transport_lock == NULL:
+        return
+    pj_mutex_lock(_udp_transport_lock)
+    for i in range(_udp_transport_count):
+        if _udp_transports[i].transport == transport:
+            if received:
+                _udp_transports[i].rx_packets += 1
+                _udp_transports[i].rx_bytes += length
+            else:
+                _udp_transports[i].tx_packets += 1
+                _udp_transports[i].tx_bytes += length
+            break
+    pj_mutex_unlock(_udp_transport_lock)
+
 
 # globals
+cdef _udp_transport_info *_udp_transports = NULL
+cdef int _udp_transport_count = 0
+cdef pj_mutex_t *_udp_transport_lock = NULL
 cdef PJSTR h264_profile_level_id = PJSTR("profile-level-id")
 cdef PJSTR h264_packetization_mode = PJSTR("packetization-mode")
 cdef dict h264_profiles_map = dict(baseline=66, main=77, high=100)
@@ -61,6 +61,7 @@ cdef class RTPTransport:
                 pjmedia_transport_close(transport)
             self._obj = NULL
             self._wrapped_transport = NULL
+        self._release_rtp_port()
         ua.release_memory_pool(self._pool)
         self._pool = NULL
         if self._lock != NULL:
@@ -83,6 +84,13 @@ cdef class RTPTransport:
             self._pool = NULL
             return None
 
+    cdef int _release_rtp_port(self) except -1:
+        if self._rtp_port_allocator is not None:
+            self._rtp_port_allocator.release(self._rtp_port)
+            self._rtp_port_allocator = None
+            self._rtp_port = 0
+        return 0
+
     cdef void _get_info(self, pjmedia_transport_info *info):
         cdef int status
         cdef pjmedia_transport *transport
@@ -488,7 +496,7 @@ cdef class RTPTransport:
     def set_INIT(self):
         global _ice_cb
         cdef int af
-        cdef int i
+        cdef RTPPortAllocator allocator
         cdef int status
         cdef int port
         cdef pj_caching_pool *caching_pool
@@ -555,17 +563,23 @@ cdef class RTPTransport:
                     if status != 0:
                         raise PJSIPError("Could not create ICE media transport", status)
                 else:
-                    status = PJ_EBUG
-                    for i in xrange(ua._rtp_port_index, ua._rtp_port_index + ua._rtp_port_usable_count, 2):
-                        port = ua._rtp_port_start + i % ua._rtp_port_usable_count
+                    allocator = ua._rtp_port_allocator
+                    while True:
+                        port = allocator.allocate()
+                        if port == -1:
+                            _add_event("SIPEngineRTPPortRangeExhausted", dict(port_range=(allocator.start, allocator.stop)))
+                            raise SIPCoreError("No free ports left in the RTP port range %d-%d" % (allocator.start, allocator.stop))
                         with nogil:
                             status = pjmedia_transport_udp_create3(media_endpoint, af, NULL, local_ip_address,
                                                                    port, 0, transport_address)
-                        if status != PJ_ERRNO_START_SYS + EADDRINUSE:
-                            ua._rtp_port_index = (i + 2) % ua._rtp_port_usable_count
+                        if status == 0:
                             break
-                    if status != 0:
-                        raise PJSIPError("Could not create UDP/RTP media transport", status)
+                        # the port goes into quarantine, if it's used by someone else it may be free by the time it's picked again
+                        allocator.release(port)
+                        if status != PJ_ERRNO_START_SYS + EADDRINUSE:
+                            raise PJSIPError("Could not create UDP/RTP media transport", status)
+                    self._rtp_port_allocator = allocator
+                    self._rtp_port = port
                 self._obj.user_data = <void *> self.weakref
                 if self._encryption is not None:
                     wrapped_transport = self._wrapped_transport = self._obj
@@ -581,6 +595,7 @@ cdef class RTPTransport:
                             with nogil:
                                 pjmedia_transport_close(wrapped_transport)
                             self._wrapped_transport = NULL
+                            self._release_rtp_port()
                             raise PJSIPError("Could not create SRTP media transport", status)
                     elif self._encryption == 'zrtp':
                         with nogil:
@@ -595,6 +610,7 @@ cdef class RTPTransport:
                             with nogil:
                                 pjmedia_transport_close(wrapped_transport)
                             self._wrapped_transport = NULL
+                            self._release_rtp_port()
                             raise PJSIPError("Could not create ZRTP media transport", status)
                     else:
                         raise RuntimeError('invalid SRTP key negotiation specified: %s' % self._encryption)
@@ -1139,7 +1155,6 @@ cdef class AudioTransport:
             cdef int status
             cdef int volume
             cdef pj_mutex_t *lock = self._lock
-            cdef pjmedia_conf *conf_bridge
             cdef PJSIPUA ua
 
             ua = self._check_ua()
@@ -1150,15 +1165,13 @@ cdef class AudioTransport:
                 if status != 0:
                     raise PJSIPError("failed to acquire lock", status)
             try:
-                conf_bridge = self.mixer._obj
                 slot = self._slot
 
                 if value < 0:
                     raise ValueError("volume attribute cannot be negative")
                 if ua is not None and self._obj != NULL:
                     volume = int(value * 1.28 - 128)
-                    with nogil:
-                        status = pjmedia_conf_adjust_rx_level(conf_bridge, slot, volume)
+                    status = self.mixer._adjust_rx_level(slot, volume)
                     if status != 0:
                         raise PJSIPError("Could not set volume of audio transport", status)
                 self._volume = value
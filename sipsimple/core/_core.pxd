@@ -4,17 +4,31 @@ cdef extern from *:
     enum:
         PJ_SVN_REV "PJ_SVN_REVISION"
 
+    # atomic operations (compiler builtins)
+    enum:
+        __ATOMIC_ACQUIRE
+        __ATOMIC_RELEASE
+        __ATOMIC_RELAXED
+    unsigned long __atomic_load_n(unsigned long *ptr, int memorder) nogil
+    void __atomic_store_n(unsigned long *ptr, unsigned long value, int memorder) nogil
+    unsigned long __atomic_add_fetch(unsigned long *ptr, unsigned long value, int memorder) nogil
+
 # system imports
 
-from libc.stdlib cimport malloc, free
-from libc.string cimport memcpy
+from libc.stdint cimport uint32_t, uint64_t
+from libc.errno cimport errno as c_errno
+from libc.stdio cimport FILE, fopen, fwrite, fclose
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memcpy, memcmp, memset
 
 
 # Python C imports
 
 from cpython.float cimport PyFloat_AsDouble
+from cpython.pythread cimport PyThread_get_thread_ident
 from cpython.ref cimport Py_INCREF, Py_DECREF
-from cpython.string cimport PyString_FromString, PyString_FromStringAndSize, PyString_AsString, PyString_Size
+from cpython.buffer cimport PyBuffer_FillInfo
+from cpython.string cimport PyString_FromString, PyString_FromStringAndSize, PyString_AsString, PyString_AS_STRING, PyString_Size
 
 cdef extern from "Python.h":
     object PyUnicode_FromString(const char *u)
@@ -22,6 +36,24 @@ cdef extern from "Python.h":
 
 # PJSIP imports
 
+IF UNAME_SYSNAME == "Linux":
+    # CPU affinity of threads is a glibc extension
+    cdef extern from "sched.h":
+        ctypedef struct cpu_set_t:
+            pass
+        void CPU_ZERO(cpu_set_t *set) nogil
+        void CPU_SET(int cpu, cpu_set_t *set) nogil
+
+    cdef extern from "pthread.h":
+        ctypedef unsigned long pthread_t
+        int pthread_setaffinity_np(pthread_t thread, size_t cpusetsize, cpu_set_t *cpuset) nogil
+
+IF UNAME_SYSNAME == "Linux":
+    # only Linux spreads the packets arriving on a port among the sockets bound to it
+    cdef extern from "sys/socket.h":
+        enum:
+            SO_REUSEPORT
+
 cdef extern from "pjlib.h":
 
     # constants
@@ -29,8 +61,12 @@ cdef extern from "pjlib.h":
         PJ_ERR_MSG_SIZE
     enum:
         PJ_ERRNO_START_SYS
+        PJ_EPENDING
         PJ_EBUG
         PJ_ETOOMANY
+        PJ_ENOMEM
+        PJ_EEOF
+        PJ_EUNKNOWN
     enum:
         PJ_MAX_OBJ_NAME
 
@@ -46,6 +82,7 @@ cdef extern from "pjlib.h":
         char *ptr
         int slen
     ctypedef pj_str_t *pj_str_ptr_const "const pj_str_t *"
+    int pj_stricmp2(pj_str_t *str1, char *str2) nogil
 
     # errors
     pj_str_t pj_strerror(int statcode, char *buf, int bufsize) nogil
@@ -75,10 +112,17 @@ cdef extern from "pjlib.h":
         pass
     struct pj_caching_pool:
         pj_pool_factory factory
+        size_t capacity
+        size_t max_capacity
+        size_t used_count
+        size_t used_size
+        size_t peak_used_size
     void pj_caching_pool_init(pj_caching_pool *ch_pool, pj_pool_factory_policy *policy, int max_capacity) nogil
     void pj_caching_pool_destroy(pj_caching_pool *ch_pool) nogil
     void *pj_pool_alloc(pj_pool_t *pool, int size) nogil
     void pj_pool_reset(pj_pool_t *pool) nogil
+    size_t pj_pool_get_capacity(pj_pool_t *pool) nogil
+    size_t pj_pool_get_used_size(pj_pool_t *pool) nogil
     pj_pool_t *pj_pool_create_on_buf(char *name, void *buf, int size) nogil
     pj_str_t *pj_strdup2_with_null(pj_pool_t *pool, pj_str_t *dst, char *src) nogil
     void pj_pool_release(pj_pool_t *pool) nogil
@@ -102,6 +146,12 @@ cdef extern from "pjlib.h":
     int pj_rwmutex_destroy(pj_rwmutex_t *mutex) nogil
     int pj_thread_is_registered() nogil
     int pj_thread_register(char *thread_name, long *thread_desc, pj_thread_t **thread) nogil
+    int pj_thread_create(pj_pool_t *pool, char *thread_name, int proc(void *arg) nogil, void *arg,
+                         size_t stack_size, unsigned int flags, pj_thread_t **thread) nogil
+    int pj_thread_join(pj_thread_t *thread) nogil
+    int pj_thread_destroy(pj_thread_t *thread) nogil
+    int pj_thread_sleep(unsigned int msec) nogil
+    void *pj_thread_get_os_handle(pj_thread_t *thread) nogil
 
     # sockets
     enum:
@@ -126,6 +176,29 @@ cdef extern from "pjlib.h":
     int pj_sockaddr_has_addr(pj_sockaddr *addr) nogil
     int pj_sockaddr_init(int af, pj_sockaddr *addr, pj_str_t *cp, unsigned int port) nogil
     int pj_inet_pton(int af, pj_str_t *src, void *dst) nogil
+    ctypedef long pj_sock_t
+    ctypedef long pj_ssize_t
+    int pj_SOCK_DGRAM() nogil
+    int pj_sock_socket(int family, int type, int protocol, pj_sock_t *sock) nogil
+    int pj_sock_bind(pj_sock_t sockfd, void *my_addr, int addrlen) nogil
+    int pj_sock_getsockname(pj_sock_t sockfd, void *addr, int *namelen) nogil
+    int pj_sock_sendto(pj_sock_t sockfd, void *buf, pj_ssize_t *len, unsigned int flags, void *to, int tolen) nogil
+    int pj_sock_close(pj_sock_t sockfd) nogil
+    int pj_SOL_SOCKET() nogil
+    int pj_sock_setsockopt(pj_sock_t sockfd, int level, int optname, void *optval, int optlen) nogil
+
+    # ioqueue
+    struct pj_ioqueue_key_t
+    struct pj_ioqueue_op_key_t:
+        pass
+    struct pj_ioqueue_callback:
+        void on_read_complete(pj_ioqueue_key_t *key, pj_ioqueue_op_key_t *op_key, pj_ssize_t bytes_read) nogil
+    int pj_ioqueue_register_sock(pj_pool_t *pool, pj_ioqueue_t *ioque, pj_sock_t sock, void *user_data,
+                                 pj_ioqueue_callback *cb, pj_ioqueue_key_t **key) nogil
+    int pj_ioqueue_unregister(pj_ioqueue_key_t *key) nogil
+    void pj_ioqueue_op_key_init(pj_ioqueue_op_key_t *op_key, size_t size) nogil
+    int pj_ioqueue_recv(pj_ioqueue_key_t *key, pj_ioqueue_op_key_t *op_key, void *buffer, pj_ssize_t *length,
+                        unsigned int flags) nogil
 
     # dns
     struct pj_dns_resolver
@@ -136,6 +209,7 @@ cdef extern from "pjlib.h":
         long sec
         long msec
     void pj_gettimeofday(pj_time_val *tv) nogil
+    int pj_gettickcount(pj_time_val *tv) nogil
     void pj_time_val_normalize(pj_time_val *tv) nogil
 
     # timers
@@ -300,7 +374,11 @@ cdef extern from "pjmedia.h":
         int denum
 
     # frame
+    enum pjmedia_frame_type:
+        PJMEDIA_FRAME_TYPE_NONE
+        PJMEDIA_FRAME_TYPE_AUDIO
     struct pjmedia_frame:
+        pjmedia_frame_type type
         void *buf
         int size
     ctypedef pjmedia_frame *pjmedia_frame_ptr_const "const pjmedia_frame *"
@@ -433,6 +511,8 @@ cdef extern from "pjmedia.h":
     struct pjmedia_endpt
     int pjmedia_endpt_create(pj_pool_factory *pf, pj_ioqueue_t *ioqueue, int worker_cnt, pjmedia_endpt **p_endpt) nogil
     pj_pool_t *pjmedia_endpt_create_pool(pjmedia_endpt *endpt, char *pool_name, int initial, int increment) nogil
+    unsigned int pjmedia_endpt_get_thread_count(pjmedia_endpt *endpt) nogil
+    pj_thread_t *pjmedia_endpt_get_thread(pjmedia_endpt *endpt, unsigned int index) nogil
     int pjmedia_endpt_destroy(pjmedia_endpt *endpt) nogil
     pj_ioqueue_t *pjmedia_endpt_get_ioqueue(pjmedia_endpt *endpt) nogil
     pjmedia_codec_mgr *pjmedia_endpt_get_codec_mgr(pjmedia_endpt *endpt) nogil
@@ -473,6 +553,17 @@ cdef extern from "pjmedia.h":
         pjmedia_format fmt
     struct pjmedia_port:
         pjmedia_port_info info
+        int (*put_frame)(pjmedia_port *this_port, pjmedia_frame *frame) nogil
+        int (*get_frame)(pjmedia_port *this_port, pjmedia_frame *frame) nogil
+    int pjmedia_port_info_init(pjmedia_port_info *info, pj_str_t *name, unsigned int signature, unsigned int clock_rate,
+                               unsigned int channel_count, unsigned int bits_per_sample, unsigned int samples_per_frame) nogil
+    unsigned int PJMEDIA_PIA_SRATE(pjmedia_port_info *pia) nogil
+    unsigned int PJMEDIA_PIA_CCNT(pjmedia_port_info *pia) nogil
+    unsigned int PJMEDIA_PIA_BITS(pjmedia_port_info *pia) nogil
+    unsigned int PJMEDIA_PIA_SPF(pjmedia_port_info *pia) nogil
+    unsigned int PJMEDIA_PIA_AVG_FSZ(pjmedia_port_info *pia) nogil
+    int pjmedia_port_get_frame(pjmedia_port *port, pjmedia_frame *frame) nogil
+    int pjmedia_port_put_frame(pjmedia_port *port, pjmedia_frame *frame) nogil
     struct pjmedia_snd_port
     struct pjmedia_snd_port_param:
         pjmedia_aud_param base
@@ -849,6 +940,15 @@ cdef extern from "pjmedia.h":
                                       int cb(pjmedia_port *port, void *usr_data) with gil) nogil
     int pjmedia_wav_player_port_set_pos(pjmedia_port *port, unsigned int offset) nogil
 
+    # memory player
+    enum:
+        PJMEDIA_MEM_NO_LOOP
+    int pjmedia_mem_player_create(pj_pool_t *pool, void *buffer, size_t size, unsigned int clock_rate,
+                                  unsigned int channel_count, unsigned int samples_per_frame, unsigned int bits_per_sample,
+                                  unsigned int options, pjmedia_port **p_port) nogil
+    int pjmedia_mem_player_set_eof_cb(pjmedia_port *port, void *user_data,
+                                      int cb(pjmedia_port *port, void *usr_data) with gil) nogil
+
     # wav recorder
     enum pjmedia_file_writer_option:
         PJMEDIA_FILE_WRITE_PCM
@@ -857,6 +957,14 @@ cdef extern from "pjmedia.h":
                                        unsigned int bits_per_sample, unsigned int flags, int buff_size,
                                        pjmedia_port **p_port) nogil
 
+    # resampling
+    struct pjmedia_resample
+    int pjmedia_resample_create(pj_pool_t *pool, int high_quality, int large_filter, unsigned int channel_count,
+                                unsigned int rate_in, unsigned int rate_out, unsigned int samples_per_frame,
+                                pjmedia_resample **p_resample) nogil
+    void pjmedia_resample_run(pjmedia_resample *resample, short *input, short *output) nogil
+    void pjmedia_resample_destroy(pjmedia_resample *resample) nogil
+
     # tone generator
     enum:
         PJMEDIA_TONEGEN_MAX_DIGITS
@@ -907,6 +1015,18 @@ cdef extern from "pjmedia-codec.h":
     int pjmedia_codec_vpx_init(pjmedia_vid_codec_mgr *mgr, pj_pool_factory *pf) nogil
     int pjmedia_codec_vpx_deinit() nogil
 
+cdef extern from "opus.h":
+    struct OpusEncoder
+    enum:
+        OPUS_OK
+        OPUS_APPLICATION_VOIP
+        OPUS_SET_BITRATE_REQUEST
+        OPUS_GET_LOOKAHEAD_REQUEST
+    OpusEncoder *opus_encoder_create(int sample_rate, int channels, int application, int *error) nogil
+    int opus_encoder_ctl(OpusEncoder *encoder, int request, ...) nogil
+    int opus_encode(OpusEncoder *encoder, short *pcm, int frame_size, unsigned char *data, int max_data_bytes) nogil
+    void opus_encoder_destroy(OpusEncoder *encoder) nogil
+
 cdef extern from "pjsip.h":
 
     # messages
@@ -1058,6 +1178,8 @@ cdef extern from "pjsip.h":
         char *src_name
         int src_port
     struct pjsip_rx_data_msg_info:
+        char *msg_buf
+        int len
         pjsip_msg *msg
         pjsip_fromto_hdr *from_hdr "from"
         pjsip_fromto_hdr *to_hdr "to"
@@ -1067,6 +1189,7 @@ cdef extern from "pjsip.h":
         pjsip_rx_data_tp_info tp_info
         pjsip_rx_data_msg_info msg_info
     void *pjsip_hdr_clone(pj_pool_t *pool, void *hdr) nogil
+    pjsip_msg *pjsip_msg_clone(pj_pool_t *pool, pjsip_msg *msg) nogil
     void pjsip_msg_add_hdr(pjsip_msg *msg, pjsip_hdr *hdr) nogil
     void *pjsip_msg_find_hdr(pjsip_msg *msg, pjsip_hdr_e type, void *start) nogil
     void *pjsip_msg_find_hdr_by_name(pjsip_msg *msg, pj_str_t *name, void *start) nogil
@@ -1115,7 +1238,9 @@ cdef extern from "pjsip.h":
     pj_pool_t *pjsip_endpt_create_pool(pjsip_endpoint *endpt, char *pool_name, int initial, int increment) nogil
     void pjsip_endpt_release_pool(pjsip_endpoint *endpt, pj_pool_t *pool) nogil
     int pjsip_endpt_handle_events(pjsip_endpoint *endpt, pj_time_val *max_timeout) nogil
+    pj_ioqueue_t *pjsip_endpt_get_ioqueue(pjsip_endpoint *endpt) nogil
     int pjsip_endpt_register_module(pjsip_endpoint *endpt, pjsip_module *module) nogil
+    int pjsip_endpt_unregister_module(pjsip_endpoint *endpt, pjsip_module *module) nogil
     int pjsip_endpt_schedule_timer(pjsip_endpoint *endpt, pj_timer_entry *entry, pj_time_val *delay) nogil
     void pjsip_endpt_cancel_timer(pjsip_endpoint *endpt, pj_timer_entry *entry) nogil
     enum:
@@ -1143,8 +1268,11 @@ cdef extern from "pjsip.h":
     enum pjsip_ssl_method:
         PJSIP_TLSV1_METHOD
         PJSIP_SSLV23_METHOD
+    enum pjsip_transport_flags_e:
+        PJSIP_TRANSPORT_RELIABLE
     struct pjsip_transport:
         char *type_name
+        unsigned int flag
         pj_sockaddr local_addr
         pjsip_host_port local_name
         pjsip_host_port remote_name
@@ -1168,6 +1296,8 @@ cdef extern from "pjsip.h":
     int pjsip_transport_shutdown(pjsip_transport *tp) nogil
     int pjsip_udp_transport_start(pjsip_endpoint *endpt, pj_sockaddr_in *local, pjsip_host_port *a_name,
                                   unsigned int async_cnt, pjsip_transport **p_transport) nogil
+    int pjsip_udp_transport_attach(pjsip_endpoint *endpt, pj_sock_t sock, pjsip_host_port *a_name,
+                                   unsigned int async_cnt, pjsip_transport **p_transport) nogil
     int pjsip_tcp_transport_start2(pjsip_endpoint *endpt, pj_sockaddr_in *local, pjsip_host_port *a_name,
                                    unsigned int async_cnt, pjsip_tpfactory **p_tpfactory) nogil
     int pjsip_tls_transport_start(pjsip_endpoint *endpt, pjsip_tls_setting *opt, pj_sockaddr_in *local,
@@ -1411,6 +1541,30 @@ cdef class PJSTR(object):
     cdef pj_str_t pj_str
     cdef object str
 
+cdef class _LRUCache(object):
+    # attributes
+    cdef object _data
+    cdef object _lock
+    cdef readonly int size
+    cdef readonly unsigned long hits
+    cdef readonly unsigned long misses
+
+    # private methods
+    cdef object get(self, object key)
+    cdef int set(self, object key, object value) except -1
+    cdef int clear(self) except -1
+
+cdef class SIPMessageHeaders(object):
+    # attributes
+    cdef pj_pool_t *_pool
+    cdef pjsip_msg *_msg
+    cdef dict _cache
+    cdef dict _headers
+
+    # private methods
+    cdef object _get_header(self, object name)
+    cdef dict _get_all(self)
+
 # core.lib
 
 cdef class PJLIB(object):
@@ -1427,6 +1581,9 @@ cdef class PJSIPEndpoint(object):
     cdef pjsip_endpoint *_obj
     cdef pj_pool_t *_pool
     cdef pjsip_transport *_udp_transport
+    cdef int _udp_sockets
+    cdef pjsip_module _transport_stats_module
+    cdef PJSTR _transport_stats_module_name
     cdef pjsip_tpfactory *_tcp_transport
     cdef pjsip_tpfactory *_tls_transport
     cdef int _tls_verify_server
@@ -1435,10 +1592,12 @@ cdef class PJSIPEndpoint(object):
     cdef PJSTR _tls_privkey_file
     cdef object _local_ip_used
     cdef int _tls_timeout
+    cdef int _async_socket_operations
 
     # private methods
     cdef int _make_local_addr(self, pj_sockaddr_in *local_addr, object ip_address, int port) except -1
     cdef int _start_udp_transport(self, int port) except -1
+    cdef int _add_udp_transport(self, pjsip_transport *transport) except -1
     cdef int _stop_udp_transport(self) except -1
     cdef int _start_tcp_transport(self, int port) except -1
     cdef int _stop_tcp_transport(self) except -1
@@ -1470,6 +1629,12 @@ cdef class PJMEDIAEndpoint(object):
     cdef void _video_subsystem_shutdown(self)
     cdef void _set_h264_options(self, str profile, int level)
     cdef void _set_video_options(self, tuple max_resolution, int max_framerate, float max_bitrate)
+    cdef int _set_thread_affinity(self, list thread_affinity) except -1
+
+cdef struct _udp_transport_info
+cdef int _cb_transport_stats_rx(pjsip_rx_data *rdata) nogil
+cdef int _cb_transport_stats_tx(pjsip_tx_data *tdata) nogil
+cdef void _udp_transport_count_packet(pjsip_transport *transport, long length, int received) nogil
 
 # core.helper
 
@@ -1516,9 +1681,11 @@ cdef class FrozenSIPURI(BaseSIPURI):
     cdef readonly bint secure
     cdef readonly frozendict parameters
     cdef readonly frozendict headers
+    cdef object _str
 
 cdef SIPURI SIPURI_create(pjsip_sip_uri *base_uri)
 cdef FrozenSIPURI FrozenSIPURI_create(pjsip_sip_uri *base_uri)
+cdef FrozenSIPURI _parse_sip_uri(object uri_str)
 
 # core.headers
 
@@ -1774,12 +1941,20 @@ cdef FrozenReplacesHeader FrozenReplacesHeader_create(pjsip_replaces_hdr *header
 
 # core.util
 
+cdef struct _ring_buffer
+cdef char *_ring_buffer_reserve(_ring_buffer *ring, size_t size) nogil
+cdef char *_ring_buffer_first(_ring_buffer *ring) nogil
+cdef void _ring_buffer_pop(_ring_buffer *ring) nogil
+cdef size_t _ring_buffer_used(_ring_buffer *ring) nogil
 cdef int _str_to_pj_str(object string, pj_str_t *pj_str) except -1
 cdef object _pj_str_to_str(pj_str_t pj_str)
 cdef object _pj_status_to_str(int status)
 cdef object _pj_status_to_def(int status)
 cdef dict _pjsip_param_to_dict(pjsip_param *param_list)
 cdef int _dict_to_pjsip_param(object params, pjsip_param *param_list, pj_pool_t *pool)
+cdef SIPMessageHeaders SIPMessageHeaders_create(pjsip_msg *msg)
+cdef object _pjsip_hdr_to_object(pjsip_hdr *header, object header_name)
+cdef dict _pjsip_msg_headers_to_dict(pjsip_msg *msg)
 cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1
 cdef int _is_valid_ip(int af, object ip) except -1
 cdef int _get_ip_version(object ip) except -1
@@ -1794,7 +1969,10 @@ ctypedef int (*timer_callback)(object, object) except -1 with gil
 cdef class Timer(object):
     # attributes
     cdef int _scheduled
+    cdef unsigned int _generation
     cdef double schedule_time
+    cdef long long _wheel_tick
+    cdef object _wheel_slot
     cdef timer_callback callback
     cdef object obj
 
@@ -1803,6 +1981,42 @@ cdef class Timer(object):
     cdef int cancel(self) except -1
     cdef int call(self) except -1
 
+cdef class TimerWheel(object):
+    # attributes
+    cdef list _levels
+    cdef set _overflow
+    cdef long long _current_tick
+    cdef readonly int count
+    cdef readonly unsigned long long cancelled
+    cdef readonly unsigned long long expired
+
+    # private methods
+    cdef object _get_slot(self, long long tick)
+    cdef int _cascade(self, int level, int index) except -1
+    cdef int _rebuild(self, long long tick, list expired) except -1
+    cdef int add(self, Timer timer) except -1
+    cdef int remove(self, Timer timer) except -1
+    cdef list expire(self, double now)
+    cdef double next_timeout(self, double now, double max_timeout) except -1
+
+cdef class RTPPortAllocator(object):
+    # attributes
+    cdef bytearray _bitmap
+    cdef object _free
+    cdef object _quarantine
+    cdef readonly int start
+    cdef readonly int stop
+    cdef readonly int size
+    cdef readonly double quarantine_time
+    cdef readonly int allocated
+    cdef readonly int peak
+    cdef readonly unsigned long long exhausted
+
+    # private methods
+    cdef int _release_quarantined(self, double now) except -1
+    cdef int allocate(self) except -2
+    cdef int release(self, int port) except -1
+
 cdef class PJSIPThread(object):
     # attributes
     cdef pj_thread_t *_obj
@@ -1812,9 +2026,12 @@ cdef class PJSIPUA(object):
     # attributes
     cdef object _threads
     cdef object _event_handler
-    cdef list _timers
+    cdef TimerWheel _timers
+    cdef object _deferred_timers
     cdef PJLIB _pjlib
     cdef PJCachingPool _caching_pool
+    cdef dict _memory_pools
+    cdef dict _memory_pool_statistics
     cdef PJSIPEndpoint _pjsip_endpoint
     cdef PJMEDIAEndpoint _pjmedia_endpoint
     cdef pjsip_module _module
@@ -1827,23 +2044,21 @@ cdef class PJSIPUA(object):
     cdef PJSTR _ua_tag_module_name
     cdef pjsip_module _event_module
     cdef PJSTR _event_module_name
-    cdef int _trace_sip
     cdef int _detect_sip_loops
     cdef int _enable_colorbar_device
     cdef PJSTR _user_agent
     cdef object _events
     cdef object _sent_messages
     cdef object _ip_address
-    cdef int _rtp_port_start
-    cdef int _rtp_port_count
-    cdef int _rtp_port_usable_count
-    cdef int _rtp_port_index
+    cdef RTPPortAllocator _rtp_port_allocator
+    cdef double _rtp_port_quarantine_time
     cdef pj_stun_config _stun_cfg
     cdef int _fatal_error
     cdef set _incoming_events
     cdef set _incoming_requests
     cdef pj_rwmutex_t *audio_change_rwlock
     cdef pj_mutex_t *video_lock
+    cdef pj_mutex_t *_timer_lock
     cdef list old_devices
     cdef list old_video_devices
     cdef object _zrtp_cache
@@ -1858,8 +2073,18 @@ cdef class PJSIPUA(object):
     cdef int _check_self(self) except -1
     cdef int _check_thread(self) except -1
     cdef int _add_timer(self, Timer timer) except -1
+    cdef int _add_deferred_timer(self, Timer timer) except -1
+    cdef int _process_deferred_timers(self) except -1
+    cdef float _get_poll_timeout(self) except -1
+    cdef list _get_expired_timers(self)
     cdef int _remove_timer(self, Timer timer) except -1
     cdef int _cb_rx_request(self, pjsip_rx_data *rdata) except 0
+    cdef int _set_trace_sip(self, int enabled) except -1
+    cdef int _set_sip_capture_size(self, object size) except -1
+    cdef int _set_log_buffer_size(self, object size) except -1
+    cdef int _set_log_event_level(self, object level) except -1
+    cdef int _update_trace_module(self) except -1
+    cdef int _set_user_agent(self, object user_agent) except -1
 
     cdef pj_pool_t* create_memory_pool(self, bytes name, int initial_size, int resize_size)
     cdef void release_memory_pool(self, pj_pool_t* pool)
@@ -1867,16 +2092,54 @@ cdef class PJSIPUA(object):
 
 cdef int _PJSIPUA_cb_rx_request(pjsip_rx_data *rdata) with gil
 cdef void _cb_detect_nat_type(void *user_data, pj_stun_nat_detect_result_ptr_const res) with gil
-cdef int _cb_opus_fix_tx(pjsip_tx_data *tdata) with gil
-cdef int _cb_trace_rx(pjsip_rx_data *rdata) with gil
-cdef int _cb_trace_tx(pjsip_tx_data *tdata) with gil
-cdef int _cb_add_user_agent_hdr(pjsip_tx_data *tdata) with gil
-cdef int _cb_add_server_hdr(pjsip_tx_data *tdata) with gil
+cdef int _cb_opus_fix_tx(pjsip_tx_data *tdata) nogil
+cdef int _cb_opus_fix_rx(pjsip_rx_data *rdata) nogil
+cdef int _cb_trace_rx(pjsip_rx_data *rdata) nogil
+cdef int _cb_trace_tx(pjsip_tx_data *tdata) nogil
+cdef void _trace_rx_event(pjsip_rx_data *rdata) with gil
+cdef void _trace_tx_event(pjsip_tx_data *tdata) with gil
+cdef int _cb_add_user_agent_hdr(pjsip_tx_data *tdata) nogil
+cdef int _cb_add_server_hdr(pjsip_tx_data *tdata) nogil
+cdef int _add_ua_tag_hdr(pjsip_tx_data *tdata, pj_str_t *name) nogil
+cdef void _ua_tag_error(char *message) with gil
+cdef int _is_sdp_body(pjsip_msg_body *body) nogil
+cdef int _sip_capture_add(pjsip_transport *transport, pj_str_t *src_host, int src_port, pj_str_t *dst_host, int dst_port, char *data, int length) nogil
+cdef int _find_nocase(char *buf, int buf_len, char *needle, int needle_len) nogil
 cdef PJSIPUA _get_ua()
 cdef int deallocate_weakref(object weak_ref, object timer) except -1 with gil
 
 # core.sound
 
+cdef struct _audio_mixer_link
+
+cdef struct _audio_mixer_link_port:
+    pjmedia_port base
+    _audio_mixer_link *link
+
+cdef struct _audio_mixer_link:
+    _audio_mixer_link_port sink
+    _audio_mixer_link_port source
+    int has_frame
+    size_t frame_size
+    char *frame
+
+cdef class _AudioMixerShard(object):
+    # attributes
+    cdef pjmedia_conf *_obj
+    cdef pj_pool_t *_pool
+    cdef unsigned int _link_slot
+    cdef int _used_slot_count
+
+cdef class _AudioMixerLink(object):
+    # attributes
+    cdef _audio_mixer_link *_obj
+    cdef pj_pool_t *_pool
+    cdef int _src_slot
+    cdef int _dst_shard
+    cdef int _sink_slot
+    cdef int _source_slot
+    cdef int _connection_count
+
 cdef class AudioMixer(object):
     # attributes
     cdef int _input_volume
@@ -1890,9 +2153,15 @@ cdef class AudioMixer(object):
     cdef pjmedia_port *_null_port
     cdef pjmedia_snd_port *_snd
     cdef list _connected_slots
+    cdef list _shards
+    cdef dict _links
+    cdef int _bridge_size
+    cdef pjmedia_port *_clock_port
+    cdef unsigned int _clock_slot
     cdef readonly int ec_tail_length
     cdef readonly int sample_rate
     cdef readonly int slot_count
+    cdef readonly int max_shards
     cdef readonly int used_slot_count
     cdef readonly unicode input_device
     cdef readonly unicode output_device
@@ -1905,6 +2174,13 @@ cdef class AudioMixer(object):
     cdef int _add_port(self, PJSIPUA ua, pj_pool_t *pool, pjmedia_port *port) except -1 with gil
     cdef int _remove_port(self, PJSIPUA ua, unsigned int slot) except -1 with gil
     cdef int _cb_postpoll_stop_sound(self, timer) except -1
+    cdef pjmedia_conf *_get_conf_bridge(self, int slot, unsigned int *local_slot) except NULL
+    cdef int _adjust_rx_level(self, int slot, int level) except -1
+    cdef _AudioMixerShard _create_shard(self, PJSIPUA ua)
+    cdef _AudioMixerLink _create_link(self, PJSIPUA ua, int src_slot, int dst_shard)
+    cdef int _destroy_link(self, PJSIPUA ua, _AudioMixerLink link) except -1
+    cdef int _connect(self, PJSIPUA ua, int src_slot, int dst_slot) except -1
+    cdef int _disconnect(self, PJSIPUA ua, int src_slot, int dst_slot) except -1
 
 cdef class ToneGenerator(object):
     # attributes
@@ -1935,6 +2211,69 @@ cdef class RecordingWaveFile(object):
     cdef PJSIPUA _check_ua(self)
     cdef int _stop(self, PJSIPUA ua) except -1
 
+cdef enum _async_recording_format:
+    _ASYNC_RECORDING_WAV
+    _ASYNC_RECORDING_OPUS
+
+cdef struct _async_recording_file:
+    pjmedia_port base
+    int format
+    int status
+    unsigned long running
+    unsigned long write_index
+    unsigned long read_index
+    unsigned long dropped_frames
+    unsigned int ring_frames
+    size_t frame_size
+    char *ring
+    pjmedia_port *wav_port
+    FILE *file
+    OpusEncoder *encoder
+    pjmedia_resample *resample
+    short *resample_buffer
+    unsigned int encoder_frame_samples
+    unsigned char *packet
+    uint64_t granule_position
+    uint64_t page_granule_position
+    uint32_t serial
+    uint32_t page_sequence
+    unsigned int page_packets
+    unsigned int page_segment_count
+    unsigned char page_segments[255]
+    size_t page_body_size
+    unsigned char *page_body
+
+cdef class AsyncRecordingFile(object):
+    # attributes
+    cdef int _slot
+    cdef int _was_started
+    cdef pj_mutex_t *_lock
+    cdef pj_pool_t *_pool
+    cdef pj_thread_t *_thread
+    cdef _async_recording_file *_obj
+    cdef int _status
+    cdef unsigned long _dropped_frames
+    cdef unsigned long _written_frames
+    cdef readonly str filename
+    cdef readonly str format
+    cdef readonly int bitrate
+    cdef readonly double buffer_time
+    cdef readonly AudioMixer mixer
+
+    # private methods
+    cdef PJSIPUA _check_ua(self)
+    cdef int _stop(self, PJSIPUA ua) except -1
+
+cdef class WaveBuffer(object):
+    # attributes
+    cdef char *_data
+    cdef size_t _size
+    cdef unsigned int _clock_rate
+    cdef unsigned int _channel_count
+    cdef unsigned int _samples_per_frame
+    cdef unsigned int _bits_per_sample
+    cdef readonly str filename
+
 cdef class WaveFile(object):
     # attributes
     cdef object __weakref__
@@ -1946,6 +2285,7 @@ cdef class WaveFile(object):
     cdef pjmedia_port *_port
     cdef readonly str filename
     cdef readonly AudioMixer mixer
+    cdef readonly WaveBuffer buffer
 
     # private methods
     cdef PJSIPUA _check_ua(self)
@@ -1965,12 +2305,38 @@ cdef class MixerPort(object):
     cdef int _stop(self, PJSIPUA ua) except -1
 
 cdef int _AudioMixer_dealloc_handler(object obj) except -1
+cdef int _AudioMixerLink_put_frame(pjmedia_port *port, pjmedia_frame *frame) nogil
+cdef int _AsyncRecordingFile_put_frame(pjmedia_port *port, pjmedia_frame *frame) nogil
+cdef int _AsyncRecordingFile_writer(void *arg) nogil
+cdef int _AsyncRecordingFile_write_frame(_async_recording_file *obj, char *data) nogil
+cdef int _AsyncRecordingFile_add_packet(_async_recording_file *obj, unsigned char *data, size_t size) nogil
+cdef int _AsyncRecordingFile_write_page(_async_recording_file *obj, int flags) nogil
+cdef int _AsyncRecordingFile_finish(_async_recording_file *obj) nogil
+cdef uint32_t _ogg_crc(uint32_t crc, unsigned char *data, size_t size) nogil
+cdef int _AudioMixerLink_get_frame(pjmedia_port *port, pjmedia_frame *frame) nogil
 cdef int cb_play_wav_eof(pjmedia_port *port, void *user_data) with gil
 
 # core.video
 
+cdef class VideoFrameBuffer(object):
+    cdef char *buf
+    cdef size_t capacity
+    cdef size_t size
+
+cdef class VideoFrameBufferPool(object):
+    cdef list _free
+    cdef readonly int max_size
+    cdef readonly unsigned long long allocated
+    cdef readonly unsigned long long reused
+
+    cdef VideoFrameBuffer get(self, size_t size)
+    cdef int put(self, VideoFrameBuffer buffer) except -1
+
 cdef class VideoFrame(object):
-    cdef readonly str data
+    cdef str _data
+    cdef VideoFrameBuffer _buffer
+    cdef VideoFrameBufferPool _pool
+    cdef int _exports
     cdef readonly int width
     cdef readonly int height
 
@@ -2008,9 +2374,22 @@ cdef class VideoCamera(VideoProducer):
     cdef void _start(self)
     cdef void _stop(self)
 
+cdef struct _frame_buffer_renderer_info:
+    void *weakref
+    unsigned int min_interval
+    unsigned long long next_frame
+    unsigned int max_width
+    unsigned int max_height
+    char *scale_buffer
+    size_t scale_buffer_size
+    unsigned long long received
+    unsigned long long delivered
+
 cdef class FrameBufferVideoRenderer(VideoConsumer):
+    cdef _frame_buffer_renderer_info *_info
     cdef pjmedia_vid_dev_stream *_video_stream
     cdef object _frame_handler
+    cdef VideoFrameBufferPool _frame_pool
 
     cdef _initialize(self, VideoProducer producer)
     cdef void _destroy_video_port(self)
@@ -2028,6 +2407,10 @@ cdef class RemoteVideoStream(VideoProducer):
 
 cdef LocalVideoStream_create(pjmedia_vid_stream *stream)
 cdef RemoteVideoStream_create(pjmedia_vid_stream *stream, format_change_handler=*)
+cdef VideoFrame VideoFrame_create(VideoFrameBufferPool pool, char *buf, size_t size, int width, int height)
+cdef void _scale_video_frame(uint32_t *src, unsigned int src_width, unsigned int src_height, uint32_t *dst, unsigned int dst_width, unsigned int dst_height) nogil
+cdef void FrameBufferVideoRenderer_frame_handler(pjmedia_frame_ptr_const frame, pjmedia_rect_size size, void *user_data) nogil
+cdef void _FrameBufferVideoRenderer_deliver_frame(void *weakref, char *buf, size_t size, int width, int height) with gil
 cdef int RemoteVideoStream_on_event(pjmedia_event *event, void *user_data) with gil
 cdef void _start_video_port(pjmedia_vid_port *port)
 cdef void _stop_video_port(pjmedia_vid_port *port)
@@ -2038,11 +2421,16 @@ cdef struct _core_event
 cdef struct _handler_queue
 cdef int _event_queue_append(_core_event *event)
 cdef void _cb_log(int level, char_ptr_const data, int len)
+cdef void _log_buffer_add(int level, char_ptr_const data, int len) nogil
 cdef int _add_event(object event_name, dict params) except -1
 cdef list _get_clear_event_queue()
 cdef int _add_handler(int func(object obj) except -1, object obj, _handler_queue *queue) except -1
 cdef int _remove_handler(object obj, _handler_queue *queue) except -1
 cdef int _process_handler_queue(PJSIPUA ua, _handler_queue *queue) except -1
+cdef int _poll_wakeup_init(pj_pool_t *pool, pj_ioqueue_t *ioqueue) except -1
+cdef void _poll_wakeup_destroy()
+cdef void _poll_wakeup_signal()
+cdef void _cb_poll_wakeup_read(pj_ioqueue_key_t *key, pj_ioqueue_op_key_t *op_key, pj_ssize_t bytes_read) nogil
 
 # core.request
 
@@ -2321,6 +2709,7 @@ cdef class FrozenSDPSession(BaseSDPSession):
     cdef readonly FrozenSDPAttributeList attributes
     cdef readonly FrozenSDPBandwidthInfoList bandwidth_info
     cdef readonly frozenlist media
+    cdef object _str
 
 cdef class BaseSDPMediaStream(object):
     # attributes
@@ -2394,6 +2783,8 @@ cdef class FrozenSDPBandwidthInfo(BaseSDPBandwidthInfo):
     cdef readonly int value
 
 cdef SDPSession SDPSession_create(pjmedia_sdp_session_ptr_const pj_session)
+cdef int _sdp_session_is_printable(BaseSDPSession sdp_session) except -1
+cdef object _sdp_session_cache_key(pjmedia_sdp_session_ptr_const pj_session)
 cdef FrozenSDPSession FrozenSDPSession_create(pjmedia_sdp_session_ptr_const pj_session)
 cdef SDPMediaStream SDPMediaStream_create(pjmedia_sdp_media *pj_media)
 cdef FrozenSDPMediaStream FrozenSDPMediaStream_create(pjmedia_sdp_media *pj_media)
@@ -2542,6 +2933,8 @@ cdef class RTPTransport(object):
     cdef pj_pool_t *_pool
     cdef pjmedia_transport *_obj
     cdef pjmedia_transport *_wrapped_transport
+    cdef RTPPortAllocator _rtp_port_allocator
+    cdef int _rtp_port
     cdef ICECheck _rtp_valid_pair
     cdef str _encryption
     cdef readonly object ice_stun_address
@@ -2554,6 +2947,7 @@ cdef class RTPTransport(object):
     cdef void _get_info(self, pjmedia_transport_info *info)
     cdef int _init_local_sdp(self, BaseSDPSession local_sdp, BaseSDPSession remote_sdp, int sdp_index)
     cdef int _ice_active(self)
+    cdef int _release_rtp_port(self) except -1
 
 cdef class MediaCheckTimer(Timer):
     # attributes
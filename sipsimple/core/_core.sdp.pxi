@@ -331,20 +331,43 @@ cdef class FrozenSDPSession(BaseSDPSession):
 
     @classmethod
     def new(cls, BaseSDPSession sdp_session):
+        cdef FrozenSDPSession session
+        cdef object key = None
         if isinstance(sdp_session, FrozenSDPSession):
             return sdp_session
+        # the outgoing SDP is built again for every offer and answer, but it is usually the same as the previous one.
+        # The key is computed from the current content, so changes made to sdp_session need no invalidation.
+        if cls is FrozenSDPSession and _sdp_session_is_printable(sdp_session):
+            key = _sdp_session_cache_key(sdp_session.get_sdp_session())
+            if key is not None:
+                session = _sdp_session_cache.get(key)
+                if session is not None:
+                    return session
         connection = FrozenSDPConnection.new(sdp_session.connection) if (sdp_session.connection is not None) else None
         attributes = frozenlist([FrozenSDPAttribute.new(attr) for attr in sdp_session.attributes])
         bandwidth_info = frozenlist([FrozenSDPBandwidthInfo.new(info) for info in sdp_session.bandwidth_info])
         media = frozenlist([FrozenSDPMediaStream.new(m) for m in sdp_session.media])
-        return cls(sdp_session.address, sdp_session.id, sdp_session.version, sdp_session.user, sdp_session.net_type, sdp_session.address_type, sdp_session.name,
-                   connection, sdp_session.start_time, sdp_session.stop_time, attributes, bandwidth_info, media)
+        session = cls(sdp_session.address, sdp_session.id, sdp_session.version, sdp_session.user, sdp_session.net_type, sdp_session.address_type, sdp_session.name,
+                      connection, sdp_session.start_time, sdp_session.stop_time, attributes, bandwidth_info, media)
+        if key is not None:
+            _sdp_session_cache.set(key, session)
+        return session
 
     @classmethod
     def parse(cls, str sdp):
         cdef pjmedia_sdp_session *sdp_session
-        sdp_session = _parse_sdp_session(sdp)
-        return FrozenSDPSession_create(sdp_session)
+        cdef FrozenSDPSession session
+        session = _sdp_session_cache.get(sdp)
+        if session is None:
+            sdp_session = _parse_sdp_session(sdp)
+            session = FrozenSDPSession_create(sdp_session)
+            _sdp_session_cache.set(sdp, session)
+        return session
+
+    def __str__(self):
+        if self._str is None:
+            self._str = BaseSDPSession.__str__(self)
+        return self._str
 
     def __hash__(self):
         return hash((self.address, self.id, self.version, self.user, self.net_type, self.address_type, self.name, self.connection, self.start_time, self.stop_time, self.attributes, self.bandwidth_info, self.media))
@@ -448,6 +471,9 @@ cdef class BaseSDPMediaStream:
             return 'candidate' in self.attributes
 
     cdef pjmedia_sdp_media* get_sdp_media(self):
+        self._sdp_media.desc.fmt_count = len(self.formats)
+        for index, format in enumerate(self.formats):
+            _str_to_pj_str(format, &self._sdp_media.desc.fmt[index])
         self._sdp_media.attr_count = len(self.attributes)
         for index, attr in enumerate(self.attributes):
             self._sdp_media.attr[index] = (<BaseSDPAttribute>attr).get_sdp_attribute()
@@ -981,12 +1007,40 @@ cdef SDPSession SDPSession_create(pjmedia_sdp_session_ptr_const pj_session):
                        [SDPBandwidthInfo_create(pj_session.bandw[i]) for i in range(pj_session.bandw_count)],
                        [SDPMediaStream_create(pj_session.media[i]) if pj_session.media[i] != NULL else None for i in range(pj_session.media_count)])
 
+cdef int _sdp_session_is_printable(BaseSDPSession sdp_session) except -1:
+    # The lists of a mutable session can be changed in place, bypassing the checks done when they are set, so check
+    # that they still fit in the PJMEDIA structures before these are brought up to date
+    cdef BaseSDPMediaStream media
+    if len(sdp_session.attributes) > PJMEDIA_MAX_SDP_ATTR or len(sdp_session.bandwidth_info) > PJMEDIA_MAX_SDP_BANDW or len(sdp_session.media) > PJMEDIA_MAX_SDP_MEDIA:
+        return 0
+    for media in sdp_session.media:
+        if media is None or len(media.formats) > PJMEDIA_MAX_SDP_FMT or len(media.attributes) > PJMEDIA_MAX_SDP_ATTR or len(media.bandwidth_info) > PJMEDIA_MAX_SDP_BANDW:
+            return 0
+    return 1
+
+cdef object _sdp_session_cache_key(pjmedia_sdp_session_ptr_const pj_session):
+    # Re-INVITEs and session refreshes usually carry the same SDP again, so the frozen sessions are cached using their
+    # printed form as the key, which is much cheaper to obtain than building the Python objects
+    cdef char cbuf[4096]
+    cdef int buf_len
+    buf_len = pjmedia_sdp_print(pj_session, cbuf, sizeof(cbuf))
+    if buf_len > -1:
+        return PyString_FromStringAndSize(cbuf, buf_len)
+    return None
+
 cdef FrozenSDPSession FrozenSDPSession_create(pjmedia_sdp_session_ptr_const pj_session):
     cdef FrozenSDPConnection connection = None
+    cdef FrozenSDPSession session
+    cdef object key
     cdef int i
+    key = _sdp_session_cache_key(pj_session)
+    if key is not None:
+        session = _sdp_session_cache.get(key)
+        if session is not None:
+            return session
     if pj_session.conn != NULL:
         connection = FrozenSDPConnection_create(pj_session.conn)
-    return FrozenSDPSession(_pj_str_to_str(pj_session.origin.addr),
+    session = FrozenSDPSession(_pj_str_to_str(pj_session.origin.addr),
                             pj_session.origin.id,
                             pj_session.origin.version,
                             _pj_str_to_str(pj_session.origin.user),
@@ -999,6 +1053,9 @@ cdef FrozenSDPSession FrozenSDPSession_create(pjmedia_sdp_session_ptr_const pj_s
                             frozenlist([FrozenSDPAttribute_create(pj_session.attr[i]) for i in range(pj_session.attr_count)]),
                             frozenlist([FrozenSDPBandwidthInfo_create(pj_session.bandw[i]) for i in range(pj_session.bandw_count)]),
                             frozenlist([FrozenSDPMediaStream_create(pj_session.media[i]) if pj_session.media[i] != NULL else None for i in range(pj_session.media_count)]))
+    if key is not None:
+        _sdp_session_cache.set(key, session)
+    return session
 
 cdef SDPMediaStream SDPMediaStream_create(pjmedia_sdp_media *pj_media):
     cdef SDPConnection connection = None
@@ -1225,3 +1282,8 @@ cdef class SDPNegotiator:
         if status != 0:
             raise PJSIPError("SDP negotiation failed", status)
 
+
+# Globals
+#
+
+cdef _LRUCache _sdp_session_cache = _LRUCache(256)
@@ -1,13 +1,59 @@
 
+import random
+import struct
 import sys
 
 
+# An AudioMixer is made of one or more pjmedia conference bridges (shards). The first one holds the sound device and
+# drives the others: the master port of each additional bridge is added to it and read on every tick. Slot numbers are
+# global, the slots of the n-th bridge start at n * bridge size. Audio going from a slot to one in another bridge goes
+# through a link, a pair of ports sharing a frame buffer, which carries the audio of that source slot only.
+
+cdef unsigned int _AUDIO_MIXER_LINK_SIGNATURE = 0x4b4e4c4d
+
+# An AsyncRecordingFile receives the frames from the mixer clock thread into a single producer / single consumer ring
+# buffer and a writer thread takes them from there, encodes them and writes them to disk, so that a slow disk never
+# blocks the mixer. Frames are dropped when the ring buffer is full. Opus recordings are stored in an Ogg container.
+
+cdef unsigned int _ASYNC_RECORDING_FILE_SIGNATURE = 0x46434552
+cdef enum:
+    _OPUS_MAX_PACKET_SIZE = 1500
+    _OGG_PAGE_MAX_PACKETS = 50
+    _OGG_PAGE_BOS = 0x02
+    _OGG_PAGE_EOS = 0x04
+cdef uint32_t _ogg_crc_table[256]
+
+def _init_ogg_crc_table():
+    cdef uint32_t value
+    cdef int i, j
+    for i in range(256):
+        value = i << 24
+        for j in range(8):
+            if value & 0x80000000:
+                value = (value << 1) ^ 0x04c11db7
+            else:
+                value <<= 1
+        _ogg_crc_table[i] = value
+_init_ogg_crc_table()
+del _init_ogg_crc_table
+
+
+cdef class _AudioMixerShard:
+    pass
+
+
+cdef class _AudioMixerLink:
+    pass
+
+
 cdef class AudioMixer:
 
     def __cinit__(self, *args, **kwargs):
         cdef int status
 
         self._connected_slots = list()
+        self._shards = list()
+        self._links = dict()
         self._input_volume = 100
         self._output_volume = 100
 
@@ -15,9 +61,10 @@ cdef class AudioMixer:
         if status != 0:
             raise PJSIPError("failed to create lock", status)
 
-    def __init__(self, unicode input_device, unicode output_device, int sample_rate, int ec_tail_length, int slot_count=254):
+    def __init__(self, unicode input_device, unicode output_device, int sample_rate, int ec_tail_length, int slot_count=254, int max_shards=1):
         global _dealloc_handler_queue
         cdef int status
+        cdef int bridge_size
         cdef pj_pool_t *conf_pool
         cdef pj_pool_t *snd_pool
         cdef pjmedia_conf **conf_bridge_address
@@ -37,8 +84,19 @@ cdef class AudioMixer:
             raise ValueError("sample_rate argument should be a non-negative integer")
         if sample_rate % 50:
             raise ValueError("sample_rate argument should be dividable by 50")
+        if max_shards < 1:
+            raise ValueError("max_shards argument should be at least 1")
         self.sample_rate = sample_rate
         self.slot_count = slot_count
+        self.max_shards = max_shards
+        if max_shards == 1:
+            bridge_size = slot_count + 1
+        else:
+            # next to slot 0 and its slot_count ports, a bridge must have room for the worst case number of links: a sink
+            # port for each of its slots towards each other bridge and a source port for each slot of the other bridges.
+            # The first bridge also holds the clock port and the master ports of the other bridges.
+            bridge_size = 1 + slot_count + 2*slot_count*(max_shards-1) + max_shards
+        self._bridge_size = bridge_size
 
         conf_pool_name = b"AudioMixer_%d" % id(self)
         conf_pool = ua.create_memory_pool(conf_pool_name, 4096, 4096)
@@ -47,10 +105,14 @@ cdef class AudioMixer:
         snd_pool = ua.create_memory_pool(snd_pool_name, 4096, 4096)
         self._snd_pool = snd_pool
         with nogil:
-            status = pjmedia_conf_create(conf_pool, slot_count+1, sample_rate, 1,
+            status = pjmedia_conf_create(conf_pool, bridge_size, sample_rate, 1,
                                          sample_rate / 50, 16, PJMEDIA_CONF_NO_DEVICE, conf_bridge_address)
         if status != 0:
             raise PJSIPError("Could not create audio mixer", status)
+        shard = _AudioMixerShard()
+        shard._obj = self._obj
+        shard._pool = conf_pool
+        self._shards.append(shard)
         with nogil:
             status = pjmedia_null_port_create(conf_pool, sample_rate, 1,
                                               sample_rate / 50, 16, null_port_address)
@@ -184,6 +246,11 @@ cdef class AudioMixer:
         def __get__(self):
             return sorted(self._connected_slots)
 
+    property shard_count:
+
+        def __get__(self):
+            return len(self._shards)
+
     # public methods
 
     def set_sound_devices(self, unicode input_device, unicode output_device, int ec_tail_length):
@@ -211,7 +278,6 @@ cdef class AudioMixer:
     def connect_slots(self, int src_slot, int dst_slot):
         cdef int status
         cdef pj_mutex_t *lock = self._lock
-        cdef pjmedia_conf *conf_bridge
         cdef tuple connection
         cdef PJSIPUA ua
 
@@ -222,8 +288,6 @@ cdef class AudioMixer:
         if status != 0:
             raise PJSIPError("failed to acquire lock", status)
         try:
-            conf_bridge = self._obj
-
             if src_slot < 0:
                 raise ValueError("src_slot argument cannot be negative")
             if dst_slot < 0:
@@ -231,10 +295,7 @@ cdef class AudioMixer:
             connection = (src_slot, dst_slot)
             if connection in self._connected_slots:
                 return
-            with nogil:
-                status = pjmedia_conf_connect_port(conf_bridge, src_slot, dst_slot, 0)
-            if status != 0:
-                raise PJSIPError("Could not connect slots on audio mixer", status)
+            self._connect(ua, src_slot, dst_slot)
             self._connected_slots.append(connection)
         finally:
             with nogil:
@@ -243,7 +304,6 @@ cdef class AudioMixer:
     def disconnect_slots(self, int src_slot, int dst_slot):
         cdef int status
         cdef pj_mutex_t *lock = self._lock
-        cdef pjmedia_conf *conf_bridge
         cdef tuple connection
         cdef PJSIPUA ua
 
@@ -254,8 +314,6 @@ cdef class AudioMixer:
         if status != 0:
             raise PJSIPError("failed to acquire lock", status)
         try:
-            conf_bridge = self._obj
-
             if src_slot < 0:
                 raise ValueError("src_slot argument cannot be negative")
             if dst_slot < 0:
@@ -263,10 +321,7 @@ cdef class AudioMixer:
             connection = (src_slot, dst_slot)
             if connection not in self._connected_slots:
                 return
-            with nogil:
-                status = pjmedia_conf_disconnect_port(conf_bridge, src_slot, dst_slot)
-            if status != 0:
-                raise PJSIPError("Could not disconnect slots on audio mixer", status)
+            self._disconnect(ua, src_slot, dst_slot)
             self._connected_slots.remove(connection)
         finally:
             with nogil:
@@ -452,45 +507,62 @@ cdef class AudioMixer:
         cdef int status
         cdef pj_mutex_t *lock = self._lock
         cdef pjmedia_conf* conf_bridge
+        cdef _AudioMixerShard shard
 
         with nogil:
             status = pj_mutex_lock(lock)
         if status != 0:
             raise PJSIPError("failed to acquire lock", status)
         try:
-            conf_bridge = self._obj
+            for shard in self._shards:
+                if shard._used_slot_count < self.slot_count:
+                    break
+            else:
+                if len(self._shards) == self.max_shards:
+                    raise PJSIPError("Could not add audio object to audio mixer", PJ_ETOOMANY)
+                shard = self._create_shard(ua)
+            conf_bridge = shard._obj
 
             with nogil:
                 status = pjmedia_conf_add_port(conf_bridge, pool, port, NULL, &slot)
             if status != 0:
                 raise PJSIPError("Could not add audio object to audio mixer", status)
+            shard._used_slot_count += 1
             self.used_slot_count += 1
             if self.used_slot_count == 1 and not (self.input_device is None and self.output_device is None) and self._snd == NULL:
                 self._start_sound_device(ua, self.input_device, self.output_device, self.ec_tail_length)
-            return slot
+            return self._shards.index(shard) * self._bridge_size + slot
         finally:
             with nogil:
                 pj_mutex_unlock(lock)
 
     cdef int _remove_port(self, PJSIPUA ua, unsigned int slot) except -1 with gil:
         cdef int status
+        cdef unsigned int local_slot
         cdef pj_mutex_t *lock = self._lock
         cdef pjmedia_conf* conf_bridge
         cdef tuple connection
         cdef Timer timer
+        cdef _AudioMixerShard shard
 
         with nogil:
             status = pj_mutex_lock(lock)
         if status != 0:
             raise PJSIPError("failed to acquire lock", status)
         try:
-            conf_bridge = self._obj
+            conf_bridge = self._get_conf_bridge(slot, &local_slot)
+            shard = self._shards[slot // self._bridge_size]
 
+            # the bridge drops the connections of the port, but the links to other bridges need to be released
+            for connection in self._connected_slots:
+                if slot in connection and connection[0] // self._bridge_size != connection[1] // self._bridge_size:
+                    self._disconnect(ua, connection[0], connection[1])
             with nogil:
-                status = pjmedia_conf_remove_port(conf_bridge, slot)
+                status = pjmedia_conf_remove_port(conf_bridge, local_slot)
             if status != 0:
                 raise PJSIPError("Could not remove audio object from audio mixer", status)
             self._connected_slots = [connection for connection in self._connected_slots if slot not in connection]
+            shard._used_slot_count -= 1
             self.used_slot_count -= 1
             if self.used_slot_count == 0 and not (self.input_device is None and self.output_device is None):
                 timer = Timer()
@@ -518,11 +590,217 @@ cdef class AudioMixer:
             with nogil:
                 pj_mutex_unlock(lock)
 
+    cdef pjmedia_conf *_get_conf_bridge(self, int slot, unsigned int *local_slot) except NULL:
+        cdef _AudioMixerShard shard
+        if slot < 0 or slot // self._bridge_size >= len(self._shards):
+            raise ValueError("Invalid audio mixer slot: %d" % slot)
+        shard = self._shards[slot // self._bridge_size]
+        local_slot[0] = slot % self._bridge_size
+        return shard._obj
+
+    cdef int _adjust_rx_level(self, int slot, int level) except -1:
+        cdef int status
+        cdef unsigned int local_slot
+        cdef pjmedia_conf *conf_bridge
+
+        conf_bridge = self._get_conf_bridge(slot, &local_slot)
+        with nogil:
+            status = pjmedia_conf_adjust_rx_level(conf_bridge, local_slot, level)
+        return status
+
+    cdef _AudioMixerShard _create_shard(self, PJSIPUA ua):
+        # No need to hold the lock, this function is always called with it held
+        cdef int status
+        cdef int bridge_size = self._bridge_size
+        cdef int sample_rate = self.sample_rate
+        cdef unsigned int slot
+        cdef pj_pool_t *pool
+        cdef pjmedia_conf *main_bridge = self._obj
+        cdef pjmedia_conf *conf_bridge
+        cdef pjmedia_port **clock_port_address = &self._clock_port
+        cdef bytes pool_name
+        cdef _AudioMixerShard shard
+
+        if self._clock_port == NULL:
+            # reading the additional bridges into a null port on every tick of the main one is what drives them
+            pool = self._conf_pool
+            with nogil:
+                status = pjmedia_null_port_create(pool, sample_rate, 1, sample_rate / 50, 16, clock_port_address)
+            if status != 0:
+                raise PJSIPError("Could not create null audio port", status)
+            with nogil:
+                status = pjmedia_conf_add_port(main_bridge, pool, clock_port_address[0], NULL, &slot)
+            if status != 0:
+                with nogil:
+                    pjmedia_port_destroy(clock_port_address[0])
+                self._clock_port = NULL
+                raise PJSIPError("Could not add null audio port to audio mixer", status)
+            self._clock_slot = slot
+
+        pool_name = b"AudioMixer_shard_%d_%d" % (id(self), len(self._shards))
+        pool = ua.create_memory_pool(pool_name, 4096, 4096)
+        shard = _AudioMixerShard()
+        shard._pool = pool
+        with nogil:
+            status = pjmedia_conf_create(pool, bridge_size, sample_rate, 1, sample_rate / 50, 16, PJMEDIA_CONF_NO_DEVICE, &conf_bridge)
+        if status != 0:
+            ua.release_memory_pool(pool)
+            raise PJSIPError("Could not create audio mixer", status)
+        with nogil:
+            status = pjmedia_conf_add_port(main_bridge, pool, pjmedia_conf_get_master_port(conf_bridge), NULL, &slot)
+            if status == 0:
+                status = pjmedia_conf_connect_port(main_bridge, slot, self._clock_slot, 0)
+                if status != 0:
+                    pjmedia_conf_remove_port(main_bridge, slot)
+        if status != 0:
+            with nogil:
+                pjmedia_conf_destroy(conf_bridge)
+            ua.release_memory_pool(pool)
+            raise PJSIPError("Could not link audio mixer bridges", status)
+        shard._obj = conf_bridge
+        shard._link_slot = slot
+        self._shards.append(shard)
+        return shard
+
+    cdef _AudioMixerLink _create_link(self, PJSIPUA ua, int src_slot, int dst_shard):
+        # No need to hold the lock, this function is always called with it held
+        cdef int status
+        cdef int sample_rate = self.sample_rate
+        cdef unsigned int slot
+        cdef unsigned int src_local_slot
+        cdef size_t frame_size = sample_rate / 50 * 2
+        cdef pj_str_t name
+        cdef pj_pool_t *pool
+        cdef pjmedia_conf *src_bridge
+        cdef pjmedia_conf *dst_bridge
+        cdef _audio_mixer_link *link_obj
+        cdef bytes pool_name
+        cdef _AudioMixerLink link
+
+        src_bridge = self._get_conf_bridge(src_slot, &src_local_slot)
+        dst_bridge = (<_AudioMixerShard> self._shards[dst_shard])._obj
+
+        link = _AudioMixerLink()
+        link._src_slot = src_slot
+        link._dst_shard = dst_shard
+        link._sink_slot = -1
+        link._source_slot = -1
+        link._connection_count = 0
+        pool_name = b"AudioMixerLink_%d" % id(link)
+        pool = ua.create_memory_pool(pool_name, 1024, 1024)
+        link._pool = pool
+        link_obj = <_audio_mixer_link *> pj_pool_alloc(pool, sizeof(_audio_mixer_link) + frame_size)
+        if link_obj == NULL:
+            ua.release_memory_pool(pool)
+            raise SIPCoreError("Could not allocate memory pool")
+        memset(link_obj, 0, sizeof(_audio_mixer_link))
+        link_obj.frame = <char *> link_obj + sizeof(_audio_mixer_link)
+        link_obj.frame_size = frame_size
+        link._obj = link_obj
+
+        name.ptr = "mixer-link"
+        name.slen = 10
+        pjmedia_port_info_init(&link_obj.sink.base.info, &name, _AUDIO_MIXER_LINK_SIGNATURE, sample_rate, 1, 16, sample_rate / 50)
+        pjmedia_port_info_init(&link_obj.source.base.info, &name, _AUDIO_MIXER_LINK_SIGNATURE, sample_rate, 1, 16, sample_rate / 50)
+        link_obj.sink.link = link_obj
+        link_obj.source.link = link_obj
+        link_obj.sink.base.put_frame = _AudioMixerLink_put_frame
+        link_obj.source.base.get_frame = _AudioMixerLink_get_frame
+
+        with nogil:
+            status = pjmedia_conf_add_port(src_bridge, pool, &link_obj.sink.base, NULL, &slot)
+        if status != 0:
+            self._destroy_link(ua, link)
+            raise PJSIPError("Could not link audio mixer bridges", status)
+        link._sink_slot = src_slot - src_local_slot + slot
+        with nogil:
+            status = pjmedia_conf_connect_port(src_bridge, src_local_slot, slot, 0)
+        if status == 0:
+            with nogil:
+                status = pjmedia_conf_add_port(dst_bridge, pool, &link_obj.source.base, NULL, &slot)
+        if status != 0:
+            self._destroy_link(ua, link)
+            raise PJSIPError("Could not link audio mixer bridges", status)
+        link._source_slot = dst_shard * self._bridge_size + slot
+        self._links[(src_slot, dst_shard)] = link
+        return link
+
+    cdef int _destroy_link(self, PJSIPUA ua, _AudioMixerLink link) except -1:
+        # No need to hold the lock, this function is always called with it held
+        cdef unsigned int local_slot
+        cdef pjmedia_conf *conf_bridge
+
+        for slot in (link._sink_slot, link._source_slot):
+            if slot != -1:
+                conf_bridge = self._get_conf_bridge(slot, &local_slot)
+                with nogil:
+                    pjmedia_conf_remove_port(conf_bridge, local_slot)
+        link._sink_slot = -1
+        link._source_slot = -1
+        if self._links.get((link._src_slot, link._dst_shard)) is link:
+            del self._links[(link._src_slot, link._dst_shard)]
+        link._obj = NULL
+        ua.release_memory_pool(link._pool)
+        link._pool = NULL
+        return 0
+
+    cdef int _connect(self, PJSIPUA ua, int src_slot, int dst_slot) except -1:
+        # No need to hold the lock, this function is always called with it held
+        cdef int status
+        cdef int dst_shard = dst_slot // self._bridge_size
+        cdef unsigned int src_local_slot
+        cdef unsigned int dst_local_slot
+        cdef pjmedia_conf *conf_bridge
+        cdef _AudioMixerLink link = None
+
+        self._get_conf_bridge(src_slot, &src_local_slot)
+        conf_bridge = self._get_conf_bridge(dst_slot, &dst_local_slot)
+        if src_slot // self._bridge_size != dst_shard:
+            link = self._links.get((src_slot, dst_shard))
+            if link is None:
+                link = self._create_link(ua, src_slot, dst_shard)
+            src_local_slot = link._source_slot % self._bridge_size
+        with nogil:
+            status = pjmedia_conf_connect_port(conf_bridge, src_local_slot, dst_local_slot, 0)
+        if status != 0:
+            if link is not None and link._connection_count == 0:
+                self._destroy_link(ua, link)
+            raise PJSIPError("Could not connect slots on audio mixer", status)
+        if link is not None:
+            link._connection_count += 1
+        return 0
+
+    cdef int _disconnect(self, PJSIPUA ua, int src_slot, int dst_slot) except -1:
+        # No need to hold the lock, this function is always called with it held
+        cdef int status
+        cdef int dst_shard = dst_slot // self._bridge_size
+        cdef unsigned int src_local_slot
+        cdef unsigned int dst_local_slot
+        cdef pjmedia_conf *conf_bridge
+        cdef _AudioMixerLink link = None
+
+        self._get_conf_bridge(src_slot, &src_local_slot)
+        conf_bridge = self._get_conf_bridge(dst_slot, &dst_local_slot)
+        if src_slot // self._bridge_size != dst_shard:
+            link = self._links[(src_slot, dst_shard)]
+            src_local_slot = link._source_slot % self._bridge_size
+        with nogil:
+            status = pjmedia_conf_disconnect_port(conf_bridge, src_local_slot, dst_local_slot)
+        if status != 0:
+            raise PJSIPError("Could not disconnect slots on audio mixer", status)
+        if link is not None:
+            link._connection_count -= 1
+            if link._connection_count == 0:
+                self._destroy_link(ua, link)
+        return 0
+
     def __dealloc__(self):
         global _dealloc_handler_queue
         cdef PJSIPUA ua
         cdef pjmedia_conf *conf_bridge = self._obj
         cdef pjmedia_port *null_port = self._null_port
+        cdef pjmedia_port *clock_port = self._clock_port
+        cdef _AudioMixerShard shard
 
         _remove_handler(self, &_dealloc_handler_queue)
 
@@ -532,6 +810,8 @@ cdef class AudioMixer:
             return
 
         self._stop_sound_device(ua)
+        for link in self._links.values():
+            self._destroy_link(ua, link)
         if self._null_port != NULL:
             with nogil:
                 pjmedia_port_destroy(null_port)
@@ -540,6 +820,18 @@ cdef class AudioMixer:
             with nogil:
                 pjmedia_conf_destroy(conf_bridge)
             self._obj = NULL
+        for shard in self._shards[1:]:
+            conf_bridge = shard._obj
+            with nogil:
+                pjmedia_conf_destroy(conf_bridge)
+            shard._obj = NULL
+            ua.release_memory_pool(shard._pool)
+            shard._pool = NULL
+        self._shards = list()
+        if self._clock_port != NULL:
+            with nogil:
+                pjmedia_port_destroy(clock_port)
+            self._clock_port = NULL
         ua.release_memory_pool(self._conf_pool)
         self._conf_pool = NULL
         ua.release_memory_pool(self._snd_pool)
@@ -561,7 +853,6 @@ cdef class ToneGenerator:
             cdef int volume
             cdef int status
             cdef pj_mutex_t *lock = self._lock
-            cdef pjmedia_conf *conf_bridge
             cdef PJSIPUA ua
 
             ua = self._get_ua(0)
@@ -572,15 +863,13 @@ cdef class ToneGenerator:
                 if status != 0:
                     raise PJSIPError("failed to acquire lock", status)
             try:
-                conf_bridge = self.mixer._obj
                 slot = self._slot
 
                 if value < 0:
                     raise ValueError("volume attribute cannot be negative")
                 if ua is not None and self._slot != -1:
                     volume = int(value * 1.28 - 128)
-                    with nogil:
-                        status = pjmedia_conf_adjust_rx_level(conf_bridge, slot, volume)
+                    status = self.mixer._adjust_rx_level(slot, volume)
                     if status != 0:
                         raise PJSIPError("Could not set volume of tone generator", status)
                 self._volume = value
@@ -1005,6 +1294,369 @@ cdef class RecordingWaveFile:
             pj_mutex_destroy(self._lock)
 
 
+cdef class AsyncRecordingFile:
+    def __cinit__(self, *args, **kwargs):
+        cdef int status
+
+        status = pj_mutex_create_recursive(_get_ua()._pjsip_endpoint._pool, "async_recording_file_lock", &self._lock)
+        if status != 0:
+            raise PJSIPError("failed to create lock", status)
+
+        self._slot = -1
+
+    def __init__(self, AudioMixer mixer, filename, format="wav", int bitrate=24000, double buffer_time=5.0):
+        if self.filename is not None:
+            raise SIPCoreError("AsyncRecordingFile.__init__() was already called")
+        if mixer is None:
+            raise ValueError("mixer argument may not be None")
+        if filename is None:
+            raise ValueError("filename argument may not be None")
+        if not isinstance(filename, basestring):
+            raise TypeError("file argument must be str or unicode")
+        if isinstance(filename, unicode):
+            filename = filename.encode(sys.getfilesystemencoding())
+        if format not in ("wav", "opus"):
+            raise ValueError("Unknown recording format: %s" % format)
+        if bitrate <= 0:
+            raise ValueError("bitrate argument must be positive")
+        if buffer_time <= 0:
+            raise ValueError("buffer_time argument must be positive")
+        self.mixer = mixer
+        self.filename = filename
+        self.format = format
+        self.bitrate = bitrate
+        self.buffer_time = buffer_time
+
+    cdef PJSIPUA _check_ua(self):
+        cdef PJSIPUA ua
+        try:
+            ua = _get_ua()
+            return ua
+        except:
+            self._pool = NULL
+            self._obj = NULL
+            self._thread = NULL
+            self._slot = -1
+            return None
+
+    property is_active:
+
+        def __get__(self):
+            self._check_ua()
+            return self._slot != -1
+
+    property slot:
+
+        def __get__(self):
+            self._check_ua()
+            if self._slot == -1:
+                return None
+            else:
+                return self._slot
+
+    property dropped_frames:
+
+        def __get__(self):
+            self._check_ua()
+            if self._obj == NULL:
+                return self._dropped_frames
+            return __atomic_load_n(&self._obj.dropped_frames, __ATOMIC_RELAXED)
+
+    property written_frames:
+
+        def __get__(self):
+            self._check_ua()
+            if self._obj == NULL:
+                return self._written_frames
+            return __atomic_load_n(&self._obj.read_index, __ATOMIC_RELAXED)
+
+    property error:
+
+        def __get__(self):
+            cdef int status
+            self._check_ua()
+            status = self._obj.status if self._obj != NULL else self._status
+            if status == 0:
+                return None
+            return PJSIPError("Could not write recording", status)
+
+    def start(self):
+        cdef char *filename
+        cdef int sample_rate
+        cdef int encoder_rate
+        cdef int lookahead
+        cdef int status
+        cdef unsigned int ring_frames
+        cdef size_t frame_size
+        cdef pj_mutex_t *lock = self._lock
+        cdef pj_pool_t *pool
+        cdef pj_str_t name
+        cdef _async_recording_file *obj
+        cdef bytes pool_name
+        cdef bytes header
+        cdef bytes vendor
+        cdef PJSIPUA ua
+
+        ua = _get_ua()
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            filename = PyString_AsString(self.filename)
+            pool_name = b"AsyncRecordingFile_%d" % id(self)
+            sample_rate = self.mixer.sample_rate
+            frame_size = sample_rate / 50 * 2
+            ring_frames = 1
+            while ring_frames < self.buffer_time * 50:
+                ring_frames *= 2
+
+            if self._was_started:
+                raise SIPCoreError("This AsyncRecordingFile was already started once")
+            pool = ua.create_memory_pool(pool_name, 4096, 4096)
+            self._pool = pool
+            try:
+                obj = <_async_recording_file *> pj_pool_alloc(pool, sizeof(_async_recording_file))
+                if obj == NULL:
+                    raise SIPCoreError("Could not allocate memory pool")
+                memset(obj, 0, sizeof(_async_recording_file))
+                self._obj = obj
+                obj.ring = <char *> pj_pool_alloc(pool, ring_frames * frame_size)
+                if obj.ring == NULL:
+                    raise SIPCoreError("Could not allocate memory pool")
+                obj.ring_frames = ring_frames
+                obj.frame_size = frame_size
+                obj.running = 1
+                name.ptr = "async-recorder"
+                name.slen = 14
+                pjmedia_port_info_init(&obj.base.info, &name, _ASYNC_RECORDING_FILE_SIGNATURE, sample_rate, 1, 16, sample_rate / 50)
+                obj.base.put_frame = _AsyncRecordingFile_put_frame
+
+                if self.format == "wav":
+                    obj.format = _ASYNC_RECORDING_WAV
+                    with nogil:
+                        status = pjmedia_wav_writer_port_create(pool, filename, sample_rate, 1, sample_rate / 50, 16,
+                                                                PJMEDIA_FILE_WRITE_PCM, 0, &obj.wav_port)
+                    if status != 0:
+                        raise PJSIPError("Could not create WAV file", status)
+                else:
+                    obj.format = _ASYNC_RECORDING_OPUS
+                    encoder_rate = sample_rate if sample_rate in (8000, 12000, 16000, 24000, 48000) else 48000
+                    obj.encoder_frame_samples = encoder_rate / 50
+                    if encoder_rate != sample_rate:
+                        with nogil:
+                            status = pjmedia_resample_create(pool, 1, 0, 1, sample_rate, encoder_rate, sample_rate / 50, &obj.resample)
+                        if status != 0:
+                            raise PJSIPError("Could not create resampler", status)
+                        obj.resample_buffer = <short *> pj_pool_alloc(pool, obj.encoder_frame_samples * 2)
+                    obj.packet = <unsigned char *> pj_pool_alloc(pool, _OPUS_MAX_PACKET_SIZE)
+                    obj.page_body = <unsigned char *> pj_pool_alloc(pool, 255 * 255)
+                    if obj.packet == NULL or obj.page_body == NULL or (obj.resample != NULL and obj.resample_buffer == NULL):
+                        raise SIPCoreError("Could not allocate memory pool")
+                    obj.encoder = opus_encoder_create(encoder_rate, 1, OPUS_APPLICATION_VOIP, &status)
+                    if status != OPUS_OK:
+                        obj.encoder = NULL
+                        raise SIPCoreError("Could not create Opus encoder (error %d)" % status)
+                    opus_encoder_ctl(obj.encoder, OPUS_SET_BITRATE_REQUEST, <int> self.bitrate)
+                    opus_encoder_ctl(obj.encoder, OPUS_GET_LOOKAHEAD_REQUEST, &lookahead)
+                    obj.serial = random.getrandbits(32)
+                    obj.file = fopen(filename, "wb")
+                    if obj.file == NULL:
+                        raise SIPCoreError("Could not create Opus file: %s" % os.strerror(c_errno))
+                    # the granule positions are always counted at 48kHz in Ogg Opus
+                    header = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, lookahead * 48000 / encoder_rate, sample_rate, 0, 0)
+                    status = _AsyncRecordingFile_add_packet(obj, <unsigned char *> PyString_AsString(header), len(header))
+                    if status == 0:
+                        status = _AsyncRecordingFile_write_page(obj, _OGG_PAGE_BOS)
+                    if status == 0:
+                        vendor = b"sipsimple"
+                        header = b"OpusTags" + struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", 0)
+                        status = _AsyncRecordingFile_add_packet(obj, <unsigned char *> PyString_AsString(header), len(header))
+                    if status == 0:
+                        status = _AsyncRecordingFile_write_page(obj, 0)
+                    if status != 0:
+                        raise PJSIPError("Could not write Opus file", status)
+
+                with nogil:
+                    status = pj_thread_create(pool, "recording_writer", _AsyncRecordingFile_writer, <void *> obj, 0, 0, &self._thread)
+                if status != 0:
+                    self._thread = NULL
+                    raise PJSIPError("Could not start recording writer thread", status)
+                self._slot = self.mixer._add_port(ua, self._pool, &obj.base)
+            except:
+                self._stop(ua)
+                raise
+            self._was_started = 1
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    def stop(self):
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+        cdef PJSIPUA ua
+
+        ua = self._check_ua()
+        if ua is None:
+            return
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            self._stop(ua)
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
+    cdef int _stop(self, PJSIPUA ua) except -1:
+        cdef int status
+        cdef _async_recording_file *obj = self._obj
+        cdef pj_thread_t *thread = self._thread
+
+        if self._slot != -1:
+            # once the port is removed from the mixer its put_frame callback is no longer called
+            self.mixer._remove_port(ua, self._slot)
+            self._slot = -1
+        if obj != NULL:
+            __atomic_store_n(&obj.running, 0, __ATOMIC_RELEASE)
+            if thread != NULL:
+                with nogil:
+                    pj_thread_join(thread)
+                    pj_thread_destroy(thread)
+                self._thread = NULL
+            with nogil:
+                status = _AsyncRecordingFile_finish(obj)
+            self._status = obj.status or status
+            self._dropped_frames = obj.dropped_frames
+            self._written_frames = obj.read_index
+            self._obj = NULL
+        ua.release_memory_pool(self._pool)
+        self._pool = NULL
+        return 0
+
+    def __dealloc__(self):
+        cdef PJSIPUA ua
+        try:
+            ua = _get_ua()
+        except:
+            return
+        self._stop(ua)
+
+        if self._lock != NULL:
+            pj_mutex_destroy(self._lock)
+
+
+cdef class WaveBuffer:
+    def __cinit__(self, *args, **kwargs):
+        self._data = NULL
+        self._size = 0
+
+    def __init__(self, filename):
+        cdef char *c_filename
+        cdef char *data = NULL
+        cdef char *new_data
+        cdef int status
+        cdef size_t size = 0
+        cdef size_t capacity = 0
+        cdef unsigned int frame_size
+        cdef pj_pool_t *pool
+        cdef pjmedia_port *port = NULL
+        cdef pjmedia_frame frame
+        cdef bytes pool_name
+        cdef PJSIPUA ua
+
+        if self.filename is not None:
+            raise SIPCoreError("WaveBuffer.__init__() was already called")
+        if filename is None:
+            raise ValueError("filename argument may not be None")
+        if not isinstance(filename, basestring):
+            raise TypeError("file argument must be str or unicode")
+        if isinstance(filename, unicode):
+            filename = filename.encode(sys.getfilesystemencoding())
+
+        ua = _get_ua()
+        c_filename = PyString_AsString(filename)
+        pool_name = b"WaveBuffer_%d" % id(self)
+        pool = ua.create_memory_pool(pool_name, 4096, 4096)
+        try:
+            with nogil:
+                status = pjmedia_wav_player_port_create(pool, c_filename, 0, PJMEDIA_FILE_NO_LOOP, 0, &port)
+            if status != 0:
+                raise PJSIPError("Could not open WAV file", status)
+            # the WAV player port converts A-law and u-law files to 16 bit PCM, so the decoded frames can be fed to a memory player
+            frame_size = PJMEDIA_PIA_AVG_FSZ(&port.info)
+            with nogil:
+                while True:
+                    if size + frame_size > capacity:
+                        capacity = 2 * capacity
+                        if capacity < size + frame_size:
+                            capacity = size + frame_size
+                        new_data = <char *> realloc(data, capacity)
+                        if new_data == NULL:
+                            status = PJ_ENOMEM
+                            break
+                        data = new_data
+                    frame.buf = data + size
+                    frame.size = frame_size
+                    frame.type = PJMEDIA_FRAME_TYPE_AUDIO
+                    status = pjmedia_port_get_frame(port, &frame)
+                    if status != 0 or frame.type != PJMEDIA_FRAME_TYPE_AUDIO:
+                        break
+                    size += frame.size
+            if status != 0 and status != PJ_EEOF:
+                raise PJSIPError("Could not read WAV file", status)
+            if size == 0:
+                raise SIPCoreError("WAV file contains no audio data")
+            # give back the unused part of the buffer, the cache budget is computed from the size of the audio data
+            if capacity > size:
+                new_data = <char *> realloc(data, size)
+                if new_data != NULL:
+                    data = new_data
+            self._data = data
+            self._size = size
+            self._clock_rate = PJMEDIA_PIA_SRATE(&port.info)
+            self._channel_count = PJMEDIA_PIA_CCNT(&port.info)
+            self._samples_per_frame = PJMEDIA_PIA_SPF(&port.info)
+            self._bits_per_sample = PJMEDIA_PIA_BITS(&port.info)
+            self.filename = filename
+        except:
+            free(data)
+            raise
+        finally:
+            if port != NULL:
+                with nogil:
+                    pjmedia_port_destroy(port)
+            ua.release_memory_pool(pool)
+
+    property size:
+
+        def __get__(self):
+            return self._size
+
+    property clock_rate:
+
+        def __get__(self):
+            return self._clock_rate
+
+    property channel_count:
+
+        def __get__(self):
+            return self._channel_count
+
+    property duration:
+
+        def __get__(self):
+            if self._clock_rate == 0:
+                return 0.0
+            return float(self._size) / (self._clock_rate * self._channel_count * self._bits_per_sample / 8)
+
+    def __dealloc__(self):
+        free(self._data)
+
+
 cdef class WaveFile:
     def __cinit__(self, *args, **kwargs):
         cdef int status
@@ -1019,7 +1671,7 @@ cdef class WaveFile:
         self._slot = -1
         self._volume = 100
 
-    def __init__(self, AudioMixer mixer, filename):
+    def __init__(self, AudioMixer mixer, filename, WaveBuffer buffer=None):
         if self.filename is not None:
             raise SIPCoreError("WaveFile.__init__() was already called")
         if mixer is None:
@@ -1030,8 +1682,11 @@ cdef class WaveFile:
             raise TypeError("file argument must be str or unicode")
         if isinstance(filename, unicode):
             filename = filename.encode(sys.getfilesystemencoding())
+        if buffer is not None and buffer.filename is None:
+            raise ValueError("buffer argument was not initialized")
         self.mixer = mixer
         self.filename = filename
+        self.buffer = buffer
 
     cdef PJSIPUA _check_ua(self):
         cdef PJSIPUA ua
@@ -1069,7 +1724,6 @@ cdef class WaveFile:
             cdef int status
             cdef int volume
             cdef pj_mutex_t *lock = self._lock
-            cdef pjmedia_conf *conf_bridge
             cdef PJSIPUA ua
 
             ua = self._check_ua()
@@ -1080,15 +1734,13 @@ cdef class WaveFile:
                 if status != 0:
                     raise PJSIPError("failed to acquire lock", status)
             try:
-                conf_bridge = self.mixer._obj
                 slot = self._slot
 
                 if value < 0:
                     raise ValueError("volume attribute cannot be negative")
                 if ua is not None and self._slot != -1:
                     volume = int(value * 1.28 - 128)
-                    with nogil:
-                        status = pjmedia_conf_adjust_rx_level(conf_bridge, slot, volume)
+                    status = self.mixer._adjust_rx_level(slot, volume)
                     if status != 0:
                         raise PJSIPError("Could not set volume of .wav file", status)
                 self._volume = value
@@ -1106,6 +1758,13 @@ cdef class WaveFile:
         cdef pjmedia_port **port_address
         cdef bytes pool_name
         cdef char* c_pool_name
+        cdef WaveBuffer buffer = self.buffer
+        cdef char *data
+        cdef size_t size
+        cdef unsigned int clock_rate
+        cdef unsigned int channel_count
+        cdef unsigned int samples_per_frame
+        cdef unsigned int bits_per_sample
         cdef PJSIPUA ua
 
         ua = _get_ua()
@@ -1125,14 +1784,32 @@ cdef class WaveFile:
             pool = ua.create_memory_pool(pool_name, 4096, 4096)
             self._pool = pool
             try:
-                with nogil:
-                    status = pjmedia_wav_player_port_create(pool, filename, 0, PJMEDIA_FILE_NO_LOOP, 0, port_address)
-                if status != 0:
-                    raise PJSIPError("Could not open WAV file", status)
-                with nogil:
-                    status = pjmedia_wav_player_set_eof_cb(port_address[0], weakref, cb_play_wav_eof)
-                if status != 0:
-                    raise PJSIPError("Could not set WAV EOF callback", status)
+                if buffer is not None:
+                    # the port only reads from the buffer, which is kept alive by self.buffer while the port exists
+                    data = buffer._data
+                    size = buffer._size
+                    clock_rate = buffer._clock_rate
+                    channel_count = buffer._channel_count
+                    samples_per_frame = buffer._samples_per_frame
+                    bits_per_sample = buffer._bits_per_sample
+                    with nogil:
+                        status = pjmedia_mem_player_create(pool, data, size, clock_rate, channel_count, samples_per_frame,
+                                                           bits_per_sample, PJMEDIA_MEM_NO_LOOP, port_address)
+                    if status != 0:
+                        raise PJSIPError("Could not create WAV buffer player", status)
+                    with nogil:
+                        status = pjmedia_mem_player_set_eof_cb(port_address[0], weakref, cb_play_wav_eof)
+                    if status != 0:
+                        raise PJSIPError("Could not set WAV EOF callback", status)
+                else:
+                    with nogil:
+                        status = pjmedia_wav_player_port_create(pool, filename, 0, PJMEDIA_FILE_NO_LOOP, 0, port_address)
+                    if status != 0:
+                        raise PJSIPError("Could not open WAV file", status)
+                    with nogil:
+                        status = pjmedia_wav_player_set_eof_cb(port_address[0], weakref, cb_play_wav_eof)
+                    if status != 0:
+                        raise PJSIPError("Could not set WAV EOF callback", status)
                 self._slot = self.mixer._add_port(ua, self._pool, self._port)
                 if self._volume != 100:
                     self.volume = self._volume
@@ -1369,6 +2046,157 @@ cdef int _AudioMixer_dealloc_handler(object obj) except -1:
     finally:
         pj_mutex_unlock(mixer._lock)
 
+cdef int _AudioMixerLink_put_frame(pjmedia_port *port, pjmedia_frame *frame) nogil:
+    cdef _audio_mixer_link *link = (<_audio_mixer_link_port *> port).link
+    if frame.type == PJMEDIA_FRAME_TYPE_AUDIO and <size_t> frame.size == link.frame_size:
+        memcpy(link.frame, frame.buf, link.frame_size)
+        link.has_frame = 1
+    else:
+        link.has_frame = 0
+    return 0
+
+cdef int _AudioMixerLink_get_frame(pjmedia_port *port, pjmedia_frame *frame) nogil:
+    cdef _audio_mixer_link *link = (<_audio_mixer_link_port *> port).link
+    if link.has_frame:
+        memcpy(frame.buf, link.frame, link.frame_size)
+        frame.size = link.frame_size
+        frame.type = PJMEDIA_FRAME_TYPE_AUDIO
+        link.has_frame = 0
+    else:
+        frame.size = 0
+        frame.type = PJMEDIA_FRAME_TYPE_NONE
+    return 0
+
+cdef int _AsyncRecordingFile_put_frame(pjmedia_port *port, pjmedia_frame *frame) nogil:
+    # called from the mixer clock thread, which is the only producer
+    cdef _async_recording_file *obj = <_async_recording_file *> port
+    cdef unsigned long write_index = obj.write_index
+    if frame.type != PJMEDIA_FRAME_TYPE_AUDIO or <size_t> frame.size != obj.frame_size:
+        return 0
+    if write_index - __atomic_load_n(&obj.read_index, __ATOMIC_ACQUIRE) >= obj.ring_frames:
+        __atomic_add_fetch(&obj.dropped_frames, 1, __ATOMIC_RELAXED)
+        return 0
+    memcpy(obj.ring + (write_index & (obj.ring_frames - 1)) * obj.frame_size, frame.buf, obj.frame_size)
+    __atomic_store_n(&obj.write_index, write_index + 1, __ATOMIC_RELEASE)
+    return 0
+
+cdef int _AsyncRecordingFile_writer(void *arg) nogil:
+    cdef _async_recording_file *obj = <_async_recording_file *> arg
+    cdef unsigned long read_index = obj.read_index
+    cdef unsigned long write_index
+    cdef unsigned long running
+    while True:
+        # read the running flag first, so the frames queued before the recording was stopped are still written
+        running = __atomic_load_n(&obj.running, __ATOMIC_ACQUIRE)
+        write_index = __atomic_load_n(&obj.write_index, __ATOMIC_ACQUIRE)
+        while read_index != write_index:
+            if obj.status == 0:
+                obj.status = _AsyncRecordingFile_write_frame(obj, obj.ring + (read_index & (obj.ring_frames - 1)) * obj.frame_size)
+            read_index += 1
+            __atomic_store_n(&obj.read_index, read_index, __ATOMIC_RELEASE)
+        if not running:
+            break
+        pj_thread_sleep(10)
+    return 0
+
+cdef int _AsyncRecordingFile_write_frame(_async_recording_file *obj, char *data) nogil:
+    cdef int size
+    cdef int status
+    cdef short *pcm = <short *> data
+    cdef pjmedia_frame frame
+    if obj.format == _ASYNC_RECORDING_WAV:
+        frame.type = PJMEDIA_FRAME_TYPE_AUDIO
+        frame.buf = data
+        frame.size = obj.frame_size
+        return pjmedia_port_put_frame(obj.wav_port, &frame)
+    if obj.resample != NULL:
+        pjmedia_resample_run(obj.resample, pcm, obj.resample_buffer)
+        pcm = obj.resample_buffer
+    size = opus_encode(obj.encoder, pcm, obj.encoder_frame_samples, obj.packet, _OPUS_MAX_PACKET_SIZE)
+    if size < 0:
+        return PJ_EUNKNOWN
+    status = _AsyncRecordingFile_add_packet(obj, obj.packet, size)
+    if status != 0:
+        return status
+    obj.granule_position += 960
+    obj.page_granule_position = obj.granule_position
+    if obj.page_packets >= _OGG_PAGE_MAX_PACKETS:
+        return _AsyncRecordingFile_write_page(obj, 0)
+    return 0
+
+cdef int _AsyncRecordingFile_add_packet(_async_recording_file *obj, unsigned char *data, size_t size) nogil:
+    cdef int status
+    cdef unsigned int segment_count = size / 255 + 1
+    cdef unsigned int i
+    if obj.page_segment_count + segment_count > 255:
+        status = _AsyncRecordingFile_write_page(obj, 0)
+        if status != 0:
+            return status
+    for i in range(segment_count - 1):
+        obj.page_segments[obj.page_segment_count + i] = 255
+    obj.page_segments[obj.page_segment_count + segment_count - 1] = size % 255
+    obj.page_segment_count += segment_count
+    memcpy(obj.page_body + obj.page_body_size, data, size)
+    obj.page_body_size += size
+    obj.page_packets += 1
+    return 0
+
+cdef int _AsyncRecordingFile_write_page(_async_recording_file *obj, int flags) nogil:
+    cdef unsigned char header[27]
+    cdef uint32_t crc
+    cdef int i
+    memcpy(header, "OggS", 4)
+    header[4] = 0
+    header[5] = flags
+    for i in range(8):
+        header[6 + i] = (obj.page_granule_position >> (8 * i)) & 0xff
+    for i in range(4):
+        header[14 + i] = (obj.serial >> (8 * i)) & 0xff
+        header[18 + i] = (obj.page_sequence >> (8 * i)) & 0xff
+        header[22 + i] = 0
+    header[26] = obj.page_segment_count
+    crc = _ogg_crc(0, header, 27)
+    crc = _ogg_crc(crc, obj.page_segments, obj.page_segment_count)
+    crc = _ogg_crc(crc, obj.page_body, obj.page_body_size)
+    for i in range(4):
+        header[22 + i] = (crc >> (8 * i)) & 0xff
+    if fwrite(header, 1, 27, obj.file) != 27:
+        return PJ_EUNKNOWN
+    if obj.page_segment_count > 0 and fwrite(obj.page_segments, 1, obj.page_segment_count, obj.file) != obj.page_segment_count:
+        return PJ_EUNKNOWN
+    if obj.page_body_size > 0 and fwrite(obj.page_body, 1, obj.page_body_size, obj.file) != obj.page_body_size:
+        return PJ_EUNKNOWN
+    obj.page_sequence += 1
+    obj.page_packets = 0
+    obj.page_segment_count = 0
+    obj.page_body_size = 0
+    return 0
+
+cdef int _AsyncRecordingFile_finish(_async_recording_file *obj) nogil:
+    cdef int status = 0
+    if obj.wav_port != NULL:
+        status = pjmedia_port_destroy(obj.wav_port)
+        obj.wav_port = NULL
+    if obj.file != NULL:
+        if obj.status == 0:
+            status = _AsyncRecordingFile_write_page(obj, _OGG_PAGE_EOS)
+        if fclose(obj.file) != 0 and status == 0:
+            status = PJ_EUNKNOWN
+        obj.file = NULL
+    if obj.encoder != NULL:
+        opus_encoder_destroy(obj.encoder)
+        obj.encoder = NULL
+    if obj.resample != NULL:
+        pjmedia_resample_destroy(obj.resample)
+        obj.resample = NULL
+    return status
+
+cdef uint32_t _ogg_crc(uint32_t crc, unsigned char *data, size_t size) nogil:
+    cdef size_t i
+    for i in range(size):
+        crc = (crc << 8) ^ _ogg_crc_table[((crc >> 24) & 0xff) ^ data[i]]
+    return crc
+
 cdef int cb_play_wav_eof(pjmedia_port *port, void *user_data) with gil:
     cdef Timer timer
     cdef WaveFile wav_file
@@ -1,6 +1,5 @@
 
 import errno
-import heapq
 import re
 import random
 import sys
@@ -9,6 +8,38 @@ import traceback
 import os
 import tempfile
 
+from collections import deque
+from libc.math cimport ceil
+from libc.string cimport strlen
+
+
+# C types
+
+cdef struct _sip_capture_record:
+    unsigned int size
+    long sec
+    long msec
+    unsigned char ipv6
+    unsigned char reliable
+    unsigned char src_addr[16]
+    unsigned char dst_addr[16]
+    unsigned short src_port
+    unsigned short dst_port
+    unsigned int len
+
+cdef struct _sip_capture:
+    _ring_buffer ring
+    unsigned long packets
+
+cdef packed struct _pcap_file_header:
+    unsigned int magic
+    unsigned short version_major
+    unsigned short version_minor
+    int thiszone
+    unsigned int sigfigs
+    unsigned int snaplen
+    unsigned int network
+
 
 cdef class Timer:
     cdef int schedule(self, float delay, timer_callback callback, object obj) except -1:
@@ -19,11 +50,21 @@ cdef class Timer:
             raise ValueError("callback must be non-NULL")
         if self._scheduled:
             raise RuntimeError("already scheduled")
-        self.schedule_time = PyFloat_AsDouble(time.time() + delay)
         self.callback = callback
         self.obj = obj
-        ua._add_timer(self)
         self._scheduled = 1
+        # references kept by earlier schedules of this timer (deferred or expired ones) are recognized by their generation
+        self._generation += 1
+        try:
+            if delay == 0:
+                # timers without a delay are only used to defer work out of PJSIP callbacks, so they bypass the wheel
+                ua._add_deferred_timer(self)
+            else:
+                self.schedule_time = PyFloat_AsDouble(time.time() + delay)
+                ua._add_timer(self)
+        except:
+            self._scheduled = 0
+            raise
         return 0
 
     cdef int cancel(self) except -1:
@@ -38,24 +79,209 @@ cdef class Timer:
         self._scheduled = 0
         self.callback(self.obj, self)
 
-    def __richcmp__(self, other, op):
-        cdef double diff
-        if not isinstance(self, Timer) or not isinstance(other, Timer):
-            return NotImplemented
-        diff = (<Timer>self).schedule_time - (<Timer>other).schedule_time
-        if op == 0: # <
-            return diff < 0.0
-        elif op == 1: # <=
-            return diff <= 0.0
-        elif op == 2: # ==
-            return diff == 0.0
-        elif op == 3: # !=
-            return diff != 0.0
-        elif op == 4: # >
-            return diff > 0.0
-        elif op == 5: # >=
-            return diff >= 0.0
-        return
+
+# The timer wheel has 4 levels: the first one has a slot for each tick (10ms) and covers 2.56 seconds, the
+# following ones have 64 slots covering 256, 16384 and 1048576 ticks each, which adds up to about 7.7 days.
+# Timers scheduled further away than that are kept in an overflow set. Each slot is a set, so scheduling and
+# cancelling a timer are O(1) and cancelled timers are removed right away instead of lingering until they expire.
+
+cdef double _TIMER_WHEEL_TICK = 0.01
+cdef int _TIMER_WHEEL_LEVELS = 4
+cdef int _TIMER_WHEEL_ROOT_BITS = 8
+cdef int _TIMER_WHEEL_LEVEL_BITS = 6
+cdef long long _TIMER_WHEEL_MAX_CATCHUP = 1 << 20
+
+
+cdef class TimerWheel:
+    def __cinit__(self, double now):
+        cdef int i
+        self._levels = [[set() for i in range(1 << _TIMER_WHEEL_ROOT_BITS)]]
+        for i in range(1, _TIMER_WHEEL_LEVELS):
+            self._levels.append([set() for i in range(1 << _TIMER_WHEEL_LEVEL_BITS)])
+        self._overflow = set()
+        self._current_tick = <long long> (now / _TIMER_WHEEL_TICK)
+        self.count = 0
+        self.cancelled = 0
+        self.expired = 0
+
+    cdef object _get_slot(self, long long tick):
+        cdef long long delta = tick - self._current_tick
+        cdef int level
+        cdef int shift = _TIMER_WHEEL_ROOT_BITS
+        if delta < (1 << shift):
+            return self._levels[0][tick & ((1 << _TIMER_WHEEL_ROOT_BITS) - 1)]
+        for level in range(1, _TIMER_WHEEL_LEVELS):
+            if delta < (<long long> 1 << (shift + _TIMER_WHEEL_LEVEL_BITS)):
+                return self._levels[level][(tick >> shift) & ((1 << _TIMER_WHEEL_LEVEL_BITS) - 1)]
+            shift += _TIMER_WHEEL_LEVEL_BITS
+        return self._overflow
+
+    cdef int _cascade(self, int level, int index) except -1:
+        cdef Timer timer
+        cdef set slot
+        cdef object timers
+        if level < _TIMER_WHEEL_LEVELS:
+            slot = self._levels[level][index]
+        else:
+            slot = self._overflow
+        if not slot:
+            return 0
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            timer._wheel_slot = self._get_slot(timer._wheel_tick)
+            timer._wheel_slot.add(timer)
+        return 0
+
+    cdef int _rebuild(self, long long tick, list expired) except -1:
+        # used when the clock jumped too far ahead to walk the wheel one tick at a time
+        cdef Timer timer
+        cdef list timers = list()
+        cdef list level_slots
+        cdef set slot
+        for level_slots in self._levels:
+            for slot in level_slots:
+                timers.extend(slot)
+                slot.clear()
+        timers.extend(self._overflow)
+        self._overflow.clear()
+        self._current_tick = tick + 1
+        for timer in timers:
+            if timer._wheel_tick <= tick:
+                timer._wheel_slot = None
+                expired.append(timer)
+            else:
+                timer._wheel_slot = self._get_slot(timer._wheel_tick)
+                timer._wheel_slot.add(timer)
+        return 0
+
+    cdef int add(self, Timer timer) except -1:
+        timer._wheel_tick = <long long> ceil(timer.schedule_time / _TIMER_WHEEL_TICK)
+        if timer._wheel_tick < self._current_tick:
+            timer._wheel_tick = self._current_tick
+        timer._wheel_slot = self._get_slot(timer._wheel_tick)
+        timer._wheel_slot.add(timer)
+        self.count += 1
+        return 0
+
+    cdef int remove(self, Timer timer) except -1:
+        if timer._wheel_slot is None:
+            return 0
+        timer._wheel_slot.discard(timer)
+        timer._wheel_slot = None
+        self.count -= 1
+        self.cancelled += 1
+        return 0
+
+    cdef list expire(self, double now):
+        cdef long long tick = <long long> (now / _TIMER_WHEEL_TICK)
+        cdef long long index
+        cdef int level
+        cdef int shift
+        cdef list expired = list()
+        cdef set slot
+        cdef Timer timer
+        if self.count == 0:
+            self._current_tick = max(self._current_tick, tick + 1)
+            return expired
+        if tick - self._current_tick > _TIMER_WHEEL_MAX_CATCHUP:
+            self._rebuild(tick, expired)
+        while self._current_tick <= tick:
+            index = self._current_tick & ((1 << _TIMER_WHEEL_ROOT_BITS) - 1)
+            if index == 0:
+                # find the highest level that wraps around on this tick and move its timers down, level by level
+                level = 1
+                shift = _TIMER_WHEEL_ROOT_BITS
+                while level < _TIMER_WHEEL_LEVELS and (self._current_tick >> shift) & ((1 << _TIMER_WHEEL_LEVEL_BITS) - 1) == 0:
+                    level += 1
+                    shift += _TIMER_WHEEL_LEVEL_BITS
+                while level > 0:
+                    self._cascade(level, (self._current_tick >> shift) & ((1 << _TIMER_WHEEL_LEVEL_BITS) - 1))
+                    level -= 1
+                    shift -= _TIMER_WHEEL_LEVEL_BITS
+            slot = self._levels[0][index]
+            if slot:
+                for timer in slot:
+                    timer._wheel_slot = None
+                expired.extend(slot)
+                slot.clear()
+            self._current_tick += 1
+        self.count -= len(expired)
+        self.expired += len(expired)
+        if len(expired) > 1:
+            expired.sort(key=_timer_schedule_time)
+        # the callbacks of the first timers may cancel and reschedule the following ones, which then have a new generation
+        return [(timer, timer._generation) for timer in expired]
+
+    cdef double next_timeout(self, double now, double max_timeout) except -1:
+        cdef long long tick
+        cdef long long last_tick
+        if self.count == 0:
+            return max_timeout
+        last_tick = <long long> ((now + max_timeout) / _TIMER_WHEEL_TICK)
+        tick = self._current_tick
+        while tick <= last_tick:
+            # the poll loop needs to wake up for a cascade as well, as it may bring a timer due in this interval down
+            if self._levels[0][tick & ((1 << _TIMER_WHEEL_ROOT_BITS) - 1)] or tick & ((1 << _TIMER_WHEEL_ROOT_BITS) - 1) == 0:
+                return min(max(tick * _TIMER_WHEEL_TICK - now, 0.0), max_timeout)
+            tick += 1
+        return max_timeout
+
+
+def _timer_schedule_time(Timer timer):
+    return timer.schedule_time
+
+
+# RTP ports are handed out in even/odd pairs. The bitmap has a bit set for every pair which is in use, the free pairs
+# are kept in a FIFO so that allocating one is O(1) and the least recently used pair is picked first. A released pair
+# is kept in quarantine for a while before it can be reused, so late RTP from the previous call doesn't end up in a new one.
+
+cdef class RTPPortAllocator:
+    def __cinit__(self, int start, int stop, double quarantine_time):
+        self.start = start
+        self.stop = stop
+        self.size = (stop - start) // 2
+        self.quarantine_time = quarantine_time
+        self._bitmap = bytearray((self.size + 7) // 8)
+        self._free = deque(range(self.size))
+        self._quarantine = deque()
+        self.allocated = 0
+        self.peak = 0
+        self.exhausted = 0
+
+    cdef int _release_quarantined(self, double now) except -1:
+        while self._quarantine and self._quarantine[0][0] <= now:
+            self._free.append(self._quarantine.popleft()[1])
+        return 0
+
+    cdef int allocate(self) except -2:
+        cdef int index
+        self._release_quarantined(time.time())
+        if not self._free:
+            self.exhausted += 1
+            return -1
+        index = self._free.popleft()
+        self._bitmap[index >> 3] |= 1 << (index & 7)
+        self.allocated += 1
+        if self.allocated > self.peak:
+            self.peak = self.allocated
+        return self.start + 2*index
+
+    cdef int release(self, int port) except -1:
+        cdef int index = (port - self.start) // 2
+        if port < self.start or index >= self.size or not self._bitmap[index >> 3] & (1 << (index & 7)):
+            return 0
+        self._bitmap[index >> 3] &= ~(1 << (index & 7))
+        self.allocated -= 1
+        self._quarantine.append((time.time() + self.quarantine_time, index))
+        return 0
+
+    property statistics:
+
+        def __get__(self):
+            self._release_quarantined(time.time())
+            return dict(range=(self.start, self.stop), size=self.size, allocated=self.allocated, quarantined=len(self._quarantine),
+                        free=len(self._free), peak=self.peak, exhausted=self.exhausted)
 
 
 cdef class PJSIPUA:
@@ -65,7 +291,8 @@ cdef class PJSIPUA:
             raise SIPCoreError("Can only have one PJSUPUA instance at the same time")
         _ua = <void *> self
         self._threads = []
-        self._timers = list()
+        self._timers = TimerWheel(time.time())
+        self._deferred_timers = deque()
         self._events = {}
         self._incoming_events = set()
         self._incoming_requests = set()
@@ -90,15 +317,27 @@ cdef class PJSIPUA:
         pj_log_set_log_func(_cb_log)
         self._pjlib = PJLIB()
         pj_srand(random.getrandbits(32)) # rely on python seed for now
-        self._caching_pool = PJCachingPool()
-        self._pjmedia_endpoint = PJMEDIAEndpoint(self._caching_pool)
+        self._caching_pool = PJCachingPool(kwargs["memory_pool_cache_size"])
+        self._memory_pools = dict()
+        self._memory_pool_statistics = dict()
+        self._pjmedia_endpoint = PJMEDIAEndpoint(self._caching_pool, kwargs["media_threads"], kwargs["media_thread_affinity"])
         self._pjsip_endpoint = PJSIPEndpoint(self._caching_pool, kwargs["ip_address"], kwargs["udp_port"],
                                              kwargs["tcp_port"], kwargs["tls_port"],
                                              kwargs["tls_verify_server"], kwargs["tls_ca_file"],
-                                             kwargs["tls_cert_file"], kwargs["tls_privkey_file"], kwargs["tls_timeout"])
+                                             kwargs["tls_cert_file"], kwargs["tls_privkey_file"], kwargs["tls_timeout"],
+                                             kwargs["async_socket_operations"], kwargs["udp_sockets"])
         status = pj_mutex_create_simple(self._pjsip_endpoint._pool, "event_queue_lock", &_event_queue_lock)
         if status != 0:
             raise PJSIPError("Could not initialize event queue mutex", status)
+        status = pj_mutex_create_simple(self._pjsip_endpoint._pool, "log_buffer_lock", &_log_buffer_lock)
+        if status != 0:
+            raise PJSIPError("Could not initialize log buffer mutex", status)
+        self._set_log_buffer_size(kwargs["log_buffer_size"])
+        self._set_log_event_level(kwargs["log_event_level"])
+        status = pj_mutex_create_simple(self._pjsip_endpoint._pool, "ua_timer_lock", &self._timer_lock)
+        if status != 0:
+            raise PJSIPError("Could not initialize timer mutex", status)
+        _poll_wakeup_init(self._pjsip_endpoint._pool, pjsip_endpt_get_ioqueue(self._pjsip_endpoint._obj))
         self._ip_address = kwargs["ip_address"]
         self.codecs = kwargs["codecs"]
         self.video_codecs = kwargs["video_codecs"]
@@ -127,7 +366,6 @@ cdef class PJSIPUA:
                                             PJSIP_H_SUPPORTED, NULL, 1, &str_gruu.pj_str)
         if status != 0:
             raise PJSIPError("Could not add 'gruu' to Supported header", status)
-        self._trace_sip = int(bool(kwargs["trace_sip"]))
         self._detect_sip_loops = int(bool(kwargs["detect_sip_loops"]))
         self._enable_colorbar_device = int(bool(kwargs["enable_colorbar_device"]))
         self._opus_fix_module_name = PJSTR("mod-core-opus-fix")
@@ -149,9 +387,11 @@ cdef class PJSIPUA:
         self._trace_module.on_rx_response = _cb_trace_rx
         self._trace_module.on_tx_request = _cb_trace_tx
         self._trace_module.on_tx_response = _cb_trace_tx
-        status = pjsip_endpt_register_module(self._pjsip_endpoint._obj, &self._trace_module)
+        status = pj_mutex_create_simple(self._pjsip_endpoint._pool, "sip_capture_lock", &_sip_capture_lock)
         if status != 0:
-            raise PJSIPError("Could not load sip trace module", status)
+            raise PJSIPError("Could not initialize SIP capture mutex", status)
+        self._set_sip_capture_size(kwargs["sip_capture_size"])
+        self._set_trace_sip(int(bool(kwargs["trace_sip"])))
         self._ua_tag_module_name = PJSTR("mod-core-ua-tag")
         self._ua_tag_module.name = self._ua_tag_module_name.pj_str
         self._ua_tag_module.id = -1
@@ -177,7 +417,10 @@ cdef class PJSIPUA:
         status = pj_mutex_create_recursive(self._pjsip_endpoint._pool, "ua_video_lock", &self.video_lock)
         if status != 0:
             raise PJSIPError("Could not initialize video mutex", status)
-        self._user_agent = PJSTR(kwargs["user_agent"])
+        status = pj_mutex_create_simple(self._pjsip_endpoint._pool, "ua_tag_lock", &_ua_tag_lock)
+        if status != 0:
+            raise PJSIPError("Could not initialize User-Agent/Server header mutex", status)
+        self._set_user_agent(kwargs["user_agent"])
         for event, accept_types in kwargs["events"].iteritems():
             self.add_event(event, accept_types)
         for event in kwargs["incoming_events"]:
@@ -189,6 +432,7 @@ cdef class PJSIPUA:
             if method in ("ACK", "BYE", "INVITE", "REFER", "SUBSCRIBE"):
                 raise ValueError('Handling incoming "%s" requests is not allowed' % method)
             self._incoming_requests.add(method)
+        self._rtp_port_quarantine_time = kwargs["rtp_port_quarantine_time"]
         self.rtp_port_range = kwargs["rtp_port_range"]
         self.zrtp_cache = kwargs["zrtp_cache"]
         pj_stun_config_init(&self._stun_cfg, &self._caching_pool._obj.factory, 0,
@@ -199,11 +443,139 @@ cdef class PJSIPUA:
 
         def __get__(self):
             self._check_self()
-            return bool(self._trace_sip)
+            return bool(_trace_sip)
+
+        def __set__(self, value):
+            self._check_self()
+            self._set_trace_sip(int(bool(value)))
+
+    property sip_capture_size:
+
+        def __get__(self):
+            self._check_self()
+            return _sip_capture_state.ring.size
 
         def __set__(self, value):
             self._check_self()
-            self._trace_sip = int(bool(value))
+            self._set_sip_capture_size(value)
+
+    property sip_capture_statistics:
+
+        def __get__(self):
+            cdef dict retval
+            self._check_self()
+            with nogil:
+                pj_mutex_lock(_sip_capture_lock)
+            try:
+                retval = dict(size=_sip_capture_state.ring.size, used=_ring_buffer_used(&_sip_capture_state.ring),
+                              buffered_packets=_sip_capture_state.ring.count, captured_packets=_sip_capture_state.packets,
+                              dropped_packets=_sip_capture_state.ring.dropped)
+            finally:
+                with nogil:
+                    pj_mutex_unlock(_sip_capture_lock)
+            return retval
+
+    property timer_statistics:
+
+        def __get__(self):
+            cdef dict retval
+            self._check_self()
+            with nogil:
+                pj_mutex_lock(self._timer_lock)
+            try:
+                retval = dict(scheduled=self._timers.count, deferred=len(self._deferred_timers),
+                              cancelled=self._timers.cancelled, expired=self._timers.expired)
+            finally:
+                with nogil:
+                    pj_mutex_unlock(self._timer_lock)
+            return retval
+
+    property udp_transport_statistics:
+
+        def __get__(self):
+            cdef list retval = list()
+            cdef pjsip_transport *transport
+            cdef int i
+            self._check_self()
+            with nogil:
+                pj_mutex_lock(_udp_transport_lock)
+            try:
+                for i in range(_udp_transport_count):
+                    transport = _udp_transports[i].transport
+                    retval.append(dict(local_address='%s:%d' % (_pj_str_to_str(transport.local_name.host), transport.local_name.port),
+                                       rx_packets=_udp_transports[i].rx_packets, rx_bytes=_udp_transports[i].rx_bytes,
+                                       tx_packets=_udp_transports[i].tx_packets, tx_bytes=_udp_transports[i].tx_bytes))
+            finally:
+                with nogil:
+                    pj_mutex_unlock(_udp_transport_lock)
+            return retval
+
+    property memory_pool_statistics:
+
+        def __get__(self):
+            cdef pj_caching_pool *caching_pool
+            cdef pj_pool_t *pool
+            cdef dict pools = dict()
+            self._check_self()
+            caching_pool = &self._caching_pool._obj
+            for prefix, (live, peak, created) in self._memory_pool_statistics.iteritems():
+                pools[prefix] = dict(live=live, peak=peak, created=created, capacity=0, used=0)
+            for address, prefix in self._memory_pools.iteritems():
+                pool = <pj_pool_t *> <Py_ssize_t> address
+                pools[prefix]["capacity"] += pj_pool_get_capacity(pool)
+                pools[prefix]["used"] += pj_pool_get_used_size(pool)
+            return dict(pools=pools, cache=dict(capacity=caching_pool.capacity, max_capacity=caching_pool.max_capacity,
+                                                used_count=caching_pool.used_count, used_size=caching_pool.used_size,
+                                                peak_used_size=caching_pool.peak_used_size))
+
+    property handler_queue_statistics:
+
+        def __get__(self):
+            self._check_self()
+            return dict(post_poll=_post_poll_handler_queue.count, dealloc=_dealloc_handler_queue.count)
+
+    def save_sip_capture(self, object filename, object seconds=None):
+        # Write the buffered SIP packets (or only those captured in the last `seconds' seconds) to a pcap file. The
+        # file is written without holding the GIL, so this can be called from a background thread.
+        cdef char *buf = NULL
+        cdef char *c_filename
+        cdef size_t length = 0
+        cdef unsigned int count = 0
+        cdef int status
+        cdef pj_time_val start
+        self._check_self()
+        if isinstance(filename, unicode):
+            filename = filename.encode(sys.getfilesystemencoding())
+        c_filename = filename
+        pj_gettimeofday(&start)
+        if seconds is None:
+            start.sec = 0
+            start.msec = 0
+        else:
+            start.sec -= int(seconds)
+            start.msec -= int(seconds * 1000) % 1000
+            if start.msec < 0:
+                start.sec -= 1
+                start.msec += 1000
+        with nogil:
+            pj_mutex_lock(_sip_capture_lock)
+            if _sip_capture_state.ring.buf != NULL:
+                buf = <char *> malloc(_sip_capture_state.ring.size)
+                if buf != NULL:
+                    _sip_capture_copy(&_sip_capture_state, buf, &start, &length, &count)
+            pj_mutex_unlock(_sip_capture_lock)
+        if _sip_capture_state.ring.size == 0:
+            raise SIPCoreError("SIP capture is not enabled")
+        if buf == NULL:
+            raise MemoryError()
+        try:
+            with nogil:
+                status = _sip_capture_write_pcap(c_filename, buf, length)
+            if status != 0:
+                raise SIPCoreError("Could not write SIP capture to %s" % filename)
+        finally:
+            free(buf)
+        return count
 
     property detect_sip_loops:
 
@@ -310,6 +682,17 @@ cdef class PJSIPUA:
             pool = pjsip_endpt_create_pool(endpoint, c_pool_name, initial_size, resize_size)
         if pool == NULL:
             raise SIPCoreError("Could not allocate memory pool")
+        # pools are named <prefix>_<id>, the statistics are kept per prefix
+        prefix, sep, suffix = name.rpartition(b"_")
+        if not sep or not suffix.isdigit():
+            prefix = name
+        statistics = self._memory_pool_statistics.get(prefix)
+        if statistics is None:
+            statistics = self._memory_pool_statistics[prefix] = [0, 0, 0]
+        statistics[0] += 1
+        statistics[1] = max(statistics[0], statistics[1])
+        statistics[2] += 1
+        self._memory_pools[<Py_ssize_t> pool] = prefix
         return pool
 
     cdef void release_memory_pool(self, pj_pool_t* pool):
@@ -317,6 +700,9 @@ cdef class PJSIPUA:
         endpoint = self._pjsip_endpoint._obj
 
         if pool != NULL:
+            prefix = self._memory_pools.pop(<Py_ssize_t> pool, None)
+            if prefix is not None:
+                self._memory_pool_statistics[prefix][0] -= 1
             with nogil:
                 pjsip_endpt_release_pool(endpoint, pool)
 
@@ -589,7 +975,7 @@ cdef class PJSIPUA:
 
         def __get__(self):
             self._check_self()
-            return (self._rtp_port_start, self._rtp_port_start + self._rtp_port_count)
+            return (self._rtp_port_allocator.start, self._rtp_port_allocator.stop)
 
         def __set__(self, value):
             cdef int _rtp_port_start
@@ -606,10 +992,13 @@ cdef class PJSIPUA:
             _rtp_port_usable_count = _rtp_port_count - _rtp_port_count % 2 # we need an even number of ports, so we won't use the last one if an odd number is provided
             if _rtp_port_usable_count < 2:
                 raise SIPCoreError("RTP port range should contain at least 2 ports")
-            self._rtp_port_start = _rtp_port_start
-            self._rtp_port_count = _rtp_port_count
-            self._rtp_port_usable_count = _rtp_port_usable_count
-            self._rtp_port_index = 0
+            self._rtp_port_allocator = RTPPortAllocator(_rtp_port_start, _rtp_port_stop, self._rtp_port_quarantine_time)
+
+    property rtp_port_statistics:
+
+        def __get__(self):
+            self._check_self()
+            return self._rtp_port_allocator.statistics
 
     property user_agent:
 
@@ -619,7 +1008,7 @@ cdef class PJSIPUA:
 
         def __set__(self, value):
             self._check_self()
-            self._user_agent = PJSTR("value")
+            self._set_user_agent(value)
 
     property log_level:
 
@@ -633,6 +1022,81 @@ cdef class PJSIPUA:
                 raise ValueError("Log level should be between 0 and %d" % PJ_LOG_MAX_LEVEL)
             pj_log_set_level(value)
 
+    property log_event_level:
+
+        def __get__(self):
+            self._check_self()
+            return _log_event_level
+
+        def __set__(self, value):
+            self._check_self()
+            self._set_log_event_level(value)
+
+    property log_buffer_size:
+
+        def __get__(self):
+            self._check_self()
+            return _log_buffer.size
+
+        def __set__(self, value):
+            self._check_self()
+            self._set_log_buffer_size(value)
+
+    property log_buffer_statistics:
+
+        def __get__(self):
+            cdef dict retval
+            self._check_self()
+            with nogil:
+                pj_mutex_lock(_log_buffer_lock)
+            try:
+                retval = dict(size=_log_buffer.size, used=_ring_buffer_used(&_log_buffer), buffered_lines=_log_buffer.count,
+                              dropped_lines=_log_buffer.evicted + _log_buffer.dropped)
+            finally:
+                with nogil:
+                    pj_mutex_unlock(_log_buffer_lock)
+            return retval
+
+    def get_buffered_logs(self, object count=None):
+        # Remove the oldest count (or all) lines from the log buffer and return them as (level, message) tuples
+        cdef char *buf = NULL
+        cdef size_t length = 0
+        cdef size_t offset = 0
+        cdef unsigned int c_count
+        cdef int pending = 0
+        cdef _log_record *record
+        cdef list retval = list()
+        self._check_self()
+        if count is None:
+            c_count = _log_buffer.count
+        elif count < 0:
+            raise ValueError("count must be a non-negative number")
+        else:
+            c_count = count
+        with nogil:
+            pj_mutex_lock(_log_buffer_lock)
+            if _log_buffer.count > 0 and c_count > 0:
+                pending = 1
+                buf = <char *> malloc(_ring_buffer_used(&_log_buffer))
+                if buf != NULL:
+                    while c_count > 0 and _log_buffer.count > 0:
+                        record = <_log_record *> _ring_buffer_first(&_log_buffer)
+                        memcpy(buf + length, record, record.size)
+                        length += record.size
+                        _ring_buffer_pop(&_log_buffer)
+                        c_count -= 1
+            pj_mutex_unlock(_log_buffer_lock)
+        if pending and buf == NULL:
+            raise MemoryError()
+        try:
+            while offset < length:
+                record = <_log_record *> (buf + offset)
+                retval.append((record.level, PyString_FromStringAndSize(buf + offset + sizeof(_log_record), record.len)))
+                offset += record.size
+        finally:
+            free(buf)
+        return retval
+
     property tls_verify_server:
 
         def __get__(self):
@@ -756,10 +1220,11 @@ cdef class PJSIPUA:
         self.dealloc()
 
     def dealloc(self):
-        global _ua, _dealloc_handler_queue, _event_queue_lock
+        global _ua, _dealloc_handler_queue, _event_queue_lock, _log_buffer_lock, _ua_tag_lock, _trace_sip, _sip_capture_lock
         if _ua == NULL:
             return
         self._check_thread()
+        _poll_wakeup_destroy()
         pjmedia_aud_dev_set_observer_cb(NULL)
         if self.audio_change_rwlock != NULL:
             pj_rwmutex_destroy(self.audio_change_rwlock)
@@ -767,7 +1232,27 @@ cdef class PJSIPUA:
         if self.video_lock != NULL:
             pj_mutex_destroy(self.video_lock)
             self.video_lock = NULL
+        if self._timer_lock != NULL:
+            pj_mutex_destroy(self._timer_lock)
+            self._timer_lock = NULL
+        _trace_sip = 0
+        if _sip_capture_lock != NULL:
+            pj_mutex_lock(_sip_capture_lock)
+            free(_sip_capture_state.ring.buf)
+            memset(&_sip_capture_state, 0, sizeof(_sip_capture))
+            pj_mutex_destroy(_sip_capture_lock)
+            _sip_capture_lock = NULL
+        if _ua_tag_lock != NULL:
+            pj_mutex_lock(_ua_tag_lock)
+            pj_mutex_destroy(_ua_tag_lock)
+            _ua_tag_lock = NULL
         _process_handler_queue(self, &_dealloc_handler_queue)
+        if _log_buffer_lock != NULL:
+            pj_mutex_lock(_log_buffer_lock)
+            free(_log_buffer.buf)
+            memset(&_log_buffer, 0, sizeof(_ring_buffer))
+            pj_mutex_destroy(_log_buffer_lock)
+            _log_buffer_lock = NULL
         if _event_queue_lock != NULL:
             pj_mutex_lock(_event_queue_lock)
             pj_mutex_destroy(_event_queue_lock)
@@ -780,35 +1265,44 @@ cdef class PJSIPUA:
         self._poll_log()
 
     cdef int _poll_log(self) except -1:
-        cdef object event_name
-        cdef dict event_params
+        # The event handler gets all the events queued since the last call at once, as (name, params) tuples
         cdef list events
         events = _get_clear_event_queue()
-        for event_name, event_params in events:
-            self._event_handler(event_name, **event_params)
+        if events:
+            self._event_handler(events)
+        return 0
 
     def poll(self):
-        global _post_poll_handler_queue
-        cdef int status
-        cdef double now
+        global _post_poll_handler_queue, _poll_thread_ident
         cdef object retval = None
-        cdef float max_timeout
-        cdef pj_time_val pj_max_timeout
-        cdef list timers
         cdef Timer timer
+        cdef unsigned int generation
 
         self._check_self()
+        _poll_thread_ident = PyThread_get_thread_ident()
 
-        max_timeout = 0.100
-        while self._timers:
-            if not (<Timer>self._timers[0])._scheduled:
-                # timer was cancelled
-                heapq.heappop(self._timers)
-            else:
-                max_timeout = min(max((<Timer>self._timers[0]).schedule_time - time.time(), 0.0), max_timeout)
-                break
-        pj_max_timeout.sec = int(max_timeout)
-        pj_max_timeout.msec = int(max_timeout * 1000) % 1000
+        self.handle_events(self._get_poll_timeout())
+        _process_handler_queue(self, &_post_poll_handler_queue)
+
+        for timer, generation in self._get_expired_timers():
+            if timer._scheduled and timer._generation == generation:
+                timer.call()
+        self._process_deferred_timers()
+
+        self._poll_log()
+        if self._fatal_error:
+            return True
+        else:
+            return False
+
+    def handle_events(self, float timeout=0.100):
+        # Only lets PJSIP process network and timer events, without running the post-poll handlers, the core timers
+        # or dispatching the queued events. It can be called from additional threads besides the one calling poll.
+        cdef int status
+        cdef pj_time_val pj_max_timeout
+        self._check_self()
+        pj_max_timeout.sec = int(timeout)
+        pj_max_timeout.msec = int(timeout * 1000) % 1000
         with nogil:
             status = pjsip_endpt_handle_events(self._pjsip_endpoint._obj, &pj_max_timeout)
         IF UNAME_SYSNAME == "Darwin":
@@ -817,28 +1311,42 @@ cdef class PJSIPUA:
         ELSE:
             if status != 0:
                 raise PJSIPError("Error while handling events", status)
-        _process_handler_queue(self, &_post_poll_handler_queue)
 
-        timers = list()
-        now = time.time()
-        while self._timers:
-            if not (<Timer>self._timers[0])._scheduled:
-                # timer was cancelled
-                heapq.heappop(self._timers)
-            elif (<Timer>self._timers[0]).schedule_time <= now:
-                # timer needs to be processed
-                timer = heapq.heappop(self._timers)
-                timers.append(timer)
-            else:
-                break
-        for timer in timers:
-            timer.call()
+    cdef float _get_poll_timeout(self) except -1:
+        cdef float max_timeout = 0.100
+        if self._deferred_timers:
+            return 0.0
+        with nogil:
+            pj_mutex_lock(self._timer_lock)
+        try:
+            max_timeout = self._timers.next_timeout(time.time(), max_timeout)
+        finally:
+            with nogil:
+                pj_mutex_unlock(self._timer_lock)
+        return max_timeout
 
-        self._poll_log()
-        if self._fatal_error:
-            return True
-        else:
-            return False
+    cdef int _process_deferred_timers(self) except -1:
+        # Timers deferred while processing these are left for the next poll, which will not block
+        cdef Timer timer
+        cdef unsigned int generation
+        cdef int count = len(self._deferred_timers)
+        while count > 0:
+            timer, generation = self._deferred_timers.popleft()
+            count -= 1
+            if timer._scheduled and timer._generation == generation:
+                timer.call()
+        return 0
+
+    cdef list _get_expired_timers(self):
+        cdef list timers
+        with nogil:
+            pj_mutex_lock(self._timer_lock)
+        try:
+            timers = self._timers.expire(time.time())
+        finally:
+            with nogil:
+                pj_mutex_unlock(self._timer_lock)
+        return timers
 
     cdef int _handle_exception(self, int is_fatal) except -1:
         cdef object exc_type
@@ -864,12 +1372,120 @@ cdef class PJSIPUA:
         return 0
 
     cdef int _add_timer(self, Timer timer) except -1:
-        heapq.heappush(self._timers, timer)
+        with nogil:
+            pj_mutex_lock(self._timer_lock)
+        try:
+            self._timers.add(timer)
+        finally:
+            with nogil:
+                pj_mutex_unlock(self._timer_lock)
+        _poll_wakeup_signal()
+        return 0
+
+    cdef int _add_deferred_timer(self, Timer timer) except -1:
+        self._deferred_timers.append((timer, timer._generation))
+        _poll_wakeup_signal()
         return 0
 
     cdef int _remove_timer(self, Timer timer) except -1:
-        # Don't remove it from the heap, just mark it as not scheduled
         timer._scheduled = 0
+        if timer._wheel_slot is None:
+            # deferred timers are skipped when their turn comes, as are the ones rescheduled since then
+            return 0
+        with nogil:
+            pj_mutex_lock(self._timer_lock)
+        try:
+            self._timers.remove(timer)
+        finally:
+            with nogil:
+                pj_mutex_unlock(self._timer_lock)
+        return 0
+
+    cdef int _set_trace_sip(self, int enabled) except -1:
+        global _trace_sip
+        _trace_sip = enabled
+        self._update_trace_module()
+        return 0
+
+    cdef int _set_sip_capture_size(self, object size) except -1:
+        cdef char *buf = NULL
+        cdef char *old_buf
+        cdef size_t c_size
+        if size is None or size < 0:
+            raise ValueError("SIP capture size must be a non-negative number")
+        c_size = size
+        if c_size > 0:
+            if c_size < sizeof(_sip_capture_record) + 1024:
+                raise ValueError("SIP capture size is too small")
+            buf = <char *> malloc(c_size)
+            if buf == NULL:
+                raise MemoryError()
+        with nogil:
+            pj_mutex_lock(_sip_capture_lock)
+            old_buf = _sip_capture_state.ring.buf
+            memset(&_sip_capture_state, 0, sizeof(_sip_capture))
+            _sip_capture_state.ring.buf = buf
+            _sip_capture_state.ring.size = c_size
+            pj_mutex_unlock(_sip_capture_lock)
+        free(old_buf)
+        self._update_trace_module()
+        return 0
+
+    cdef int _set_log_buffer_size(self, object size) except -1:
+        cdef char *buf = NULL
+        cdef char *old_buf
+        cdef size_t c_size
+        if size is None or size < 0:
+            raise ValueError("Log buffer size must be a non-negative number")
+        c_size = size
+        if c_size > 0:
+            if c_size < sizeof(_log_record) + 1024:
+                raise ValueError("Log buffer size is too small")
+            buf = <char *> malloc(c_size)
+            if buf == NULL:
+                raise MemoryError()
+        with nogil:
+            pj_mutex_lock(_log_buffer_lock)
+            old_buf = _log_buffer.buf
+            memset(&_log_buffer, 0, sizeof(_ring_buffer))
+            _log_buffer.buf = buf
+            _log_buffer.size = c_size
+            pj_mutex_unlock(_log_buffer_lock)
+        free(old_buf)
+        return 0
+
+    cdef int _set_log_event_level(self, object level) except -1:
+        global _log_event_level
+        if level is None:
+            level = PJ_LOG_MAX_LEVEL
+        if level < 0 or level > PJ_LOG_MAX_LEVEL:
+            raise ValueError("Log event level should be between 0 and %d" % PJ_LOG_MAX_LEVEL)
+        _log_event_level = level
+        return 0
+
+    cdef int _update_trace_module(self) except -1:
+        # The trace module is only registered while tracing or capturing is enabled, so that it costs nothing otherwise
+        cdef int status
+        if _trace_sip or _sip_capture_state.ring.buf != NULL:
+            if self._trace_module.id == -1:
+                status = pjsip_endpt_register_module(self._pjsip_endpoint._obj, &self._trace_module)
+                if status != 0:
+                    raise PJSIPError("Could not load sip trace module", status)
+        elif self._trace_module.id != -1:
+            status = pjsip_endpt_unregister_module(self._pjsip_endpoint._obj, &self._trace_module)
+            if status != 0:
+                raise PJSIPError("Could not unload sip trace module", status)
+        return 0
+
+    cdef int _set_user_agent(self, object user_agent) except -1:
+        global _ua_tag_value
+        cdef PJSTR value = PJSTR(user_agent)
+        with nogil:
+            pj_mutex_lock(_ua_tag_lock)
+        _ua_tag_value = value.pj_str
+        self._user_agent = value
+        with nogil:
+            pj_mutex_unlock(_ua_tag_lock)
         return 0
 
     cdef int _cb_rx_request(self, pjsip_rx_data *rdata) except 0:
@@ -1055,154 +1671,165 @@ cdef int _PJSIPUA_cb_rx_request(pjsip_rx_data *rdata) with gil:
     except:
         ua._handle_exception(0)
 
-cdef int _cb_opus_fix_tx(pjsip_tx_data *tdata) with gil:
-    cdef PJSIPUA ua
+# The following callbacks are invoked for every SIP message, so they do all their work without the GIL and
+# only acquire it when an event needs to be reported.
+
+cdef int _cb_opus_fix_tx(pjsip_tx_data *tdata) nogil:
     cdef pjsip_msg_body *body
-    cdef pjsip_msg_body *new_body
+    cdef pjsip_msg_body *new_body = NULL
     cdef pjmedia_sdp_session *sdp
     cdef pjmedia_sdp_media *media
     cdef pjmedia_sdp_attr *attr
     cdef int i
     cdef int j
+    cdef int k
+    cdef int pos
     cdef pj_str_t new_value
-    try:
-        ua = _get_ua()
-    except:
+    if _ua == NULL or tdata == NULL or tdata.msg == NULL:
         return 0
-    try:
-        if tdata != NULL and tdata.msg != NULL:
-            body = tdata.msg.body
-            if body != NULL and _pj_str_to_str(body.content_type.type).lower() == "application" and _pj_str_to_str(body.content_type.subtype).lower() == "sdp":
+    body = tdata.msg.body
+    if not _is_sdp_body(body):
+        return 0
+    sdp = <pjmedia_sdp_session *> body.data
+    for i in range(sdp.media_count):
+        media = sdp.media[i]
+        if pj_stricmp2(&media.desc.media, "audio") != 0:
+            continue
+        for j in range(media.attr_count):
+            attr = media.attr[j]
+            if pj_stricmp2(&attr.name, "rtpmap") != 0:
+                continue
+            pos = _find_nocase(attr.value.ptr, attr.value.slen, "opus", 4)
+            if pos == -1:
+                continue
+            # this is the opus rtpmap attribute, the body is only cloned the first time one is found
+            if new_body == NULL:
                 new_body = pjsip_msg_body_clone(tdata.pool, body)
                 sdp = <pjmedia_sdp_session *> new_body.data
-                for i in range(sdp.media_count):
-                    media = sdp.media[i]
-                    if _pj_str_to_str(media.desc.media).lower() != "audio":
-                        continue
-                    for j in range(media.attr_count):
-                        attr = media.attr[j]
-                        if _pj_str_to_str(attr.name).lower() != "rtpmap":
-                            continue
-                        attr_value = _pj_str_to_str(attr.value).lower()
-                        pos = attr_value.find("opus")
-                        if pos == -1:
-                            continue
-                        # this is the opus rtpmap attribute
-                        opus_line = attr_value[:pos] + "opus/48000/2"
-                        new_value.slen = len(opus_line)
-                        new_value.ptr = <char *> pj_pool_alloc(tdata.pool, new_value.slen)
-                        memcpy(new_value.ptr, PyString_AsString(opus_line), new_value.slen)
-                        attr.value = new_value
-                        break
-                tdata.msg.body = new_body
-    except:
-        ua._handle_exception(0)
+                media = sdp.media[i]
+                attr = media.attr[j]
+            new_value.slen = pos + 12
+            new_value.ptr = <char *> pj_pool_alloc(tdata.pool, new_value.slen)
+            for k in range(pos):
+                new_value.ptr[k] = _ascii_lower(attr.value.ptr[k])
+            memcpy(new_value.ptr + pos, "opus/48000/2", 12)
+            attr.value = new_value
+            break
+    if new_body != NULL:
+        tdata.msg.body = new_body
     return 0
 
-cdef int _cb_opus_fix_rx(pjsip_rx_data *rdata) with gil:
-    cdef PJSIPUA ua
+cdef int _cb_opus_fix_rx(pjsip_rx_data *rdata) nogil:
     cdef pjsip_msg_body *body
     cdef int pos1
     cdef int pos2
     cdef char *body_ptr
-    try:
-        ua = _get_ua()
-    except:
+    if _ua == NULL or rdata == NULL or rdata.msg_info.msg == NULL:
         return 0
-    try:
-        if rdata != NULL and rdata.msg_info.msg != NULL:
-            body = rdata.msg_info.msg.body
-            if body != NULL and _pj_str_to_str(body.content_type.type).lower() == "application" and _pj_str_to_str(body.content_type.subtype).lower() == "sdp":
-                body_ptr = <char*>body.data
-                body_str = PyString_FromStringAndSize(body_ptr, body.len).lower()
-                pos1 = body_str.find("opus/48000")
-                if pos1 != -1:
-                    pos2 = body_str.find("opus/48000/2")
-                    if pos2 != -1:
-                        memcpy(body_ptr + pos2 + 11, '1', 1)
-                    else:
-                        # old opus, we must make it fail
-                        memcpy(body_ptr + pos1 + 5, 'XXXXX', 5)
-    except:
-        ua._handle_exception(0)
+    body = rdata.msg_info.msg.body
+    if not _is_sdp_body(body):
+        return 0
+    body_ptr = <char *> body.data
+    pos1 = _find_nocase(body_ptr, body.len, "opus/48000", 10)
+    if pos1 != -1:
+        pos2 = _find_nocase(body_ptr + pos1, body.len - pos1, "opus/48000/2", 12)
+        if pos2 != -1:
+            memcpy(body_ptr + pos1 + pos2 + 11, '1', 1)
+        else:
+            # old opus, we must make it fail
+            memcpy(body_ptr + pos1 + 5, 'XXXXX', 5)
     return 0
 
-cdef int _cb_trace_rx(pjsip_rx_data *rdata) with gil:
+cdef int _cb_trace_rx(pjsip_rx_data *rdata) nogil:
+    cdef pj_str_t src_host
+    if _sip_capture_state.ring.buf != NULL:
+        src_host.ptr = rdata.pkt_info.src_name
+        src_host.slen = strlen(rdata.pkt_info.src_name)
+        # on stream transports the packet may hold more than this message, so only the message itself is captured
+        _sip_capture_add(rdata.tp_info.transport, &src_host, rdata.pkt_info.src_port,
+                         &rdata.tp_info.transport.local_name.host, rdata.tp_info.transport.local_name.port,
+                         rdata.msg_info.msg_buf, rdata.msg_info.len)
+    if _trace_sip:
+        _trace_rx_event(rdata)
+    return 0
+
+cdef int _cb_trace_tx(pjsip_tx_data *tdata) nogil:
+    cdef pj_str_t dst_host
+    if _sip_capture_state.ring.buf != NULL:
+        dst_host.ptr = tdata.tp_info.dst_name
+        dst_host.slen = strlen(tdata.tp_info.dst_name)
+        _sip_capture_add(tdata.tp_info.transport, &tdata.tp_info.transport.local_name.host, tdata.tp_info.transport.local_name.port,
+                         &dst_host, tdata.tp_info.dst_port, tdata.buf.start, tdata.buf.cur - tdata.buf.start)
+    if _trace_sip:
+        _trace_tx_event(tdata)
+    return 0
+
+cdef void _trace_rx_event(pjsip_rx_data *rdata) with gil:
     cdef PJSIPUA ua
     try:
         ua = _get_ua()
     except:
-        return 0
+        return
     try:
-        if ua._trace_sip:
-            _add_event("SIPEngineSIPTrace",
-                        dict(received=True, source_ip=rdata.pkt_info.src_name, source_port=rdata.pkt_info.src_port,
-                             destination_ip=_pj_str_to_str(rdata.tp_info.transport.local_name.host),
-                             destination_port=rdata.tp_info.transport.local_name.port,
-                             data=PyString_FromStringAndSize(rdata.pkt_info.packet, rdata.pkt_info.len),
-                             transport=rdata.tp_info.transport.type_name))
+        _add_event("SIPEngineSIPTrace",
+                    dict(received=True, source_ip=rdata.pkt_info.src_name, source_port=rdata.pkt_info.src_port,
+                         destination_ip=_pj_str_to_str(rdata.tp_info.transport.local_name.host),
+                         destination_port=rdata.tp_info.transport.local_name.port,
+                         data=PyString_FromStringAndSize(rdata.pkt_info.packet, rdata.pkt_info.len),
+                         transport=rdata.tp_info.transport.type_name))
     except:
         ua._handle_exception(0)
-    return 0
 
-cdef int _cb_trace_tx(pjsip_tx_data *tdata) with gil:
+cdef void _trace_tx_event(pjsip_tx_data *tdata) with gil:
     cdef PJSIPUA ua
     try:
         ua = _get_ua()
     except:
-        return 0
+        return
     try:
-        if ua._trace_sip:
-            _add_event("SIPEngineSIPTrace",
-                        dict(received=False,
-                             source_ip=_pj_str_to_str(tdata.tp_info.transport.local_name.host),
-                             source_port=tdata.tp_info.transport.local_name.port, destination_ip=tdata.tp_info.dst_name,
-                             destination_port=tdata.tp_info.dst_port,
-                             data=PyString_FromStringAndSize(tdata.buf.start, tdata.buf.cur - tdata.buf.start),
-                             transport=tdata.tp_info.transport.type_name))
+        _add_event("SIPEngineSIPTrace",
+                    dict(received=False,
+                         source_ip=_pj_str_to_str(tdata.tp_info.transport.local_name.host),
+                         source_port=tdata.tp_info.transport.local_name.port, destination_ip=tdata.tp_info.dst_name,
+                         destination_port=tdata.tp_info.dst_port,
+                         data=PyString_FromStringAndSize(tdata.buf.start, tdata.buf.cur - tdata.buf.start),
+                         transport=tdata.tp_info.transport.type_name))
     except:
         ua._handle_exception(0)
+
+cdef int _cb_add_user_agent_hdr(pjsip_tx_data *tdata) nogil:
+    if _add_ua_tag_hdr(tdata, &_user_agent_hdr_name_pj) != 0:
+        _ua_tag_error('Could not add "User-Agent" header to outgoing request')
     return 0
 
-cdef int _cb_add_user_agent_hdr(pjsip_tx_data *tdata) with gil:
-    cdef PJSIPUA ua
+cdef int _cb_add_server_hdr(pjsip_tx_data *tdata) nogil:
+    if _add_ua_tag_hdr(tdata, &_server_hdr_name_pj) != 0:
+        _ua_tag_error('Could not add "Server" header to outgoing response')
+    return 0
+
+cdef int _add_ua_tag_hdr(pjsip_tx_data *tdata, pj_str_t *name) nogil:
     cdef pjsip_hdr *hdr
-    cdef void *found_hdr
-    try:
-        ua = _get_ua()
-    except:
+    if _ua_tag_lock == NULL or pjsip_msg_find_hdr_by_name(tdata.msg, name, NULL) != NULL:
         return 0
-    try:
-        found_hdr = pjsip_msg_find_hdr_by_name(tdata.msg, &_user_agent_hdr_name.pj_str, NULL)
-        if found_hdr == NULL:
-            hdr = <pjsip_hdr *> pjsip_generic_string_hdr_create(tdata.pool, &_user_agent_hdr_name.pj_str,
-                                                                &ua._user_agent.pj_str)
-            if hdr == NULL:
-                raise SIPCoreError('Could not add "User-Agent" header to outgoing request')
-            pjsip_msg_add_hdr(tdata.msg, hdr)
-    except:
-        ua._handle_exception(0)
+    # the header value is copied into the message pool, so it is only needed while holding the lock
+    pj_mutex_lock(_ua_tag_lock)
+    hdr = <pjsip_hdr *> pjsip_generic_string_hdr_create(tdata.pool, name, &_ua_tag_value)
+    pj_mutex_unlock(_ua_tag_lock)
+    if hdr == NULL:
+        return -1
+    pjsip_msg_add_hdr(tdata.msg, hdr)
     return 0
 
-cdef int _cb_add_server_hdr(pjsip_tx_data *tdata) with gil:
+cdef void _ua_tag_error(char *message) with gil:
     cdef PJSIPUA ua
-    cdef pjsip_hdr *hdr
-    cdef void *found_hdr
     try:
         ua = _get_ua()
     except:
-        return 0
+        return
     try:
-        found_hdr = pjsip_msg_find_hdr_by_name(tdata.msg, &_server_hdr_name.pj_str, NULL)
-        if found_hdr == NULL:
-            hdr = <pjsip_hdr *> pjsip_generic_string_hdr_create(tdata.pool, &_server_hdr_name.pj_str,
-                                                                &ua._user_agent.pj_str)
-            if hdr == NULL:
-                raise SIPCoreError('Could not add "Server" header to outgoing response')
-            pjsip_msg_add_hdr(tdata.msg, hdr)
+        raise SIPCoreError(message)
     except:
         ua._handle_exception(0)
-    return 0
 
 # functions
 
@@ -1218,11 +1845,192 @@ cdef PJSIPUA _get_ua():
 cdef int deallocate_weakref(object weak_ref, object timer) except -1 with gil:
     Py_DECREF(weak_ref)
 
+cdef int _sip_capture_add(pjsip_transport *transport, pj_str_t *src_host, int src_port, pj_str_t *dst_host, int dst_port, char *data, int length) nogil:
+    # Store a packet in the SIP capture ring buffer, evicting the oldest packets if there is not enough room. Packets
+    # whose addresses are not IP addresses of the transport's family cannot be represented in the capture and are skipped.
+    cdef _sip_capture *capture = &_sip_capture_state
+    cdef _sip_capture_record record
+    cdef pj_time_val now
+    cdef char *buf
+    cdef size_t size
+    cdef int af
+    if length < 0:
+        return -1
+    if length > _SIP_CAPTURE_MAX_PAYLOAD:
+        length = _SIP_CAPTURE_MAX_PAYLOAD
+    pj_gettimeofday(&now)
+    memset(&record, 0, sizeof(_sip_capture_record))
+    record.sec = now.sec
+    record.msec = now.msec
+    af = transport.local_addr.addr.sa_family
+    record.ipv6 = af == pj_AF_INET6()
+    record.reliable = (transport.flag & PJSIP_TRANSPORT_RELIABLE) != 0
+    if pj_inet_pton(af, src_host, record.src_addr) != 0 or pj_inet_pton(af, dst_host, record.dst_addr) != 0:
+        return -1
+    record.src_port = src_port
+    record.dst_port = dst_port
+    record.len = length
+    size = (sizeof(_sip_capture_record) + length + 7) & ~(<size_t> 7)
+    record.size = size
+    pj_mutex_lock(_sip_capture_lock)
+    if capture.ring.buf == NULL:
+        pj_mutex_unlock(_sip_capture_lock)
+        return 0
+    capture.packets += 1
+    buf = _ring_buffer_reserve(&capture.ring, size)
+    if buf == NULL:
+        pj_mutex_unlock(_sip_capture_lock)
+        return -1
+    memcpy(buf, &record, sizeof(_sip_capture_record))
+    memcpy(buf + sizeof(_sip_capture_record), data, length)
+    pj_mutex_unlock(_sip_capture_lock)
+    return 0
+
+cdef void _sip_capture_copy(_sip_capture *capture, char *buf, pj_time_val *start, size_t *length, unsigned int *count) nogil:
+    # Copy all records not older than start to buf in chronological order. Must be called with the capture lock held.
+    cdef _ring_buffer *ring = &capture.ring
+    cdef _sip_capture_record *record
+    cdef size_t offset = ring.head
+    cdef size_t end = ring.wrap if ring.wrapped else ring.tail
+    cdef unsigned int i
+    length[0] = 0
+    count[0] = 0
+    for i in range(ring.count):
+        if offset == end:
+            offset = 0
+            end = ring.tail
+        record = <_sip_capture_record *> (ring.buf + offset)
+        if record.sec > start.sec or (record.sec == start.sec and record.msec >= start.msec):
+            memcpy(buf + length[0], record, record.size)
+            length[0] += record.size
+            count[0] += 1
+        offset += record.size
+
+cdef int _sip_capture_write_pcap(char *filename, char *buf, size_t length) nogil:
+    # Write the records as a pcap file with raw IP link type, wrapping each SIP message in an IPv4 or IPv6 header and
+    # in a UDP or TCP header. Messages sent over TLS are written decrypted, as TCP. The TCP sequence numbers are made
+    # up from the number of bytes written so far, the real ones are not known at this level, and the UDP and TCP
+    # checksums are left out.
+    cdef FILE *output
+    cdef _sip_capture_record *record
+    cdef size_t offset = 0
+    cdef _pcap_file_header file_header
+    cdef unsigned int packet_header[4]
+    cdef unsigned char headers[60]
+    cdef unsigned char *transport_header
+    cdef unsigned int ip_header_len
+    cdef unsigned int transport_header_len
+    cdef unsigned int checksum
+    cdef unsigned int tcp_seq = 1
+    cdef int i
+    output = fopen(filename, "wb")
+    if output == NULL:
+        return -1
+    file_header.magic = 0xa1b2c3d4
+    file_header.version_major = 2
+    file_header.version_minor = 4
+    file_header.thiszone = 0
+    file_header.sigfigs = 0
+    file_header.snaplen = 65535
+    file_header.network = 101 # LINKTYPE_RAW
+    if fwrite(&file_header, sizeof(_pcap_file_header), 1, output) != 1:
+        fclose(output)
+        return -1
+    while offset < length:
+        record = <_sip_capture_record *> (buf + offset)
+        ip_header_len = 40 if record.ipv6 else 20
+        transport_header_len = 20 if record.reliable else 8
+        memset(headers, 0, 60)
+        if record.ipv6:
+            headers[0] = 0x60
+            headers[4] = ((record.len + transport_header_len) >> 8) & 0xff
+            headers[5] = (record.len + transport_header_len) & 0xff
+            headers[6] = 6 if record.reliable else 17
+            headers[7] = 64
+            memcpy(headers + 8, record.src_addr, 16)
+            memcpy(headers + 24, record.dst_addr, 16)
+        else:
+            headers[0] = 0x45
+            headers[2] = ((record.len + 20 + transport_header_len) >> 8) & 0xff
+            headers[3] = (record.len + 20 + transport_header_len) & 0xff
+            headers[6] = 0x40
+            headers[8] = 64
+            headers[9] = 6 if record.reliable else 17
+            memcpy(headers + 12, record.src_addr, 4)
+            memcpy(headers + 16, record.dst_addr, 4)
+            checksum = 0
+            for i in range(0, 20, 2):
+                checksum += (headers[i] << 8) | headers[i + 1]
+            while checksum >> 16:
+                checksum = (checksum & 0xffff) + (checksum >> 16)
+            checksum = ~checksum & 0xffff
+            headers[10] = checksum >> 8
+            headers[11] = checksum & 0xff
+        transport_header = headers + ip_header_len
+        transport_header[0] = record.src_port >> 8
+        transport_header[1] = record.src_port & 0xff
+        transport_header[2] = record.dst_port >> 8
+        transport_header[3] = record.dst_port & 0xff
+        if record.reliable:
+            transport_header[4] = (tcp_seq >> 24) & 0xff
+            transport_header[5] = (tcp_seq >> 16) & 0xff
+            transport_header[6] = (tcp_seq >> 8) & 0xff
+            transport_header[7] = tcp_seq & 0xff
+            transport_header[12] = 0x50 # header length of 5 words
+            transport_header[13] = 0x18 # PSH, ACK
+            transport_header[14] = transport_header[15] = 0xff
+            tcp_seq += record.len
+        else:
+            transport_header[4] = ((record.len + 8) >> 8) & 0xff
+            transport_header[5] = (record.len + 8) & 0xff
+        packet_header[0] = record.sec
+        packet_header[1] = record.msec * 1000
+        packet_header[2] = packet_header[3] = record.len + ip_header_len + transport_header_len
+        if (fwrite(packet_header, sizeof(packet_header), 1, output) != 1 or
+            fwrite(headers, ip_header_len + transport_header_len, 1, output) != 1 or
+            (record.len > 0 and fwrite(buf + offset + sizeof(_sip_capture_record), record.len, 1, output) != 1)):
+            fclose(output)
+            return -1
+        offset += record.size
+    if fclose(output) != 0:
+        return -1
+    return 0
+
+cdef int _is_sdp_body(pjsip_msg_body *body) nogil:
+    return body != NULL and pj_stricmp2(&body.content_type.type, "application") == 0 and pj_stricmp2(&body.content_type.subtype, "sdp") == 0
+
+cdef inline char _ascii_lower(char c) nogil:
+    if c >= 'A' and c <= 'Z':
+        return c + 32
+    return c
+
+cdef int _find_nocase(char *buf, int buf_len, char *needle, int needle_len) nogil:
+    # needle must be lowercase
+    cdef int i
+    cdef int j
+    for i in range(buf_len - needle_len + 1):
+        for j in range(needle_len):
+            if _ascii_lower(buf[i + j]) != needle[j]:
+                break
+        else:
+            return i
+    return -1
+
 
 # globals
 
 cdef void *_ua = NULL
+cdef int _trace_sip = 0
+cdef pj_mutex_t *_sip_capture_lock = NULL
+cdef _sip_capture _sip_capture_state
+memset(&_sip_capture_state, 0, sizeof(_sip_capture))
+cdef enum:
+    _SIP_CAPTURE_MAX_PAYLOAD = 65535 - 60 # room for an IPv4 and a TCP header
+cdef pj_mutex_t *_ua_tag_lock = NULL
+cdef pj_str_t _ua_tag_value
 cdef PJSTR _user_agent_hdr_name = PJSTR("User-Agent")
 cdef PJSTR _server_hdr_name = PJSTR("Server")
+cdef pj_str_t _user_agent_hdr_name_pj = _user_agent_hdr_name.pj_str
+cdef pj_str_t _server_hdr_name_pj = _server_hdr_name.pj_str
 cdef PJSTR _event_hdr_name = PJSTR("Event")
 cdef object _re_ipv4 = re.compile(r"^(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})$")
@@ -4,6 +4,8 @@ import re
 import sys
 
 from application.version import Version
+from collections import OrderedDict
+from threading import Lock
 
 
 cdef class PJSTR:
@@ -154,8 +156,118 @@ cdef class frozendict:
         return self.dict.values()
 
 
+cdef class _LRUCache:
+    # A bounded mapping which drops the least recently used entries when it grows beyond its size. It can be used
+    # from several threads.
+    def __cinit__(self, int size):
+        if size < 1:
+            raise ValueError("size must be a positive number")
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    cdef object get(self, object key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    cdef int set(self, object key, object value) except -1:
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        return 0
+
+    cdef int clear(self) except -1:
+        with self._lock:
+            self._data.clear()
+        return 0
+
+
+# C types
+
+cdef struct _ring_buffer_record:
+    unsigned int size
+
+cdef struct _ring_buffer:
+    char *buf
+    size_t size
+    size_t head
+    size_t tail
+    size_t wrap
+    int wrapped
+    unsigned int count
+    unsigned long dropped
+    unsigned long evicted
+
+
 # functions
 
+cdef char *_ring_buffer_reserve(_ring_buffer *ring, size_t size) nogil:
+    # Make room at the end of the ring for a record of the given size, which includes the record header and must be a
+    # multiple of 8, evicting the oldest records if needed. Records are never split, so if one doesn't fit at the end
+    # of the buffer writing continues at the start. Returns NULL if the record is larger than the whole buffer.
+    cdef char *record
+    if ring.buf == NULL:
+        return NULL
+    if size > ring.size:
+        ring.dropped += 1
+        return NULL
+    if ring.count == 0:
+        ring.head = ring.tail = ring.wrap = 0
+        ring.wrapped = 0
+    while True:
+        if not ring.wrapped:
+            if ring.size - ring.tail >= size:
+                break
+            ring.wrap = ring.tail
+            ring.tail = 0
+            ring.wrapped = 1
+        elif ring.head - ring.tail >= size:
+            break
+        else:
+            _ring_buffer_pop(ring)
+            ring.evicted += 1
+    record = ring.buf + ring.tail
+    (<_ring_buffer_record *> record).size = size
+    ring.tail += size
+    ring.count += 1
+    return record
+
+cdef char *_ring_buffer_first(_ring_buffer *ring) nogil:
+    if ring.count == 0:
+        return NULL
+    return ring.buf + ring.head
+
+cdef void _ring_buffer_pop(_ring_buffer *ring) nogil:
+    if ring.count == 0:
+        return
+    ring.head += (<_ring_buffer_record *> (ring.buf + ring.head)).size
+    ring.count -= 1
+    if ring.wrapped and ring.head == ring.wrap:
+        ring.head = 0
+        ring.wrapped = 0
+
+cdef size_t _ring_buffer_used(_ring_buffer *ring) nogil:
+    if ring.count == 0:
+        return 0
+    elif ring.wrapped:
+        return ring.wrap - ring.head + ring.tail
+    else:
+        return ring.tail - ring.head
+
 cdef int _str_to_pj_str(object string, pj_str_t *pj_str) except -1:
     pj_str.ptr = PyString_AsString(string)
     pj_str.slen = len(string)
@@ -196,84 +308,228 @@ cdef int _dict_to_pjsip_param(object params, pjsip_param *param_list, pj_pool_t
         pj_list_insert_after(<pj_list *> param_list, <pj_list *> param)
     return 0
 
-cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1:
-    cdef pjsip_msg_body *body
-    cdef pjsip_hdr *header
+cdef class SIPMessageHeaders:
+    # A read-only mapping over the headers of a SIP message. The message is cloned into a private memory pool
+    # and each header is only converted to its Python representation the first time it is looked up. The pool is
+    # held for as long as the mapping is referenced, unless all the headers get converted, when it is released.
+
+    def __init__(self, *args, **kwargs):
+        raise TypeError("SIPMessageHeaders cannot be instantiated directly")
+
+    def __dealloc__(self):
+        cdef PJSIPUA ua
+        try:
+            ua = _get_ua()
+        except:
+            return
+        ua.release_memory_pool(self._pool)
+        self._pool = NULL
+        self._msg = NULL
+
+    def __repr__(self):
+        return "SIPMessageHeaders(%r)" % self._get_all()
+
+    def __len__(self):
+        return len(self._get_all())
+
+    def __iter__(self):
+        return iter(self._get_all())
+
+    def __contains__(self, name):
+        return self._get_header(name) is not None
+
+    def __getitem__(self, name):
+        cdef object value = self._get_header(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __richcmp__(SIPMessageHeaders self, other, op):
+        if isinstance(other, SIPMessageHeaders):
+            other = (<SIPMessageHeaders>other)._get_all()
+        if op == 2:
+            return self._get_all() == other
+        elif op == 3:
+            return self._get_all() != other
+        else:
+            return NotImplemented
+
+    def copy(self):
+        return self._get_all().copy()
+
+    def get(self, name, default=None):
+        cdef object value = self._get_header(name)
+        if value is None:
+            return default
+        return value
+
+    def has_key(self, name):
+        return self._get_header(name) is not None
+
+    def items(self):
+        return self._get_all().items()
+
+    def iteritems(self):
+        return self._get_all().iteritems()
+
+    def iterkeys(self):
+        return self._get_all().iterkeys()
+
+    def itervalues(self):
+        return self._get_all().itervalues()
+
+    def keys(self):
+        return self._get_all().keys()
+
+    def values(self):
+        return self._get_all().values()
+
+    cdef object _get_header(self, object name):
+        cdef pjsip_hdr *header
+        cdef object header_data
+        cdef object value
+        cdef char *c_name
+        cdef int c_name_len
+        if self._headers is not None or self._msg == NULL:
+            return self._get_all().get(name, None)
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        except TypeError:
+            return None
+        if not isinstance(name, str):
+            return None
+        c_name = PyString_AsString(name)
+        c_name_len = PyString_Size(name)
+        value = None
+        header = <pjsip_hdr *> (<pj_list *> &self._msg.hdr).next
+        while header != &self._msg.hdr:
+            if header.name.slen == c_name_len and memcmp(header.name.ptr, c_name, c_name_len) == 0:
+                header_data = _pjsip_hdr_to_object(header, name)
+                if header_data is not None:
+                    if name in _multi_headers:
+                        if value is None:
+                            value = []
+                        value.append(header_data)
+                    else:
+                        value = header_data
+                        break
+            header = <pjsip_hdr *> (<pj_list *> header).next
+        self._cache[name] = value
+        return value
+
+    cdef dict _get_all(self):
+        cdef PJSIPUA ua
+        if self._headers is None:
+            self._headers = _pjsip_msg_headers_to_dict(self._msg) if self._msg != NULL else dict()
+            self._cache = None
+            # the message is not needed anymore
+            self._msg = NULL
+            try:
+                ua = _get_ua()
+            except SIPCoreError:
+                pass
+            else:
+                ua.release_memory_pool(self._pool)
+                self._pool = NULL
+        return self._headers
+
+
+cdef SIPMessageHeaders SIPMessageHeaders_create(pjsip_msg *msg):
+    cdef SIPMessageHeaders headers
+    cdef PJSIPUA ua
+    cdef bytes pool_name
+    ua = _get_ua()
+    headers = SIPMessageHeaders.__new__(SIPMessageHeaders)
+    pool_name = b"SIPMessageHeaders_%d" % id(headers)
+    headers._pool = ua.create_memory_pool(pool_name, 4096, 4096)
+    headers._msg = pjsip_msg_clone(headers._pool, msg)
+    headers._cache = dict()
+    headers._headers = None
+    return headers
+
+
+cdef object _pjsip_hdr_to_object(pjsip_hdr *header, object header_name):
     cdef pjsip_generic_array_hdr *array_header
-    cdef pjsip_ctype_hdr *ctype_header
     cdef pjsip_cseq_hdr *cseq_header
-    cdef char *buf
-    cdef int buf_len, i, status
-    headers = {}
+    cdef int i
+    header_data = None
+    if header_name in ("Accept", "Allow", "Require", "Supported", "Unsupported", "Allow-Events"):
+        array_header = <pjsip_generic_array_hdr *> header
+        header_data = []
+        for i from 0 <= i < array_header.count:
+            header_data.append(_pj_str_to_str(array_header.values[i]))
+    elif header_name == "Contact":
+        header_data = FrozenContactHeader_create(<pjsip_contact_hdr *> header)
+    elif header_name == "Content-Length":
+        header_data = (<pjsip_clen_hdr *> header).len
+    elif header_name == "Content-Type":
+        header_data = FrozenContentTypeHeader_create(<pjsip_ctype_hdr *> header)
+    elif header_name == "CSeq":
+        cseq_header = <pjsip_cseq_hdr *> header
+        header_data = (cseq_header.cseq, _pj_str_to_str(cseq_header.method.name))
+    elif header_name in ("Expires", "Max-Forwards", "Min-Expires"):
+        header_data = (<pjsip_generic_int_hdr *> header).ivalue
+    elif header_name == "From":
+        header_data = FrozenFromHeader_create(<pjsip_fromto_hdr *> header)
+    elif header_name == "To":
+        header_data = FrozenToHeader_create(<pjsip_fromto_hdr *> header)
+    elif header_name == "Route":
+        header_data = FrozenRouteHeader_create(<pjsip_routing_hdr *> header)
+    elif header_name == "Reason":
+        value = _pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue)
+        protocol, sep, params_str = value.partition(';')
+        params = frozendict([(name, value or None) for name, sep, value in [param.partition('=') for param in params_str.split(';')]])
+        header_data = FrozenReasonHeader(protocol, params)
+    elif header_name == "Record-Route":
+        header_data = FrozenRecordRouteHeader_create(<pjsip_routing_hdr *> header)
+    elif header_name == "Retry-After":
+        header_data = FrozenRetryAfterHeader_create(<pjsip_retry_after_hdr *> header)
+    elif header_name == "Via":
+        header_data = FrozenViaHeader_create(<pjsip_via_hdr *> header)
+    elif header_name == "Warning":
+        match = _re_warning_hdr.match(_pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue))
+        if match is not None:
+            warning_params = match.groupdict()
+            warning_params['code'] = int(warning_params['code'])
+            header_data = FrozenWarningHeader(**warning_params)
+    elif header_name == "Event":
+        header_data = FrozenEventHeader_create(<pjsip_event_hdr *> header)
+    elif header_name == "Subscription-State":
+        header_data = FrozenSubscriptionStateHeader_create(<pjsip_sub_state_hdr *> header)
+    elif header_name == "Refer-To":
+        header_data = FrozenReferToHeader_create(<pjsip_generic_string_hdr *> header)
+    elif header_name == "Subject":
+        header_data = FrozenSubjectHeader_create(<pjsip_generic_string_hdr *> header)
+    elif header_name == "Replaces":
+        header_data = FrozenReplacesHeader_create(<pjsip_replaces_hdr *> header)
+    # skip the following headers:
+    elif header_name not in ("Authorization", "Proxy-Authenticate", "Proxy-Authorization", "WWW-Authenticate"):
+        header_data = FrozenHeader(header_name, _pj_str_to_str((<pjsip_generic_string_hdr *> header).hvalue))
+    return header_data
+
+cdef dict _pjsip_msg_headers_to_dict(pjsip_msg *msg):
+    cdef pjsip_hdr *header
+    cdef dict headers = {}
     header = <pjsip_hdr *> (<pj_list *> &msg.hdr).next
     while header != &msg.hdr:
         header_name = _pj_str_to_str(header.name)
-        header_data = None
-        multi_header = False
-        if header_name in ("Accept", "Allow", "Require", "Supported", "Unsupported", "Allow-Events"):
-            array_header = <pjsip_generic_array_hdr *> header
-            header_data = []
-            for i from 0 <= i < array_header.count:
-                header_data.append(_pj_str_to_str(array_header.values[i]))
-        elif header_name == "Contact":
-            multi_header = True
-            header_data = FrozenContactHeader_create(<pjsip_contact_hdr *> header)
-        elif header_name == "Content-Length":
-            header_data = (<pjsip_clen_hdr *> header).len
-        elif header_name == "Content-Type":
-            header_data = FrozenContentTypeHeader_create(<pjsip_ctype_hdr *> header)
-        elif header_name == "CSeq":
-            cseq_header = <pjsip_cseq_hdr *> header
-            header_data = (cseq_header.cseq, _pj_str_to_str(cseq_header.method.name))
-        elif header_name in ("Expires", "Max-Forwards", "Min-Expires"):
-            header_data = (<pjsip_generic_int_hdr *> header).ivalue
-        elif header_name == "From":
-            header_data = FrozenFromHeader_create(<pjsip_fromto_hdr *> header)
-        elif header_name == "To":
-            header_data = FrozenToHeader_create(<pjsip_fromto_hdr *> header)
-        elif header_name == "Route":
-            multi_header = True
-            header_data = FrozenRouteHeader_create(<pjsip_routing_hdr *> header)
-        elif header_name == "Reason":
-            value = _pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue)
-            protocol, sep, params_str = value.partition(';')
-            params = frozendict([(name, value or None) for name, sep, value in [param.partition('=') for param in params_str.split(';')]])
-            header_data = FrozenReasonHeader(protocol, params)
-        elif header_name == "Record-Route":
-            multi_header = True
-            header_data = FrozenRecordRouteHeader_create(<pjsip_routing_hdr *> header)
-        elif header_name == "Retry-After":
-            header_data = FrozenRetryAfterHeader_create(<pjsip_retry_after_hdr *> header)
-        elif header_name == "Via":
-            multi_header = True
-            header_data = FrozenViaHeader_create(<pjsip_via_hdr *> header)
-        elif header_name == "Warning":
-            match = _re_warning_hdr.match(_pj_str_to_str((<pjsip_generic_string_hdr *>header).hvalue))
-            if match is not None:
-                warning_params = match.groupdict()
-                warning_params['code'] = int(warning_params['code'])
-                header_data = FrozenWarningHeader(**warning_params)
-        elif header_name == "Event":
-            header_data = FrozenEventHeader_create(<pjsip_event_hdr *> header)
-        elif header_name == "Subscription-State":
-            header_data = FrozenSubscriptionStateHeader_create(<pjsip_sub_state_hdr *> header)
-        elif header_name == "Refer-To":
-            header_data = FrozenReferToHeader_create(<pjsip_generic_string_hdr *> header)
-        elif header_name == "Subject":
-            header_data = FrozenSubjectHeader_create(<pjsip_generic_string_hdr *> header)
-        elif header_name == "Replaces":
-            header_data = FrozenReplacesHeader_create(<pjsip_replaces_hdr *> header)
-        # skip the following headers:
-        elif header_name not in ("Authorization", "Proxy-Authenticate", "Proxy-Authorization", "WWW-Authenticate"):
-            header_data = FrozenHeader(header_name, _pj_str_to_str((<pjsip_generic_string_hdr *> header).hvalue))
+        header_data = _pjsip_hdr_to_object(header, header_name)
         if header_data is not None:
-            if multi_header:
+            if header_name in _multi_headers:
                 headers.setdefault(header_name, []).append(header_data)
             else:
                 if header_name not in headers:
                     headers[header_name] = header_data
         header = <pjsip_hdr *> (<pj_list *> header).next
-    info_dict["headers"] = headers
+    return headers
+
+cdef int _pjsip_msg_to_dict(pjsip_msg *msg, dict info_dict) except -1:
+    cdef pjsip_msg_body *body
+    cdef char *buf
+    cdef int buf_len, status
+    info_dict["headers"] = SIPMessageHeaders_create(msg)
     body = msg.body
     if body == NULL:
         info_dict["body"] = None
@@ -394,5 +650,6 @@ def decode_device_name(device_name):
 
 cdef object _re_pj_status_str_def = re.compile("^.*\((.*)\)$")
 cdef object _re_warning_hdr = re.compile('(?P<code>[0-9]{3}) (?P<agent>.*?) "(?P<text>.*?)"')
+cdef object _multi_headers = frozenset(["Contact", "Route", "Record-Route", "Via"])
 sip_status_messages = SIPStatusMessages()
 
@@ -810,11 +810,66 @@ cdef class RemoteVideoStream(VideoProducer):
 
 cdef class FrameBufferVideoRenderer(VideoConsumer):
 
-    def __init__(self, frame_handler):
+    def __cinit__(self, *args, **kwargs):
+        self._info = <_frame_buffer_renderer_info *> malloc(sizeof(_frame_buffer_renderer_info))
+        if self._info == NULL:
+            raise MemoryError()
+        memset(self._info, 0, sizeof(_frame_buffer_renderer_info))
+        self._info.weakref = <void *> self.weakref
+
+    def __init__(self, frame_handler, int frame_pool_size=4, max_framerate=None, max_size=None):
         super(FrameBufferVideoRenderer, self).__init__()
         if not callable(frame_handler):
             raise TypeError('frame_handler must be callable')
+        if frame_pool_size < 0:
+            raise ValueError('frame_pool_size must be a non-negative number')
         self._frame_handler = frame_handler
+        self._frame_pool = VideoFrameBufferPool(frame_pool_size)
+        self.max_framerate = max_framerate
+        self.max_size = max_size
+
+    property max_framerate:
+
+        def __get__(self):
+            if self._info.min_interval == 0:
+                return None
+            return 1000.0 / self._info.min_interval
+
+        def __set__(self, value):
+            if value is None:
+                self._info.min_interval = 0
+            elif value <= 0:
+                raise ValueError('max_framerate must be a positive number')
+            else:
+                self._info.min_interval = max(1, int(1000 / value))
+            self._info.next_frame = 0
+
+    property max_size:
+
+        def __get__(self):
+            if self._info.max_width == 0 and self._info.max_height == 0:
+                return None
+            return (self._info.max_width or None, self._info.max_height or None)
+
+        def __set__(self, value):
+            cdef unsigned int width
+            cdef unsigned int height
+            if value is None:
+                width = height = 0
+            else:
+                width, height = (0 if item is None else item for item in value)
+            self._info.max_width = width
+            self._info.max_height = height
+
+    property frame_statistics:
+
+        def __get__(self):
+            return dict(received=self._info.received, delivered=self._info.delivered)
+
+    property frame_pool_statistics:
+
+        def __get__(self):
+            return self._frame_pool.statistics
 
     cdef _initialize(self, VideoProducer producer):
         cdef pjmedia_vid_port_param vp_param
@@ -878,7 +933,7 @@ cdef class FrameBufferVideoRenderer(VideoConsumer):
                 raise SIPCoreError("invalid video device stream")
             self._video_stream = video_stream
 
-            ptr = <void*>self.weakref
+            ptr = <void*>self._info
             status = pjmedia_vid_dev_fb_set_callback(video_stream, FrameBufferVideoRenderer_frame_handler, ptr)
             if status != 0:
                 raise PJSIPError("Could not set frame handler callback", status)
@@ -967,6 +1022,10 @@ cdef class FrameBufferVideoRenderer(VideoConsumer):
 
     def __dealloc__(self):
         self.close()
+        if self._info != NULL:
+            free(self._info.scale_buffer)
+            free(self._info)
+            self._info = NULL
 
 
 cdef RemoteVideoStream_create(pjmedia_vid_stream *stream, format_change_handler=None):
@@ -991,34 +1050,189 @@ cdef void _stop_video_port(pjmedia_vid_port *port):
         raise PJSIPError("Could not stop video port", status)
 
 
+# Frames delivered by FrameBufferVideoRenderer live in native buffers which are recycled through a small pool. The
+# VideoFrame exposes the buffer through the buffer protocol (memoryview(frame)), so the pixels can be read without
+# making a copy. The buffer goes back to the pool when the frame is released or garbage collected.
+
+cdef class VideoFrameBuffer:
+
+    def __cinit__(self, size_t capacity):
+        self.buf = <char *> malloc(capacity)
+        if self.buf == NULL:
+            raise MemoryError()
+        self.capacity = capacity
+        self.size = 0
+
+    def __dealloc__(self):
+        free(self.buf)
+        self.buf = NULL
+
+
+cdef class VideoFrameBufferPool:
+
+    def __cinit__(self, int max_size):
+        self.max_size = max_size
+        self._free = list()
+        self.allocated = 0
+        self.reused = 0
+
+    cdef VideoFrameBuffer get(self, size_t size):
+        cdef VideoFrameBuffer buffer
+        while self._free:
+            buffer = self._free.pop()
+            if buffer.capacity >= size:
+                buffer.size = size
+                self.reused += 1
+                return buffer
+        buffer = VideoFrameBuffer(size)
+        buffer.size = size
+        self.allocated += 1
+        return buffer
+
+    cdef int put(self, VideoFrameBuffer buffer) except -1:
+        if len(self._free) < self.max_size:
+            self._free.append(buffer)
+        return 0
+
+    property statistics:
+
+        def __get__(self):
+            return dict(allocated=self.allocated, reused=self.reused, free=len(self._free))
+
+
 cdef class VideoFrame:
 
     def __init__(self, str data, int width, int height):
-        self.data = data
+        self._data = data
         self.width = width
         self.height = height
 
+    def __dealloc__(self):
+        if self._buffer is not None and self._pool is not None:
+            self._pool.put(self._buffer)
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        if self._data is not None:
+            PyBuffer_FillInfo(buffer, self, PyString_AS_STRING(self._data), len(self._data), 1, flags)
+        elif self._buffer is not None:
+            PyBuffer_FillInfo(buffer, self, self._buffer.buf, self._buffer.size, 1, flags)
+        else:
+            raise BufferError("the video frame was released")
+        self._exports += 1
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        self._exports -= 1
+
+    def release(self):
+        """Return the frame memory to the renderer for reuse, the frame cannot be used anymore after that"""
+        if self._exports > 0:
+            raise BufferError("the video frame data is still being used")
+        if self._buffer is not None and self._pool is not None:
+            self._pool.put(self._buffer)
+        self._buffer = None
+        self._data = None
+
+    property data:
+
+        def __get__(self):
+            if self._data is None:
+                if self._buffer is None:
+                    raise ValueError("the video frame was released")
+                self._data = PyString_FromStringAndSize(self._buffer.buf, self._buffer.size)
+            return self._data
+
     property size:
 
         def __get__(self):
             return (self.width, self.height)
 
 
-cdef void FrameBufferVideoRenderer_frame_handler(pjmedia_frame_ptr_const frame, pjmedia_rect_size size, void *user_data) with gil:
+cdef VideoFrame VideoFrame_create(VideoFrameBufferPool pool, char *buf, size_t size, int width, int height):
+    cdef VideoFrame video_frame = VideoFrame.__new__(VideoFrame)
+    video_frame._buffer = pool.get(size)
+    video_frame._pool = pool
+    memcpy(video_frame._buffer.buf, buf, size)
+    video_frame.width = width
+    video_frame.height = height
+    return video_frame
+
+
+cdef void _scale_video_frame(uint32_t *src, unsigned int src_width, unsigned int src_height, uint32_t *dst, unsigned int dst_width, unsigned int dst_height) nogil:
+    # nearest neighbour scaling, the frame buffer renderer always gets 32 bit RGB frames
+    cdef unsigned int x
+    cdef unsigned int y
+    cdef uint32_t *src_row
+    for y in range(dst_height):
+        src_row = src + <size_t> (y * src_height / dst_height) * src_width
+        for x in range(dst_width):
+            dst[x] = src_row[x * src_width / dst_width]
+        dst += dst_width
+
+
+cdef void FrameBufferVideoRenderer_frame_handler(pjmedia_frame_ptr_const frame, pjmedia_rect_size size, void *user_data) nogil:
+    # Frames are dropped and scaled down here, so that the GIL is only taken for the frames which are delivered
+    cdef _frame_buffer_renderer_info *info = <_frame_buffer_renderer_info *> user_data
+    cdef pj_time_val now
+    cdef unsigned long long now_msec
+    cdef unsigned int min_interval
+    cdef unsigned int max_width
+    cdef unsigned int max_height
+    cdef unsigned int width = size.w
+    cdef unsigned int height = size.h
+    cdef size_t scaled_size
+    cdef char *buf = <char *> frame.buf
+    cdef size_t buf_size = frame.size
+    if info == NULL:
+        return
+    info.received += 1
+    min_interval = info.min_interval
+    if min_interval != 0:
+        pj_gettickcount(&now)
+        now_msec = <unsigned long long> now.sec * 1000 + now.msec
+        if now_msec < info.next_frame:
+            return
+        info.next_frame += min_interval
+        if info.next_frame <= now_msec:
+            info.next_frame = now_msec + min_interval
+    max_width = info.max_width
+    max_height = info.max_height
+    if max_width != 0 and width > max_width:
+        height = max(1, height * max_width / width)
+        width = max_width
+    if max_height != 0 and height > max_height:
+        width = max(1, width * max_height / height)
+        height = max_height
+    if (width != size.w or height != size.h) and frame.size >= <size_t> size.w * size.h * 4:
+        scaled_size = <size_t> width * height * 4
+        if info.scale_buffer_size < scaled_size:
+            free(info.scale_buffer)
+            info.scale_buffer = <char *> malloc(scaled_size)
+            if info.scale_buffer == NULL:
+                info.scale_buffer_size = 0
+                return
+            info.scale_buffer_size = scaled_size
+        _scale_video_frame(<uint32_t *> frame.buf, size.w, size.h, <uint32_t *> info.scale_buffer, width, height)
+        buf = info.scale_buffer
+        buf_size = scaled_size
+    else:
+        width = size.w
+        height = size.h
+    info.delivered += 1
+    _FrameBufferVideoRenderer_deliver_frame(info.weakref, buf, buf_size, width, height)
+
+
+cdef void _FrameBufferVideoRenderer_deliver_frame(void *weakref, char *buf, size_t size, int width, int height) with gil:
     cdef PJSIPUA ua
     cdef FrameBufferVideoRenderer rend
     try:
         ua = _get_ua()
     except:
         return
-    if user_data == NULL:
-        return
-    rend = (<object> user_data)()
+    rend = (<object> weakref)()
     if rend is None:
         return
     if rend._frame_handler is not None:
-        data = PyString_FromStringAndSize(<char*>frame.buf, frame.size)
-        rend._frame_handler(VideoFrame(data, size.w, size.h))
+        rend._frame_handler(VideoFrame_create(rend._frame_pool, buf, size, width, height))
 
 
 cdef int RemoteVideoStream_on_event(pjmedia_event *event, void *user_data) with gil:
@@ -11,8 +11,9 @@ import traceback
 import atexit
 
 from application import log
-from application.notification import NotificationCenter, NotificationData
+from application.notification import Any, NotificationCenter, NotificationData
 from application.python.types import Singleton
+from collections import defaultdict
 from threading import Thread, RLock
 
 from sipsimple.core._core import PJSIPUA, PJ_VERSION, PJ_SVN_REVISION, SIPCoreError
@@ -23,6 +24,7 @@ class Engine(Thread):
     __metaclass__ = Singleton
     default_start_options = {"ip_address": None,
                              "udp_port": 0,
+                             "udp_sockets": 1,
                              "tcp_port": None,
                              "tls_port": None,
                              "tls_verify_server": False,
@@ -30,11 +32,20 @@ class Engine(Thread):
                              "tls_cert_file": None,
                              "tls_privkey_file": None,
                              "tls_timeout": 3000,
+                             "async_socket_operations": 1,
+                             "poll_threads": 1,
+                             "media_threads": 1,
+                             "media_thread_affinity": None,
+                             "memory_pool_cache_size": 1048576,
                              "user_agent": "sipsimple-%s-pjsip-%s-r%s" % (__version__, PJ_VERSION, PJ_SVN_REVISION),
                              "log_level": 0,
+                             "log_event_level": None,
+                             "log_buffer_size": 0,
                              "trace_sip": False,
+                             "sip_capture_size": 0,
                              "detect_sip_loops": True,
                              "rtp_port_range": (50000, 50500),
+                             "rtp_port_quarantine_time": 5.0,
                              "zrtp_cache": None,
                              "codecs": ["G722", "speex", "PCMU", "PCMA"],
                              "video_codecs": ["H264", "H263-1998", "VP8"],
@@ -50,12 +61,18 @@ class Engine(Thread):
                              "incoming_events": set(),
                              "incoming_requests": set()}
 
+    # names of the PJSIPUA attributes that are forwarded while the engine is running, they are looked up once at start
+    # because dir() builds a new sorted list every time. The set is replaced as a whole, so readers need no locking.
+    _ua_attributes = frozenset()
+
     def __init__(self):
         self.notification_center = NotificationCenter()
         self._thread_started = False
         self._thread_stopping = False
         self._lock = RLock()
         self._options = None
+        self._posted_events = defaultdict(int)
+        self._skipped_events = defaultdict(int)
         atexit.register(self.stop)
         super(Engine, self).__init__()
         self.daemon = True
@@ -65,13 +82,18 @@ class Engine(Thread):
         return (hasattr(self, "_ua") and hasattr(self, "_thread_started")
                 and self._thread_started and not self._thread_stopping)
 
+    @property
+    def event_statistics(self):
+        names = set(self._posted_events).union(self._skipped_events)
+        return dict((name, dict(posted=self._posted_events.get(name, 0), skipped=self._skipped_events.get(name, 0))) for name in names)
+
     def __getattr__(self, attr):
-        if attr not in ["_ua", "poll"] and hasattr(self, "_ua") and attr in dir(self._ua):
+        if attr in self._ua_attributes:
             return getattr(self._ua, attr)
         raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, attr))
 
     def __setattr__(self, attr, value):
-        if attr not in ["_ua", "poll"] and hasattr(self, "_ua") and attr in dir(self._ua):
+        if attr in self._ua_attributes:
             setattr(self._ua, attr, value)
             return
         object.__setattr__(self, attr, value)
@@ -97,7 +119,9 @@ class Engine(Thread):
         init_options = Engine.default_start_options.copy()
         init_options.update(self._options)
         try:
-            self._ua = PJSIPUA(self._handle_event, **init_options)
+            if init_options["poll_threads"] < 1:
+                raise ValueError("The number of poll threads must be at least 1")
+            self._ua = PJSIPUA(self._handle_events, **init_options)
         except Exception:
             log.exception('Exception occurred while starting the Engine')
             exc_type, exc_val, exc_tb = sys.exc_info()
@@ -106,7 +130,15 @@ class Engine(Thread):
             self.notification_center.post_notification('SIPEngineDidFail', sender=self)
             return
         else:
+            with self._lock:
+                self._ua_attributes = frozenset(dir(self._ua)) - {"_ua", "poll"}
             self.notification_center.post_notification('SIPEngineDidStart', sender=self)
+        # additional threads only handle network I/O and PJSIP timers, everything else is done by this thread in poll
+        self._polling = True
+        poll_threads = [Thread(target=self._poll_events, name='SIPEngine-poll-%d' % index) for index in xrange(1, init_options["poll_threads"])]
+        for thread in poll_threads:
+            thread.daemon = True
+            thread.start()
         failed = False
         while not self._thread_stopping:
             try:
@@ -119,15 +151,50 @@ class Engine(Thread):
             if failed:
                 self.notification_center.post_notification('SIPEngineDidFail', sender=self)
                 break
+        self._polling = False
+        for thread in poll_threads:
+            thread.join()
         if not failed:
             self.notification_center.post_notification('SIPEngineWillEnd', sender=self)
+        with self._lock:
+            self._ua_attributes = frozenset()
         self._ua.dealloc()
         del self._ua
         self.notification_center.post_notification('SIPEngineDidEnd', sender=self)
 
-    def _handle_event(self, event_name, **kwargs):
-        sender = kwargs.pop("obj", None)
-        if sender is None:
-            sender = self
-        self.notification_center.post_notification(event_name, sender, NotificationData(**kwargs))
+    def _poll_events(self):
+        while self._polling:
+            try:
+                self._ua.handle_events()
+            except:
+                log.exception('Exception occurred while handling SIP events')
+                exc_type, exc_val, exc_tb = sys.exc_info()
+                self.notification_center.post_notification('SIPEngineGotException', sender=self, data=NotificationData(type=exc_type, value=exc_val, traceback="".join(traceback.format_exception(exc_type, exc_val, exc_tb))))
+                break
+
+    def _handle_events(self, events):
+        # Called with all the events generated by the core during a poll cycle. Events which nobody observes are only
+        # counted, without building and posting the notification.
+        notification_center = self.notification_center
+        posted_events = self._posted_events
+        skipped_events = self._skipped_events
+        for event_name, kwargs in events:
+            sender = kwargs.pop("obj", None)
+            if sender is None:
+                sender = self
+            if self._has_observers(event_name, sender):
+                posted_events[event_name] += 1
+                notification_center.post_notification(event_name, sender, NotificationData(**kwargs))
+            else:
+                skipped_events[event_name] += 1
+
+    def _has_observers(self, name, sender):
+        observers = getattr(self.notification_center, 'observers', None)
+        if observers is None:
+            return True
+        try:
+            return (name, sender) in observers or (name, Any) in observers or (Any, sender) in observers or (Any, Any) in observers
+        except TypeError:
+            # unhashable sender
+            return True
 
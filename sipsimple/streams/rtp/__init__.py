@@ -4,12 +4,17 @@ Handling of RTP media streams according to RFC3550, RFC3605, RFC3581,
 RFC2833 and RFC3711, RFC3489 and RFC5245.
 """
 
-__all__ = ['RTPStream']
+__all__ = ['RTPStream', 'RTPTransportPool', 'STUNServerRanking']
 
 from abc import ABCMeta, abstractmethod
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null
+from application.python.types import Singleton
+from application.system import host
+from collections import defaultdict, deque
 from threading import RLock
+from time import time
+from twisted.internet import reactor
 from zope.interface import implements
 
 from sipsimple.account import BonjourAccount
@@ -277,6 +282,238 @@ class RTPStreamEncryption(object):
         notification.center.post_notification('RTPStreamDidNotEnableEncryption', sender=stream, data=NotificationData(reason=reason))
 
 
+class RTPTransportPool(object):
+    """
+    Keeps a number of initialized RTP transports for each combination of
+    transport arguments that was requested by a stream, so that new streams
+    don't have to wait for the transport (and ICE candidate gathering) to
+    initialize. The pool is refilled in the background whenever a transport
+    is taken out of it and the number of transports kept for each profile
+    is given by the rtp.transport_pool_size setting.
+    """
+
+    __metaclass__ = Singleton
+    implements(IObserver)
+
+    # ICE candidates are considered stale after this many seconds, as the NAT bindings behind them may have expired
+    ice_max_age = 30
+
+    def __init__(self):
+        self._lock = RLock()
+        self._transports = defaultdict(deque)
+        self._pending = defaultdict(set)
+        self._profiles = {}
+        self._timer = None
+        self.started = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        return SIPSimpleSettings().rtp.transport_pool_size
+
+    @property
+    def statistics(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, available=sum(len(transports) for transports in self._transports.itervalues()),
+                        pending=sum(len(transports) for transports in self._pending.itervalues()))
+
+    def start(self):
+        with self._lock:
+            if self.started:
+                return
+            self.started = True
+            self._timer = reactor.callLater(self.ice_max_age/2.0, self._refresh)
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='NetworkConditionsDidChange')
+        notification_center.add_observer(self, name='CFGSettingsObjectDidChange')
+
+    def stop(self):
+        with self._lock:
+            if not self.started:
+                return
+            self.started = False
+            if self._timer is not None and self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+            self._flush()
+            self._transports.clear()
+            self._pending.clear()
+        notification_center = NotificationCenter()
+        notification_center.remove_observer(self, name='NetworkConditionsDidChange')
+        notification_center.remove_observer(self, name='CFGSettingsObjectDidChange')
+
+    def get(self, encryption=None, use_ice=False, ice_stun_address=None, ice_stun_port=None):
+        """Return an initialized RTPTransport created with the given arguments or None if there is none available"""
+        profile = (encryption, use_ice, ice_stun_address, ice_stun_port)
+        rtp_transport = None
+        with self._lock:
+            if not self.started or self.size == 0:
+                return None
+            transports = self._transports[profile]
+            self._expire(profile, time())
+            if transports:
+                rtp_transport = transports.popleft()[1]
+                del self._profiles[rtp_transport]
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._replenish(profile)
+        if rtp_transport is not None:
+            NotificationCenter().remove_observer(self, sender=rtp_transport)
+        return rtp_transport
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_RTPTransportDidInitialize(self, notification):
+        self._rtp_transport_initialized(notification.sender)
+
+    def _rtp_transport_initialized(self, rtp_transport):
+        if rtp_transport.ice_stun_address is not None:
+            STUNServerRanking().add_result(rtp_transport.ice_stun_address, rtp_transport.ice_stun_port, True)
+        with self._lock:
+            profile = self._profiles.get(rtp_transport)
+            if profile is None or rtp_transport not in self._pending[profile]:
+                return
+            self._pending[profile].remove(rtp_transport)
+            self._transports[profile].append((time(), rtp_transport))
+
+    def _NH_RTPTransportDidFail(self, notification):
+        rtp_transport = notification.sender
+        with self._lock:
+            profile = self._profiles.get(rtp_transport)
+            if profile is None:
+                return
+            self._pending[profile].discard(rtp_transport)
+            self._transports[profile] = deque(item for item in self._transports[profile] if item[1] is not rtp_transport)
+            self._drop(rtp_transport)
+        if rtp_transport.ice_stun_address is not None:
+            STUNServerRanking().add_result(rtp_transport.ice_stun_address, rtp_transport.ice_stun_port, False)
+
+    def _NH_NetworkConditionsDidChange(self, notification):
+        # the local addresses and the NAT bindings are not the same anymore, start over
+        with self._lock:
+            self._flush()
+            for profile in self._transports:
+                self._replenish(profile)
+
+    def _NH_CFGSettingsObjectDidChange(self, notification):
+        if 'rtp.transport_pool_size' not in notification.data.modified:
+            return
+        with self._lock:
+            size = self.size
+            for profile, transports in self._transports.iteritems():
+                while len(transports) > size:
+                    self._drop(transports.pop()[1])
+                self._replenish(profile)
+
+    def _refresh(self):
+        with self._lock:
+            if not self.started:
+                return
+            now = time()
+            for profile in self._transports:
+                self._expire(profile, now)
+                self._replenish(profile)
+            self._timer = reactor.callLater(self.ice_max_age/2.0, self._refresh)
+
+    def _expire(self, profile, now):
+        encryption, use_ice, ice_stun_address, ice_stun_port = profile
+        transports = self._transports[profile]
+        while use_ice and transports and now - transports[0][0] > self.ice_max_age:
+            self._drop(transports.popleft()[1])
+
+    def _replenish(self, profile):
+        encryption, use_ice, ice_stun_address, ice_stun_port = profile
+        pending = self._pending[profile]
+        for i in xrange(self.size - len(self._transports[profile]) - len(pending)):
+            rtp_transport = None
+            try:
+                rtp_transport = RTPTransport(encryption=encryption, use_ice=use_ice, ice_stun_address=ice_stun_address, ice_stun_port=ice_stun_port)
+                NotificationCenter().add_observer(self, sender=rtp_transport)
+                self._profiles[rtp_transport] = profile
+                pending.add(rtp_transport)
+                rtp_transport.set_INIT()
+            except SIPCoreError:
+                if rtp_transport is not None:
+                    pending.discard(rtp_transport)
+                    self._drop(rtp_transport)
+                break
+
+    def _flush(self):
+        for transports in self._transports.itervalues():
+            while transports:
+                self._drop(transports.pop()[1])
+        for pending in self._pending.itervalues():
+            while pending:
+                self._drop(pending.pop())
+
+    def _drop(self, rtp_transport):
+        self._profiles.pop(rtp_transport, None)
+        NotificationCenter().discard_observer(self, sender=rtp_transport)
+
+
+class STUNServerRanking(object):
+    """
+    Remembers for each local address which STUN servers recently worked and
+    which failed during ICE candidate gathering, for
+    rtp.stun_server_ranking_ttl seconds, and uses that to order the STUN
+    servers a stream tries. Servers that worked come first and the ones that
+    failed come last, so a dead server doesn't have to time out on every
+    call. It is only an ordering hint: every stream still runs its own STUN
+    transaction. The results are forgotten when the network conditions
+    change.
+    """
+
+    __metaclass__ = Singleton
+    implements(IObserver)
+
+    def __init__(self):
+        self._lock = RLock()
+        self._results = {}
+        NotificationCenter().add_observer(self, name='NetworkConditionsDidChange')
+
+    @property
+    def ttl(self):
+        return SIPSimpleSettings().rtp.stun_server_ranking_ttl
+
+    def add_result(self, stun_address, stun_port, succeeded):
+        if self.ttl == 0:
+            return
+        with self._lock:
+            self._results[(host.default_ip, stun_address, stun_port)] = (time(), succeeded)
+
+    def get_result(self, stun_address, stun_port):
+        """Return True if the server recently worked, False if it recently failed and None if it's not known"""
+        key = (host.default_ip, stun_address, stun_port)
+        with self._lock:
+            try:
+                timestamp, succeeded = self._results[key]
+            except KeyError:
+                return None
+            if time() - timestamp > self.ttl:
+                del self._results[key]
+                return None
+            return succeeded
+
+    def sort_servers(self, stun_servers):
+        order = {True: 0, None: 1, False: 2}
+        return sorted(stun_servers, key=lambda server: order[self.get_result(*server)])
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_NetworkConditionsDidChange(self, notification):
+        self.clear()
+
+
 class RTPStreamType(ABCMeta, MediaStreamType):
     pass
 
@@ -501,35 +738,14 @@ class RTPStream(object):
         self._init_rtp_transport(notification.data.result)
 
     def _NH_RTPTransportDidInitialize(self, notification):
-        rtp_transport = notification.sender
-        with self._lock:
-            if self.state == "ENDED":
-                self.notification_center.remove_observer(self, sender=rtp_transport)
-                return
-            del self._rtp_args
-            del self._stun_servers
-            remote_sdp = self.__dict__.pop('_incoming_remote_sdp', None)
-            stream_index = self.__dict__.pop('_incoming_stream_index', None)
-            try:
-                if remote_sdp is not None:
-                    transport = self._create_transport(rtp_transport, remote_sdp=remote_sdp, stream_index=stream_index)
-                    self._save_remote_sdp_rtp_info(remote_sdp, stream_index)
-                else:
-                    transport = self._create_transport(rtp_transport)
-            except SIPCoreError, e:
-                self.state = "ENDED"
-                self.notification_center.remove_observer(self, sender=rtp_transport)
-                self.notification_center.post_notification('MediaStreamDidNotInitialize', sender=self, data=NotificationData(reason=e.args[0]))
-                return
-            self._rtp_transport = rtp_transport
-            self._transport = transport
-            self.notification_center.add_observer(self, sender=transport)
-            self._initialized = True
-            self.state = "INITIALIZED"
-            self.notification_center.post_notification('MediaStreamDidInitialize', sender=self)
+        if notification.sender.ice_stun_address is not None:
+            STUNServerRanking().add_result(notification.sender.ice_stun_address, notification.sender.ice_stun_port, True)
+        self._rtp_transport_initialized(notification.sender)
 
     def _NH_RTPTransportDidFail(self, notification):
         self.notification_center.remove_observer(self, sender=notification.sender)
+        if notification.sender.ice_stun_address is not None:
+            STUNServerRanking().add_result(notification.sender.ice_stun_address, notification.sender.ice_stun_port, False)
         with self._lock:
             if self.state == "ENDED":
                 return
@@ -567,12 +783,44 @@ class RTPStream(object):
         self._rtp_args["use_ice"] = self._try_ice
         self._stun_servers = [(None, None)]
         if stun_servers:
-            self._stun_servers.extend(reversed(stun_servers))
+            self._stun_servers.extend(reversed(STUNServerRanking().sort_servers(stun_servers)))
         self._try_next_rtp_transport()
 
+    def _rtp_transport_initialized(self, rtp_transport):
+        with self._lock:
+            if self.state == "ENDED":
+                self.notification_center.remove_observer(self, sender=rtp_transport)
+                return
+            del self._rtp_args
+            del self._stun_servers
+            remote_sdp = self.__dict__.pop('_incoming_remote_sdp', None)
+            stream_index = self.__dict__.pop('_incoming_stream_index', None)
+            try:
+                if remote_sdp is not None:
+                    transport = self._create_transport(rtp_transport, remote_sdp=remote_sdp, stream_index=stream_index)
+                    self._save_remote_sdp_rtp_info(remote_sdp, stream_index)
+                else:
+                    transport = self._create_transport(rtp_transport)
+            except SIPCoreError, e:
+                self.state = "ENDED"
+                self.notification_center.remove_observer(self, sender=rtp_transport)
+                self.notification_center.post_notification('MediaStreamDidNotInitialize', sender=self, data=NotificationData(reason=e.args[0]))
+                return
+            self._rtp_transport = rtp_transport
+            self._transport = transport
+            self.notification_center.add_observer(self, sender=transport)
+            self._initialized = True
+            self.state = "INITIALIZED"
+            self.notification_center.post_notification('MediaStreamDidInitialize', sender=self)
+
     def _try_next_rtp_transport(self, failure_reason=None):
         if self._stun_servers:
             stun_address, stun_port = self._stun_servers.pop()
+            rtp_transport = RTPTransportPool().get(ice_stun_address=stun_address, ice_stun_port=stun_port, **self._rtp_args)
+            if rtp_transport is not None:
+                self.notification_center.add_observer(self, sender=rtp_transport)
+                self._rtp_transport_initialized(rtp_transport)
+                return
             try:
                 rtp_transport = RTPTransport(ice_stun_address=stun_address, ice_stun_port=stun_port, **self._rtp_args)
                 self.notification_center.add_observer(self, sender=rtp_transport)
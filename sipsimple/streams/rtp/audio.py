@@ -4,7 +4,7 @@ __all__ = ['AudioStream']
 from application.notification import NotificationCenter, NotificationData
 from zope.interface import implements
 
-from sipsimple.audio import AudioBridge, AudioDevice, IAudioPort, WaveRecorder
+from sipsimple.audio import AudioBridge, AudioDevice, AudioRecorder, IAudioPort
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.core import AudioTransport, PJSIPError, SIPCoreError
 from sipsimple.streams.rtp import RTPStream
@@ -159,7 +159,7 @@ class AudioStream(RTPStream):
                 raise RuntimeError("AudioStream.start_recording() may not be called in the ENDED state")
             if self._audio_rec is not None:
                 raise RuntimeError("Already recording audio to a file")
-            self._audio_rec = WaveRecorder(self.mixer, filename)
+            self._audio_rec = AudioRecorder(self.mixer, filename)
             if self.state == "ESTABLISHED":
                 self._check_recording()
 